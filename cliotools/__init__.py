@@ -1,5 +1,6 @@
 from .bdi import *
 from .bditools import *
+from .catalog import *
 from .global_badpixfix import *
 from .miscellany import *
 from .pca_skysub import *
@@ -27,7 +27,8 @@ class BDI(object):
                                 subtract_radial_profile = True,
                                 verbose = False,
                                 acube = None,
-                                bcube = None
+                                bcube = None,
+                                subframes = None
                                                 ):
         ''' Class for preparing images for and performing BDI KLIP reduction.
 
@@ -73,6 +74,9 @@ class BDI(object):
             normalized and masked yet; if so set those keywords to false.
         bcube : 3d array
             Optional user input of cube of postage stamps of Star B
+        subframes : Pandas array or str
+            Per-subframe star locations for cube datasets, from findstars_in_dataset, or the path to 
+            'ABLocations_subframes.csv'.  If supplied, used to align each subframe.  Default = None
         A_Reduced : 2d arr
             After running Reduce function, the KLIP reduced images for Star A are stored as this attribute.
         B_Reduced : 2d arr
@@ -114,6 +118,7 @@ class BDI(object):
         self.center = (0.5*((2*self.boxsize)-1),0.5*((2*self.boxsize)-1))
 
         self.subtract_radial_profile = subtract_radial_profile
+        self.subframes = subframes
 
         if np.size(acube) == 1:
             # Execute PrepareCubes on this object and store resulting cubes as attributes:
@@ -131,7 +136,8 @@ class BDI(object):
                                                     outer_mask_radius = self.outer_mask_radius,     # Mask all pixels exterior to this radius
                                                     cval = self.mask_cval,                          # Value to fill masked pixels
                                                     subtract_radial_profile = self.subtract_radial_profile, # Toggle subtract radial profile
-                                                    verbose = self.verbose                          # If True, print status updates
+                                                    verbose = self.verbose,                         # If True, print status updates
+                                                    subframes = self.subframes                      # Per-subframe star locations for cubes
                                                     )
         else:
             # Check 
@@ -254,7 +260,28 @@ class BDI(object):
                 # If using other interp modes skip remasking
                 pass
 
-    
+    def SNRMap(self, radius = 0.5, radius_format = 'lambda/D', wavelength = 3.9):
+        ''' Compute the SNR at every pixel of the KLIP reduced images using bditools.snrmap.
+
+        Must be run after Reduce.  Does not return anything; stores SNR maps (or cubes of maps
+        if size(K_klip) > 1) as attributes A_SNRMap and B_SNRMap.
+
+        Parameters:
+        -----------
+        radius : flt
+            radius of the photometric aperture.  Default = 0.5 lambda/D
+        radius_format : str
+            units of radius, either 'lambda/D' or 'pixels'.  Default = 'lambda/D'
+        wavelength : flt
+            central wavelength in microns of image filter.  Default = 3.9
+        '''
+        if not hasattr(self, 'A_Reduced'):
+            raise ValueError('Run Reduce before computing SNR maps')
+        self.A_SNRMap = snrmap(self.A_Reduced, radius = radius, radius_format = radius_format,
+                                wavelength = wavelength)
+        self.B_SNRMap = snrmap(self.B_Reduced, radius = radius, radius_format = radius_format,
+                                wavelength = wavelength)
+
     def WriteToDisk(self, headercomment = None, outfilesuffix = '', write_directory = ''):
         ''' Writes KLIP reduced images or image cubes to disk.
 
@@ -496,7 +523,6 @@ class ContrastCurve(object):
         self.fontsize = fontsize
         self.plot_cmap = plot_cmap
         self.Ncontours = Ncontours
-        from scipy import interpolate
         # load in snrs if they aren't already saved:
         if load_snrs:
             self.snrs = pickle.load( open( filename, "rb" ) )
@@ -505,17 +531,8 @@ class ContrastCurve(object):
             # regrid separation space to the same number of points as contrast
             # to make a square matrix:
             self.resep = np.linspace(np.min(self.sep),np.max(self.sep),len(self.C))
-            # find which is the largest dimension:
-            m = np.max([len(self.sep),len(self.C)])
-            # create blank array for resampling SNRs:
-            newSNRs = np.zeros((m,m))
-            for i in range(m):
-                # resample SNRs on new grid using scipy.interpolate:
-                f = interpolate.interp1d(self.sep, self.snrs[i])
-                newSNR = f(self.resep)
-                # save in array:
-                newSNRs[i] = newSNR
-            self.newSNRs = newSNRs
+            # resample SNRs for all contrasts on new grid:
+            self.newSNRs = resample_snrs(self.sep, self.snrs, self.resep)
 
         if sep_in_au: 
             if not hasattr(self, 'distance'):
@@ -598,21 +615,23 @@ class ContrastCurve(object):
         plt.title(self.path.split('/')[0]+' '+self.Star)
         return fig
 
-    def Compute5SigmaContrast(self, sep_in_au = True, distance = None):
-        from scipy import interpolate
+    def Compute5SigmaContrast(self, sep_in_au = True, distance = None, sigma = 5.0):
+        ''' Compute the contrast limit at each separation where the SNR falls below sigma.
+        Stores the result as the fivesigmacontrast attribute.
+
+        Parameters
+        ----------
+        sep_in_au : bool
+            if True, also compute the resampled separations in AU (resep_au attribute)
+        distance : tuple, flt
+            if sep_in_au = True, provide distance and error of system for the converstion from lambda/D to AU
+        sigma : flt
+            SNR threshold for the contrast limit.  Default = 5
+        '''
         if not hasattr(self, 'newSNRs'):
             self.resep = np.linspace(np.min(self.sep),np.max(self.sep),len(self.C))
-            # find which is the largest dimension:
-            m = np.max([len(self.sep),len(self.C)])
-            # create blank array for resampling SNRs:
-            newSNRs = np.zeros((m,m))
-            for i in range(m):
-                # resample SNRs on new grid using scipy.interpolate:
-                f = interpolate.interp1d(self.sep, self.snrs[i])
-                newSNR = f(self.resep)
-                # save in array:
-                newSNRs[i] = newSNR
-            self.newSNRs = newSNRs
+            # resample SNRs for all contrasts on new grid:
+            self.newSNRs = resample_snrs(self.sep, self.snrs, self.resep)
 
         if sep_in_au:
             if not hasattr(self, 'distance'):
@@ -630,21 +649,9 @@ class ContrastCurve(object):
                 # if a single value:
                 self.resep_au = lod_to_physical(self.resep, self.distance, 3.9)
 
-        sigmaupper, sigmalower = np.zeros(len(self.resep)),np.zeros(len(self.resep))
-        Cabove5sigmalimit,Cbelow5sigmalimit = np.zeros(len(self.resep)),np.zeros(len(self.resep))
-        for i in range(len(self.resep)):
-            # Collect sigma values above and below 5 sigma:
-            sigmaupper[i] = self.newSNRs[:,i][[np.where(self.newSNRs[:,i] < 5.0)][0][0][0]-1]
-            sigmalower[i] = self.newSNRs[:,i][[np.where(self.newSNRs[:,i] < 5.0)][0][0][0]]
-            # Collect the contrast values at those locations:
-            Cabove5sigmalimit[i] = self.C[[np.where(self.newSNRs[:,i] < 5.0)][0][0][0]-1]
-            Cbelow5sigmalimit[i] = self.C[[np.where(self.newSNRs[:,i] < 5.0)][0][0][0]]
-        # Now interpolate to get contrast at 5 sigma:
-        fivesigmacontrast = np.zeros(len(self.resep))
-        for i in range(len(self.resep)):
-            f = interpolate.interp1d([sigmalower[i],sigmaupper[i]], [Cbelow5sigmalimit[i],Cabove5sigmalimit[i]],fill_value='extrapolate')
-            fivesigmacontrast[i] = f(5.0)
-        self.fivesigmacontrast = fivesigmacontrast
+        # Find the first contrast below the threshold at every separation and interpolate
+        # to get the contrast at the threshold:
+        self.fivesigmacontrast = sigma_contrast_limit(self.newSNRs, self.C, sigma = sigma)
 
     def ContrastCurve5SigmaPlot(self, fontsize=15, plotstyle = 'default', 
                             yaxis_left = 'mag contrast', yaxis_right = 'mass limits',
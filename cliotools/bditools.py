@@ -23,7 +23,7 @@ def update_progress(n,max_value):
     import numpy as np
     barLength = 20 # Modify this to change the length of the progress bar
     status = ""
-    progress = np.round(np.float(n/max_value),decimals=2)
+    progress = np.round(float(n/max_value),decimals=2)
     if isinstance(progress, int):
         progress = float(progress)
     if not isinstance(progress, float):
@@ -189,23 +189,16 @@ def mag(image, x, y, radius = 9., r_in = 10., r_out = 12., returnflux = False, r
         mag : flt
             instrument magnitudes of source
     '''
-    from photutils import CircularAperture, CircularAnnulus, aperture_photometry
-    # Position of star:
-    positions = [(x,y)]
-    # Use radius equal to the firsl null, 1 lamb/d ~ 8.7 pixels:
-    radius = 9.
-    # Get sum of all pixel values within radius of center:
-    apertures = CircularAperture(positions, r=radius)
-    # Get sum of all pixels in annulus around center to sample background:
-    annulus_apertures = CircularAnnulus(positions, r_in=10., r_out=12.)
-    # Put into list:
-    apers = [apertures, annulus_apertures]
-    # Do photometry on star and background:
-    phot_table = aperture_photometry(image, apers)
+    from astropy.table import Table
+    # Sum of all pixel values within radius of center, and in annulus around center to sample background:
+    aperture_sum = aperture_sums(image, x, y, radius = radius)
+    annulus_sum = aperture_sums(image, x, y, radius = r_out) - aperture_sums(image, x, y, radius = r_in)
+    phot_table = Table({'id':[1], 'xcenter':[x], 'ycenter':[y], 'aperture_sum_0':aperture_sum, 
+                        'aperture_sum_1':annulus_sum})
     # Background mean:
-    bkg_mean = phot_table['aperture_sum_1'] / annulus_apertures.area
+    bkg_mean = phot_table['aperture_sum_1'] / (np.pi*(r_out**2 - r_in**2))
     # Backgroud within star aperture:
-    bkg_sum = bkg_mean * apertures.area
+    bkg_sum = bkg_mean * np.pi*radius**2
     # Subtract background from star flux:
     final_sum = phot_table['aperture_sum_0'] - bkg_sum 
     # Add column to table with this final flux
@@ -242,8 +235,9 @@ def contrast(image, pos, **kwargs):
 
 ########## Find Trap B stars: ###########
 
-def findtrapB(image, imstamp, boxsize=50, threshold=1e4, fwhm=10, x1=0, y1=0):
-    """Gotta get fancy to find just those four Trapezium B stars in CLIO.
+def findtrapB(image, imstamp, boxsize=50, threshold=1e4, fwhm=10, x1=0, y1=0, correlator=None, medfilt='full'):
+    """Find the four Trapezium B stars in CLIO.  A configuration of the general
+       N-star finder find_nstars.
        Written by Logan A. Pearce, 2020
 
        Parameters:
@@ -256,7 +250,7 @@ def findtrapB(image, imstamp, boxsize=50, threshold=1e4, fwhm=10, x1=0, y1=0):
             size to draw box around stars for DAOStarFinder
             to look for stars.  Box will have sides of length 2*boxsize
        threshold : int
-           threshold keyword for StarFinder
+           minimum source peak value (not the DAOStarFinder threshold, see StarDetector)
        fwhm : int
            fwhm keyword for StarFinder
        x1, y1 : flt
@@ -265,119 +259,19 @@ def findtrapB(image, imstamp, boxsize=50, threshold=1e4, fwhm=10, x1=0, y1=0):
            pixel as location of B1.  Tell findtrapB where to look
            if B1 is not the brightest star in the image (ex: in L band
            B2 might be brighter, but in Kp B1 is brightest)
+       correlator : FFTCorrelator
+           correlator for imstamp to reuse across images.  Default = None, make one
+       medfilt : str
+           how to smooth the image, see smooth_image.  Default = 'full'
            
        Returns:
        --------
        x_subpix, y_subpix : flt arr
            X and Y subpixel locations of star B1, B2, B3, B4 respectively
     """
-    from scipy import signal, ndimage
-    from photutils import DAOStarFinder
-    import numpy as np
-    from cliotools.bditools import daostarfinder, make_imagestamp
-    
-    # Median filter to smooth image:
-    image = ndimage.median_filter(image, 3)
-    # Create cross-correlation image:
-    corr = signal.correlate2d(image, imstamp, boundary='symm', mode='same')
-    # Initialize output arrays:
-    x_subpix, y_subpix = np.array([]), np.array([])
-    
-    ########### Find B1: ####################
-    # Get x,y:
-    if x1 != 0:
-        x, y, = x1, y1
-    else:
-        y, x = np.unravel_index(np.argmax(corr), corr.shape)
-    # Creat image postage stamp of B1:
-    imagestamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex=boxsize, boxsizey=boxsize)
-    # Use starfinder to find B1 subpixel location
-    sources = daostarfinder(imagestamp)
-    xs, ys = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-    # Append to source list:
-    x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
-    
-    ######### Find B2: #######################
-    # Mask B1:
-    corr_masked = corr.copy()
-    image_masked = image.copy()
-    i=0
-    xx,yy = np.meshgrid(np.arange(image.shape[1])-x_subpix[i],np.arange(image.shape[0])-y_subpix[i])
-    rA=np.hypot(xx,yy)
-    radius = 20
-    corr_masked[np.where((rA < radius))] = 0
-    image_masked[np.where((rA < radius))] = 0
-    # Find location of B2:
-    y, x = np.unravel_index(np.argmax(corr_masked), corr.shape)
-    # Create image postage stamp of B2:
-    imagestamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex=boxsize, boxsizey=boxsize)
-    # Use starfinder to find B2 subpixel location
-    sources = daostarfinder(imagestamp)
-    xs, ys = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-    # Append to source list:
-    x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
-    
-    ######### Find B3: ##########################
-    # Mask B2:
-    corr_masked2 = corr_masked.copy()
-    image_masked2 = image_masked.copy()
-    i=1
-    xx,yy = np.meshgrid(np.arange(image.shape[1])-x_subpix[i],np.arange(image.shape[0])-y_subpix[i])
-    rA=np.hypot(xx,yy)
-    radius=5
-    corr_masked2[np.where((rA < radius))] = 0
-    image_masked2[np.where((rA < radius))] = 0
-    ####### cut out:
-    # We're getting to the two faint stars now, so
-    # let's cut out just the Trapezium B cluster so we don't get fooled by other objects.
-    # Take the mean location of the two bright stars:
-    x2,y2 = np.mean(x_subpix), np.mean(y_subpix)
-    # Find if x-axis or y-axis orientation is bigger:
-    diff = np.array([np.abs(np.diff(x_subpix))[0], np.abs(np.diff(y_subpix))[0]])
-    # Set the boxsize according to orientation:
-    if np.where(np.max([np.diff(x_subpix), np.diff(y_subpix)]))[0]==1:
-        # If oriented along x-axis:
-        boxsizex = 70
-        boxsizey = 50
-    else:
-        # if oriented along y-axis:
-        boxsizex = 50
-        boxsizey = 70
-    # Cut out TrapB section of image and correlation map:   
-    image_masked2, xmin2, xmax2, ymin2, ymax2 = make_imagestamp(image_masked2, x2,y2, \
-                                                                boxsizex=boxsizex, boxsizey=boxsizey)
-    corr_masked2, xmin2, xmax2, ymin2, ymax2 = make_imagestamp(corr_masked2, x2,y2, \
-                                                               boxsizex=boxsizex, boxsizey=boxsizey)
-    # Find B3:
-    y, x = np.unravel_index(np.argmax(corr_masked2), corr_masked2.shape)
-    # Create image postage stamp of B3:
-    imagestamp, xmin, xmax, ymin, ymax = make_imagestamp(image_masked2, x, y, boxsizex=boxsize, boxsizey=boxsize)
-    # Use starfinder to find B2 subpixel location
-    sources = daostarfinder(imagestamp)
-    xs, ys = (xmin2+xmin+sources['xcentroid'])[0], (ymin2+ymin+sources['ycentroid'])[0]
-    x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
-    
-    ######### Find B4: ##########################
-    # Mask B3:
-    corr_masked3 = corr_masked.copy()
-    image_masked3 = image_masked.copy()
-    i=2
-    xx,yy = np.meshgrid(np.arange(image.shape[1])-x_subpix[i],np.arange(image.shape[0])-y_subpix[i])
-    rA=np.hypot(xx,yy)
-    radius=20
-    corr_masked3[np.where((rA < radius))] = 0
-    image_masked3[np.where((rA < radius))] = 0
-    # Do a new cutout with large B2/3 mask:
-    x2,y2 = np.median(x_subpix[0:2]), np.median(y_subpix[0:2])
-    image_masked3, xmin2, xmax2, ymin2, ymax2 = make_imagestamp(image_masked3, x2,y2, \
-                                                                boxsizex=boxsizex, boxsizey=boxsizey)
-    corr_masked3, xmin2, xmax2, ymin2, ymax2 = make_imagestamp(corr_masked3, x2,y2, \
-                                                               boxsizex=boxsizex, boxsizey=boxsizey)
-    # Skipping unravel index because it is too faint:
-    sources = daostarfinder(image_masked3)
-    xs, ys = (xmin2+sources['xcentroid'])[0], (ymin2+sources['ycentroid'])[0]
-    x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
-    return x_subpix, y_subpix
+    first = (int(x1), int(y1)) if x1 != 0 else None
+    return find_nstars(image, imstamp, boxsize = boxsize, threshold = threshold, fwhm = fwhm, first = first,
+                       medfilt = medfilt, correlator = correlator, configuration = 'TrapB')
 
 
 def daostarfinder_trapB(imagestamp, threshold = 1e4, fwhm = 10):
@@ -389,33 +283,26 @@ def daostarfinder_trapB(imagestamp, threshold = 1e4, fwhm = 10):
        imagetamp : 2d array
            image postage stamp for looking for sources
        threshold : int
-           threshold keyword for StarFinder
+           threshold on source peaks, lowered by 0.1 dex until a source is found
        fwhm : int
            fwhm keyword for StarFinder
            
        Returns:
        --------
-       sources : table
-           DAOStarFinder output table of sources
+       arr
+           x, y and peak of each source found; empty if there are none above the detection floor
     """
-    from photutils import DAOStarFinder
-    import warnings
-    import numpy as np
-    warnings.filterwarnings('ignore')
-    # Use DAOStarFinder to find subpixel locations:
+    # Detect once, then apply the threshold to the source peaks:
+    xs, ys, peaks = get_stardetector(fwhm).Sources(imagestamp)
+    if len(xs) == 0:
+        return xs, ys, peaks
     # If the threshold is too high and it can't find a point source, lower the threshold
     # until it finds something
     logthreshold = np.log10(threshold)
-    daofind = DAOStarFinder(fwhm=fwhm, threshold=10**logthreshold)
-    sources = daofind(imagestamp)
-    print(source)
-    while sources==None:
+    while not np.any(peaks >= 10**logthreshold):
         logthreshold -= 0.1
-        #print(logthreshold)
-        daofind = DAOStarFinder(fwhm=fwhm, threshold=10**logthreshold)
-        sources = daofind(imagestamp)
-
-    return sources
+    keep = peaks >= 10**logthreshold
+    return xs[keep], ys[keep], peaks[keep]
 
 def make_imagestamp(image, x, y, boxsizex=50, boxsizey=50):
     import numpy as np
@@ -435,6 +322,188 @@ def make_imagestamp(image, x, y, boxsizex=50, boxsizey=50):
 
 ############################ Finding stars in CLIO images ################################
 
+class FFTCorrelator(object):
+    def __init__(self, imstamp):
+        ''' Cross-correlate images with a reference stamp by FFT.  Reproduces 
+        scipy.signal.correlate2d(image, imstamp, boundary='symm', mode='same') by padding the image 
+        symmetrically and taking the valid part of the FFT convolution with the flipped stamp.  The 
+        stamp spectrum is computed once per image shape and reused for every frame.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, scipy
+
+        Attributes:
+        -----------
+        imstamp : 2d arr
+            reference psf stamp
+
+        Examples:
+        ---------
+        correlator = FFTCorrelator(imstamp)
+        corr = correlator(image)
+        '''
+        self.imstamp = np.array(imstamp, dtype = float)
+        M, N = self.imstamp.shape
+        # symmetric padding that puts the valid region where correlate2d's 'same' output is:
+        self.pad = (((M-1)//2, M-1-(M-1)//2), ((N-1)//2, N-1-(N-1)//2))
+        self._spectra = {}
+
+    def Spectrum(self, shape):
+        ''' FFT shape and spectrum of the flipped stamp for images of this shape
+        '''
+        from scipy import fft
+        shape = tuple(shape)
+        if shape not in self._spectra:
+            M, N = self.imstamp.shape
+            fshape = (fft.next_fast_len(shape[0] + 2*(M-1), real = True), 
+                      fft.next_fast_len(shape[1] + 2*(N-1), real = True))
+            self._spectra[shape] = (fshape, fft.rfft2(self.imstamp[::-1,::-1], fshape))
+        return self._spectra[shape]
+
+    def __call__(self, image):
+        ''' Correlation image, same shape as image
+        '''
+        from scipy import fft
+        image = np.asarray(image, dtype = float)
+        M, N = self.imstamp.shape
+        fshape, spectrum = self.Spectrum(image.shape)
+        padded = np.pad(image, self.pad, mode = 'symmetric')
+        full = fft.irfft2(fft.rfft2(padded, fshape) * spectrum, fshape)
+        return full[M-1:M-1+image.shape[0], N-1:N-1+image.shape[1]]
+
+# DAOStarFinder objects keyed by fwhm, so the kernel is built once.  They detect everything above
+# _detection_floor and StarDetector.Find applies the requested threshold to the source peaks, so a
+# ramp of thresholds reuses the same finder:
+_star_finders = {}
+_detection_floor = 10.
+
+def get_starfinder(fwhm = 10):
+    ''' Cached photutils DAOStarFinder for fwhm, detecting sources down to _detection_floor
+    '''
+    key = float(fwhm)
+    if key not in _star_finders:
+        from photutils import DAOStarFinder
+        _star_finders[key] = DAOStarFinder(fwhm = fwhm, threshold = _detection_floor)
+    return _star_finders[key]
+
+class StarDetector(object):
+    def __init__(self, fwhm = 10, threshold = 1e4, ncores = 1):
+        ''' Reusable DAOStarFinder detector.  The finder for each fwhm is built once and shared by 
+        all detectors (see get_starfinder), sources are kept if their peak is above the threshold, 
+        results are returned as plain arrays, and find_in_cube locates the star in every stamp of a 
+        cube, optionally in a thread pool.
+
+        Note the threshold is not DAOStarFinder's threshold keyword, which applies to the image 
+        convolved with the Gaussian kernel.  Sources are detected down to a fixed convolved threshold
+        of _detection_floor, then kept if their 'peak' (the maximum of the unconvolved data) is at 
+        least the threshold.  For stars matching the kernel the two are close; for faint or extended 
+        sources they differ, and nothing below _detection_floor is ever found.  All the star finders
+        built on StarDetector (daostarfinder, daostarfinder_trapB, findstars, findtrapB, find_nstars,
+        track_stars, findstars_in_dataset, ab_stack_shift) use these semantics.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, photutils
+
+        Attributes:
+        -----------
+        fwhm : flt
+            fwhm keyword for DAOStarFinder.  Default = 10
+        threshold : flt
+            starting minimum source peak value.  Default = 1e4
+        ncores : int
+            number of threads for find_in_cube.  Default = 1
+        '''
+        self.fwhm = fwhm
+        self.threshold = threshold
+        self.ncores = ncores
+
+    def Sources(self, stamp):
+        ''' All sources in a stamp down to _detection_floor.  Returns arrays of x, y centroid and 
+        peak for each source, in DAOStarFinder order; empty arrays if none were found.
+        '''
+        import warnings
+        from photutils.utils.exceptions import NoDetectionsWarning
+        with warnings.catch_warnings():
+            # An empty search isn't worth a warning, we return empty arrays:
+            warnings.simplefilter('ignore', NoDetectionsWarning)
+            sources = get_starfinder(self.fwhm)(stamp)
+        if sources is None:
+            return np.array([]), np.array([]), np.array([])
+        return np.array(sources['xcentroid']), np.array(sources['ycentroid']), np.array(sources['peak'])
+
+    def Find(self, stamp, threshold = None):
+        ''' Sources in a stamp with peak above threshold.  Returns arrays of x, y centroid and peak 
+        for each source, in DAOStarFinder order; empty arrays if none were found.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        xs, ys, peaks = self.Sources(stamp)
+        keep = peaks >= threshold
+        return xs[keep], ys[keep], peaks[keep]
+
+    def Locate(self, image, x, y, boxsize = 100, threshold = None):
+        ''' Subpixel location of the single star within boxsize of (x, y), as daostarfinder: if 
+        several sources are found the threshold is raised until only one remains; if none are 
+        found, retry starting at thresholds 1e3 then 5e2.  Returns nan, nan on failure.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        stamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex = boxsize, boxsizey = boxsize)
+        # Detect once, then apply each threshold to the source peaks:
+        xs, ys, peaks = self.Sources(stamp)
+        for thresh, step in [(threshold, 500), (1e3, 250), (5e2, 250)]:
+            keep = peaks >= thresh
+            while np.sum(keep) > 1:
+                thresh += step
+                keep = peaks >= thresh
+            if np.sum(keep) == 1:
+                return np.int_(xmin) + xs[keep][0], np.int_(ymin) + ys[keep][0]
+        return np.nan, np.nan
+
+    def find_in_cube(self, stamps, x = None, y = None, boxsize = None, threshold = None):
+        ''' Locate the star in every stamp of a cube.
+
+        Parameters:
+        -----------
+        stamps : 3d arr
+            cube of stamps
+        x, y : flt or arr
+            location of the star in each stamp.  Default = None, the stamp center
+        boxsize : int
+            search box half-width.  Default = None, the whole stamp
+        threshold : flt
+            starting threshold.  Default = None, self.threshold
+
+        Returns:
+        --------
+        arr
+            x and y subpixel location of the star in each stamp, nan where it wasn't found
+        '''
+        N, ny, nx = np.shape(stamps)
+        x = np.broadcast_to(nx//2 if x is None else x, (N,))
+        y = np.broadcast_to(ny//2 if y is None else y, (N,))
+        boxsize = np.max([nx, ny]) if boxsize is None else boxsize
+        locate = lambda i: self.Locate(stamps[i], x[i], y[i], boxsize = boxsize, threshold = threshold)
+        if self.ncores > 1:
+            import warnings
+            from concurrent.futures import ThreadPoolExecutor
+            # The warning filters are process-wide, so restore them once all threads are done:
+            with warnings.catch_warnings(), ThreadPoolExecutor(max_workers = self.ncores) as executor:
+                results = list(executor.map(locate, range(N)))
+        else:
+            results = [locate(i) for i in range(N)]
+        results = np.array(results, dtype = float).reshape(N, 2)
+        return results[:,0], results[:,1]
+
+# StarDetectors keyed by fwhm for the single-star finders, which pass their threshold per call:
+_star_detectors = {}
+
+def get_stardetector(fwhm = 10):
+    ''' Cached StarDetector for fwhm
+    '''
+    key = float(fwhm)
+    if key not in _star_detectors:
+        _star_detectors[key] = StarDetector(fwhm = fwhm)
+    return _star_detectors[key]
+
 def daostarfinder(scienceimage, x, y, boxsize = 100, threshold = 1e4, fwhm = 10, verbose = True):
     """Find the subpixel location of a single star in a single clio BDI image.
        Written by Logan A. Pearce, 2020
@@ -450,7 +519,7 @@ def daostarfinder(scienceimage, x, y, boxsize = 100, threshold = 1e4, fwhm = 10,
        boxsize : int
            size of box to draw around star psfs for DAOStarFinder
        threshold : int
-           threshold keyword for StarFinder
+           minimum source peak value (not the DAOStarFinder threshold, see StarDetector)
        fwhm : int
            fwhm keyword for StarFinder
            
@@ -459,72 +528,69 @@ def daostarfinder(scienceimage, x, y, boxsize = 100, threshold = 1e4, fwhm = 10,
        x_subpix, y_subpix : flt
            subpixel location of star
     """
-    from photutils import DAOStarFinder
-    image2 = scienceimage
-    # The settings fwhm = 10.0 seems to be good for clio
-    # Define box around source B:
-    ymin, ymax = y-boxsize, y+boxsize
-    xmin, xmax = x-boxsize, x+boxsize
-    # Correct for sources near image edge:
-    if ymin < 0:
-        ymin = 0
-    if ymax > scienceimage.shape[0]:
-        ymax = scienceimage.shape[0]
-    if xmin < 0:
-        xmin = 0
-    if xmax > scienceimage.shape[1]:
-        xmax = scienceimage.shape[1]
-    # Use DAOStarFinder to find subpixel locations:
-    # If the threshold is too high and it can't find a point source, lower the threshold
-    # until ~ 5e2, then declare failure.
-    try:
-        #print('threshold =',threshold)
-        daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-        sources = daofind(image2[np.int_(ymin):np.int_(ymax),\
-                                     np.int_(xmin):np.int_(xmax)])
-        x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-        # If it finds too many sources, keep uping the search threshold until there is only one:
-        while len(sources) > 1:
-            threshold += 500
-            daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-            sources = daofind(image2[np.int_(y-boxsize):np.int_(y+boxsize),np.int_(x-boxsize):np.int_(x+boxsize)])
-            x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-    except:
-        try:
-            threshold=1e3
-            #print('threshold =',threshold)
-            daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-            sources = daofind(image2[np.int_(ymin):np.int_(ymax),\
-                                         np.int_(xmin):np.int_(xmax)])
-            x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-            while len(sources) > 1:
-                threshold += 250
-                daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-                sources = daofind(image2[np.int_(y-boxsize):np.int_(y+boxsize),np.int_(x-boxsize):np.int_(x+boxsize)])
-                x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-        except:
-            try:
-                threshold=5e2
-                #print('threshold =',threshold)
-                daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-                sources = daofind(image2[np.int_(ymin):np.int_(ymax),\
-                                             np.int_(xmin):np.int_(xmax)])
-                x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-                while len(sources) > 1:
-                    threshold += 250
-                    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold) 
-                    sources = daofind(image2[np.int_(y-boxsize):np.int_(y+boxsize),np.int_(x-boxsize):np.int_(x+boxsize)])
-                    x_subpix, y_subpix = (xmin+sources['xcentroid'])[0], (ymin+sources['ycentroid'])[0]
-            except:
-                if verbose:
-                    print("daostarfinder: Failed to find all stars.")
-                x_subpix, y_subpix = np.nan, np.nan
-
+    x_subpix, y_subpix = get_stardetector(fwhm).Locate(scienceimage, x, y, boxsize = boxsize, threshold = threshold)
+    if np.isnan(x_subpix) and verbose:
+        print("daostarfinder: Failed to find all stars.")
     return x_subpix, y_subpix
 
+def smooth_image(image, medfilt = 'full', size = 3, nsigma = 5):
+    """Denoise an image before star finding.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy, scipy
+
+       Parameters:
+       -----------
+       image : 2d array
+           image to smooth
+       medfilt : str
+           'full': size x size median filter of the whole image.
+           'separable': 1 x size then size x 1 median filters, a faster approximation of 'full'.
+           'badpix': replace only pixels deviating from the separable median by more than nsigma
+               robust standard deviations, leaving the rest of the image untouched.
+           'none' or 'window': return the image unfiltered ('window' filters later, only within 
+               the star finding windows).
+           Default = 'full'
+       size : int
+           filter size.  Default = 3
+       nsigma : flt
+           outlier threshold for 'badpix'.  Default = 5
+           
+       Returns:
+       --------
+       2d array
+           smoothed image
+    """
+    if medfilt == 'full':
+        return ndimage.median_filter(image, size)
+    if medfilt in ['none', 'window']:
+        return image
+    if medfilt not in ['separable', 'badpix']:
+        raise ValueError("medfilt must be one of 'full', 'window', 'separable', 'badpix', 'none'")
+    med = ndimage.median_filter(ndimage.median_filter(image, size = (1,size)), size = (size,1))
+    if medfilt == 'separable':
+        return med
+    resid = image - med
+    sigma = 1.4826 * np.median(np.abs(resid - np.median(resid)))
+    return np.where(np.abs(resid) > nsigma*sigma, med, image)
+
+def _daostarfinder_window(image, x, y, boxsize = 100, threshold = 1e4, fwhm = 10, 
+                          x_masked = [], y_masked = [], radius = 20):
+    """daostarfinder on an unfiltered image, median filtering only the search window.  Stars 
+       already found at (x_masked, y_masked) are masked out to radius as in findstars.
+    """
+    # Window with a one pixel margin for the filter edge:
+    stamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex = boxsize+1, boxsizey = boxsize+1)
+    xmin, ymin = np.int_(xmin), np.int_(ymin)
+    stamp = ndimage.median_filter(stamp, 3)
+    for xm, ym in zip(x_masked, y_masked):
+        xx,yy = np.meshgrid(np.arange(xmin, xmin+stamp.shape[1])-xm, np.arange(ymin, ymin+stamp.shape[0])-ym)
+        stamp[np.where(np.hypot(xx,yy) < radius)] = 0
+    xs, ys = daostarfinder(stamp, x-xmin, y-ymin, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
+    return xmin+xs, ymin+ys
+
 def findstars(imstamp, scienceimage_filename, nstars, \
               boxsize = 100, threshold = 1e4, fwhm = 10, radius = 20,
-              a_guess = [], b_guess = []):
+              a_guess = [], b_guess = [], correlator = None, medfilt = 'full'):
     """Find the subpixel location of all stars in a single clio BDI image using DAOStarFinder 
        (https://photutils.readthedocs.io/en/stable/api/photutils.detection.DAOStarFinder.html).
        Written by Logan A. Pearce, 2020
@@ -534,60 +600,75 @@ def findstars(imstamp, scienceimage_filename, nstars, \
        -----------
        imstamp : 2d array
            boxsizex by boxsizey substamp image of a reference psf for cross correlation
-       scienceimage_filename : string
-           path to science image
+       scienceimage_filename : string or 2d array
+           path to science image, or the image itself
        nstars : int
            number of stars in the image.
        boxsize : int
            size of box to draw around star psfs for DAOStarFinder
        threshold : int
-           threshold keyword for DAO StarFinder
+           minimum source peak value (not the DAOStarFinder threshold, see StarDetector)
        fwhm : int
            fwhm keyword for DAO StarFinder
        radius : int
            radius to use when masking stars in image
         a_guess, b_guess : tuple
             (x,y) pixel tuple of rought guess of location of star A and B in image
+        correlator : FFTCorrelator
+            correlator for imstamp, reused across a dataset so the stamp spectrum is computed once.
+            Default = None, make one
+        medfilt : str
+            how to smooth the image, see smooth_image.  'window' median filters only the 
+            DAOStarFinder windows and correlates the unfiltered image.  Default = 'full'
            
        Returns:
        --------
        x_subpix, y_subpix : arr,flt
            1 x nstars array of subpixel x location and y location of stars
     """
-    from scipy import signal
     
     # Open science target image:
-    image = fits.getdata(scienceimage_filename)
+    if isinstance(scienceimage_filename, str):
+        image = fits.getdata(scienceimage_filename)
+    else:
+        image = np.asarray(scienceimage_filename)
     # If image is a cube, take the first image:
     if len(image.shape) == 3:
         image = image[0]
     # Median filter to smooth image:
-    image = ndimage.median_filter(image, 3)
+    image = smooth_image(image, medfilt)
+    window = medfilt == 'window'
     # Make container to hold results:
     x_subpix, y_subpix = np.array([]), np.array([])
 
     if len(a_guess) != 0:
-        # Run starfinder at location of guess:
-        x,y = a_guess[0],a_guess[1]
-        xs, ys = daostarfinder(image, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
-        x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
-        # repeat for B:
-        x,y = b_guess[0],b_guess[1]
-        xs, ys = daostarfinder(image, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
-        x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
+        # Run starfinder at location of guess, repeat for B:
+        for x, y in [a_guess, b_guess]:
+            if window:
+                xs, ys = _daostarfinder_window(image, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
+            else:
+                xs, ys = daostarfinder(image, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
+            x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
     
     else:
         # Use cross-correlation to find int(y,x) of star A (brightest star) in image:
-        corr = signal.correlate2d(image, imstamp, boundary='symm', mode='same')
+        if correlator is None:
+            correlator = FFTCorrelator(imstamp)
+        corr = correlator(image)
         # Find the location of the brightest star in the image:
         y, x = np.unravel_index(np.argmax(corr), corr.shape)
         # Make a copy of the correlation image to mask:
         corr_masked = corr.copy()
-        image_masked = image.copy()
+        if not window:
+            image_masked = image.copy()
         # For each star in the image:
         for i in range(nstars):
             # Use DAO Star Finder to find the subpixel location of the star at that location:
-            xs, ys = daostarfinder(image_masked, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
+            if window:
+                xs, ys = _daostarfinder_window(image, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm,
+                                               x_masked = x_subpix, y_masked = y_subpix, radius = radius)
+            else:
+                xs, ys = daostarfinder(image_masked, x, y, boxsize = boxsize, threshold = threshold, fwhm = fwhm)
             x_subpix, y_subpix = np.append(x_subpix, xs), np.append(y_subpix, ys)
             # Make a mask around that star on the cross-correlation image:
             # Make a meshgrid of the image centered at the last found star:
@@ -597,16 +678,556 @@ def findstars(imstamp, scienceimage_filename, nstars, \
             # Mask wherever that distance is less than the set radius and
             # set those pixels to zero:
             corr_masked[np.where((rA < radius))] = 0
-            image_masked[np.where((rA < radius))] = 0
+            if not window:
+                image_masked[np.where((rA < radius))] = 0
             # Now find the new highest correlation which should be the next star:
             y, x = np.unravel_index(np.argmax(corr_masked), corr.shape)
             # Repeat until all stars are found.
 
     return x_subpix, y_subpix
 
+# Star finder configurations for fields find_nstars handles with non-default settings.
+_star_configurations = {
+    # Trapezium B: two bright stars (B1, B2) and two faint ones (B3 just next to B2, B4), 
+    # all within ~70 pixels of B1:
+    'TrapB': {'nstars':4, 'min_separation':5, 'cluster_box':70, 'boxsize':50},
+}
+
+def _psf_model(imstamp, fwhm = 10):
+    ''' Background subtracted reference stamp and the subpixel location of the star in it, to 
+        subtract found stars from an image.
+    '''
+    model = np.array(imstamp, dtype = float)
+    border = np.concatenate([model[0], model[-1], model[1:-1,0], model[1:-1,-1]])
+    model = model - np.median(border)
+    y0, x0 = np.unravel_index(np.argmax(model), model.shape)
+    xs, ys = centroid_stack(model[np.newaxis], fwhm = fwhm, x0 = x0, y0 = y0)
+    return model, xs[0], ys[0]
+
+def _star_model(image_shape, model, xs, ys, x, y):
+    ''' The psf model shifted to put its star at (x, y), cut to the part overlapping an image of 
+        image_shape.  Returns the cut model and the image slices it covers, or None if it doesn't 
+        overlap.
+    '''
+    ny, nx = model.shape
+    ox, oy = int(np.floor(x - xs)), int(np.floor(y - ys))
+    x0, x1 = max(ox, 0), min(ox + nx, image_shape[1])
+    y0, y1 = max(oy, 0), min(oy + ny, image_shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    shifted = ndimage.shift(model, (y - ys - oy, x - xs - ox), order = 3, mode = 'constant')
+    return shifted[y0-oy:y1-oy, x0-ox:x1-ox], (slice(y0, y1), slice(x0, x1))
+
+def _fit_star(image, star):
+    ''' Least squares amplitude of a star model (from _star_model) in image, fit together with 
+        a constant background.  Returns the scaled model, never negative.
+    '''
+    shifted, region = star
+    A = np.vstack([shifted.ravel(), np.ones(shifted.size)]).T
+    amplitude = np.linalg.lstsq(A, image[region].ravel(), rcond = None)[0][0]
+    return max(amplitude, 0) * shifted
+
+def _next_peak(corr, peaks, min_separation, cluster_box = None):
+    ''' Highest correlation at least min_separation pixels from every peak already found, and 
+        within cluster_box pixels of the first one if given.  Returns (x, y), or None if there is 
+        nowhere left to look.
+    '''
+    allowed = np.isfinite(corr)
+    yy, xx = np.mgrid[0:corr.shape[0], 0:corr.shape[1]]
+    for x, y in peaks:
+        allowed &= np.hypot(xx - x, yy - y) >= min_separation
+    if cluster_box is not None and len(peaks) != 0:
+        x0, y0 = peaks[0]
+        allowed &= (np.abs(xx - x0) <= cluster_box) & (np.abs(yy - y0) <= cluster_box)
+    if not np.any(allowed):
+        return None
+    y, x = np.unravel_index(np.argmax(np.where(allowed, corr, -np.inf)), corr.shape)
+    return x, y
+
+def _centroid_peak(image, x, y, boxsize = 50, threshold = 1e4, fwhm = 10, medfilt_window = False, 
+                   detector = None):
+    ''' Subpixel location of the star at a correlation peak: DAOStarFinder on a stamp around the 
+        peak, keeping the source nearest the peak.  If no source is found within fwhm of the peak 
+        the threshold is halved, down to threshold/64.  Returns nan, nan if none is found.
+    '''
+    if detector is None:
+        detector = get_stardetector(fwhm)
+    stamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex = boxsize, boxsizey = boxsize)
+    xmin, ymin = np.int_(xmin), np.int_(ymin)
+    if medfilt_window:
+        stamp = ndimage.median_filter(stamp, 3)
+    thresh = threshold
+    while thresh >= threshold/64:
+        xs, ys, fluxes = detector.Find(stamp, thresh)
+        thresh = thresh / 2
+        if len(xs) == 0:
+            continue
+        dist = np.hypot(xs - (x - xmin), ys - (y - ymin))
+        j = np.argmin(dist)
+        if dist[j] <= fwhm:
+            return xmin + xs[j], ymin + ys[j]
+    return np.nan, np.nan
+
+def find_nstars(image, imstamp, nstars = None, min_separation = None, boxsize = None, threshold = 1e4, fwhm = 10,
+                cluster_box = None, first = None, medfilt = 'full', correlator = None, configuration = None):
+    """Find the subpixel location of any number of stars in an image.  Stars are found one at a 
+       time: the highest peak of the cross-correlation of the image with the reference stamp is 
+       centroided with DAOStarFinder, a scaled copy of the reference stamp is subtracted there, 
+       and the correlation of what is left is searched for the next star.  So a faint star on the 
+       flank of a bright one, which is not a peak of the correlation of the full image, is found 
+       once the bright one is removed.  Each star is finally re-centroided with all the others 
+       subtracted.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy, scipy, photutils
+
+       Parameters:
+       -----------
+       image : 2d array
+           image within which to find stars
+       imstamp : 2d array
+           image postage stamp of a reference psf for cross correlation
+       nstars : int
+           number of stars.  Default = 2
+       min_separation : flt
+           minimum separation between stars in pixels.  Default = 20
+       boxsize : int
+           half-width of the stamp around each peak for DAOStarFinder.  Default = 50
+       threshold : flt
+           minimum source peak value (not the DAOStarFinder threshold, see StarDetector)
+       fwhm : flt
+           fwhm keyword for DAOStarFinder
+       cluster_box : int
+           if given, only look for stars within this many pixels of the brightest star.  Default = None
+       first : tuple
+           (x, y) location of the first star if it is not the brightest correlation peak.  Default = None
+       medfilt : str
+           how to smooth the image, see smooth_image.  Default = 'full'
+       correlator : FFTCorrelator
+           correlator for imstamp to reuse across images.  Default = None, make one
+       configuration : str
+           name of a configuration in _star_configurations (e.g. 'TrapB') supplying nstars, 
+           min_separation, cluster_box and boxsize when they are not given.  Default = None
+           
+       Returns:
+       --------
+       x_subpix, y_subpix : arr,flt
+           subpixel x and y locations of stars in the order they were found (brightest first); 
+           nan for a star DAOStarFinder could not centroid
+    """
+    import warnings
+    config = _star_configurations[configuration] if configuration is not None else {}
+    defaults = {'nstars':2, 'min_separation':20, 'boxsize':50, 'cluster_box':None}
+    nstars = nstars if nstars is not None else config.get('nstars', defaults['nstars'])
+    min_separation = min_separation if min_separation is not None else config.get('min_separation', defaults['min_separation'])
+    boxsize = boxsize if boxsize is not None else config.get('boxsize', defaults['boxsize'])
+    cluster_box = cluster_box if cluster_box is not None else config.get('cluster_box', defaults['cluster_box'])
+    # If image is a cube, take the first image:
+    image = np.asarray(image)
+    if len(image.shape) == 3:
+        image = image[0]
+    image = np.array(smooth_image(image, medfilt), dtype = float)
+    window = medfilt == 'window'
+    if correlator is None:
+        correlator = FFTCorrelator(imstamp)
+    model, xs0, ys0 = _psf_model(imstamp, fwhm = fwhm)
+    detector = get_stardetector(fwhm)
+    x_subpix, y_subpix = np.full(nstars, np.nan), np.full(nstars, np.nan)
+    peaks, stars = [], []
+    residual = image.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        corr = correlator(residual)
+        for i in range(nstars):
+            peak = first if (i == 0 and first is not None) else _next_peak(corr, peaks, min_separation, cluster_box = cluster_box)
+            if peak is None:
+                break
+            peaks.append(peak)
+            x_subpix[i], y_subpix[i] = _centroid_peak(residual, *peak, boxsize = boxsize, threshold = threshold, 
+                                                      fwhm = fwhm, medfilt_window = window, detector = detector)
+            # Subtract the star (at the peak if it couldn't be centroided) and correlate what's left:
+            x, y = (x_subpix[i], y_subpix[i]) if np.isfinite(x_subpix[i]) else peak
+            star = _star_model(image.shape, model, xs0, ys0, x, y)
+            stars.append(star)
+            if star is not None:
+                star = (_fit_star(residual, star), star[1])
+                stars[i] = star
+                residual[star[1]] -= star[0]
+                if i < nstars - 1:
+                    corr = correlator(residual)
+        # Re-centroid each star with all the others subtracted:
+        for i, (peak, star) in enumerate(zip(peaks, stars)):
+            if star is None or not np.isfinite(x_subpix[i]):
+                continue
+            alone = residual.copy()
+            alone[star[1]] += star[0]
+            x, y = _centroid_peak(alone, *peak, boxsize = boxsize, threshold = threshold, fwhm = fwhm, 
+                                  medfilt_window = window, detector = detector)
+            if np.isfinite(x):
+                x_subpix[i], y_subpix[i] = x, y
+    return x_subpix, y_subpix
+
+def centroid_stack(stamps, fwhm = 10, x0 = None, y0 = None, niter = 10):
+    """Gaussian-windowed centroids of a stack of postage stamps, computed for the whole stack at once.
+       Each stamp's border median is subtracted as background, then the centroid is iterated with a
+       Gaussian window of the given fwhm centered on the current estimate.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy
+
+       Parameters:
+       -----------
+       stamps : 3d array
+           stack of stamps of shape (N, ny, nx)
+       fwhm : flt
+           fwhm of the psf in pixels, sets the window width
+       x0, y0 : flt or arr
+           starting location in stamp pixels.  Default = stamp center
+       niter : int
+           number of iterations.  Default = 10
+           
+       Returns:
+       --------
+       xc, yc : arr
+           subpixel x and y location of the star in each stamp
+    """
+    stamps = np.asarray(stamps, dtype = float)
+    N, ny, nx = stamps.shape
+    border = np.concatenate([stamps[:,0,:], stamps[:,-1,:], stamps[:,1:-1,0], stamps[:,1:-1,-1]], axis = 1)
+    stamps = stamps - np.median(border, axis = 1)[:,np.newaxis,np.newaxis]
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    xc = np.broadcast_to(0.5*(nx-1) if x0 is None else x0, (N,)).astype(float)
+    yc = np.broadcast_to(0.5*(ny-1) if y0 is None else y0, (N,)).astype(float)
+    sigma2 = (fwhm/2.355)**2
+    for i in range(niter):
+        dx, dy = xx - xc[:,np.newaxis,np.newaxis], yy - yc[:,np.newaxis,np.newaxis]
+        wI = np.exp(-0.5*(dx**2 + dy**2)/sigma2) * stamps
+        norm = np.sum(wI, axis = (1,2))
+        # Windowed centroid update (factor 2 makes it converge to the center of a Gaussian):
+        xc = np.clip(xc + 2*np.sum(wI*dx, axis = (1,2))/norm, 0, nx-1)
+        yc = np.clip(yc + 2*np.sum(wI*dy, axis = (1,2))/norm, 0, ny-1)
+    bad = ~(norm > 0)
+    xc[bad], yc[bad] = np.nan, np.nan
+    return xc, yc
+
+def subframe_positions(cube, x_subpix, y_subpix, fwhm = 10, medfilt = 'full'):
+    """Subpixel location of each star in every subframe of a coadd cube, from its location in the 
+       first subframe.  All subframes are centroided at once with centroid_stack.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy, scipy
+
+       Parameters:
+       -----------
+       cube : 3d array
+           image cube
+       x_subpix, y_subpix : arr
+           star locations in the first subframe, e.g. from findstars
+       fwhm : flt
+           fwhm of the psf in pixels
+       medfilt : str
+           'none' to skip the 3x3 median filter of each subframe stamp.  Default = 'full'
+           
+       Returns:
+       --------
+       3d arr
+           positions of shape (nsubframes, nstars, 2), x then y; nan where a star's stamp falls 
+           off the image
+    """
+    half = int(np.ceil(2*fwhm))
+    positions = np.full((cube.shape[0], len(x_subpix), 2), np.nan)
+    for i, (x, y) in enumerate(zip(x_subpix, y_subpix)):
+        if np.isnan(x) or np.isnan(y):
+            continue
+        xi, yi = int(np.round(x)), int(np.round(y))
+        if yi-half < 0 or xi-half < 0 or yi+half+1 > cube.shape[1] or xi+half+1 > cube.shape[2]:
+            continue
+        stamps = cube[:, yi-half:yi+half+1, xi-half:xi+half+1]
+        if medfilt != 'none':
+            stamps = ndimage.median_filter(stamps, size = (1,3,3))
+        xc, yc = centroid_stack(stamps, fwhm = fwhm, x0 = x-(xi-half), y0 = y-(yi-half))
+        positions[:,i,0], positions[:,i,1] = xi-half+xc, yi-half+yc
+    return positions
+
+def read_subframe_locations(file):
+    """Read the per-subframe star locations written by findstars_in_dataset for cube datasets, 
+       naming the first two stars' columns as ab_stack_shift expects.
+       Written by Logan A. Pearce, 2020
+
+       Parameters:
+       -----------
+       file : str
+           path to ABLocations_subframes.csv
+           
+       Returns:
+       --------
+       pandas DataFrame
+           filename, subframe, xca, yca, xcb, ycb, ...
+    """
+    k = pd.read_csv(file)
+    return k.rename(columns = {'xc1':'xca', 'yc1':'yca', 'xc2':'xcb', 'yc2':'ycb'})
+
+# Per-star frame quality metrics, in the order stamp_quality returns them:
+_quality_metrics = ['peak', 'flux', 'strehl', 'fwhm', 'saturated', 'edge_distance', 'centroid_residual']
+
+def stamp_quality(stamps, x, y, fwhm = 10, saturation = None):
+    """Image quality metrics for a stack of star stamps, computed for the whole stack at once.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy
+
+       Parameters:
+       -----------
+       stamps : 3d array
+           stack of stamps of shape (N, ny, nx) around stars
+       x, y : arr
+           star location in each stamp, stamp pixels
+       fwhm : flt
+           nominal fwhm of the psf in pixels
+       saturation : flt
+           detector saturation/linearity level.  Default = None, don't check
+           
+       Returns:
+       --------
+       2d arr
+           metrics of shape (N, 6): peak (background subtracted), flux (within 1.5 fwhm), strehl 
+           proxy (peak/flux), fwhm (from the area above half maximum), number of saturated pixels, 
+           and centroid residual (pixels between the given location and the windowed centroid)
+    """
+    stamps = np.asarray(stamps, dtype = float)
+    N, ny, nx = stamps.shape
+    x, y = np.broadcast_to(x, (N,)).astype(float), np.broadcast_to(y, (N,)).astype(float)
+    saturated = np.zeros(N) if saturation is None else np.sum(stamps >= saturation, axis = (1,2))
+    border = np.concatenate([stamps[:,0,:], stamps[:,-1,:], stamps[:,1:-1,0], stamps[:,1:-1,-1]], axis = 1)
+    s = stamps - np.median(border, axis = 1)[:,np.newaxis,np.newaxis]
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    r = np.hypot(xx - x[:,np.newaxis,np.newaxis], yy - y[:,np.newaxis,np.newaxis])
+    flux = np.sum(np.where(r <= 1.5*fwhm, s, 0), axis = (1,2))
+    peak = np.max(np.where(r <= fwhm, s, -np.inf), axis = (1,2))
+    halfmax = np.sum((s >= 0.5*peak[:,np.newaxis,np.newaxis]) & (r <= 2*fwhm), axis = (1,2))
+    xc, yc = centroid_stack(stamps, fwhm = fwhm, x0 = x, y0 = y)
+    return np.array([peak, flux, peak/flux, 2*np.sqrt(halfmax/np.pi), saturated, np.hypot(xc - x, yc - y)]).T
+
+def frame_quality(image, x_subpix, y_subpix, fwhm = 10, saturation = None):
+    """Image quality metrics for every star in a frame, see stamp_quality, plus each star's 
+       distance from the nearest image edge.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy
+
+       Parameters:
+       -----------
+       image : 2d array
+           image
+       x_subpix, y_subpix : arr
+           star locations, e.g. from findstars
+       fwhm : flt
+           nominal fwhm of the psf in pixels
+       saturation : flt
+           detector saturation/linearity level.  Default = None, don't check
+           
+       Returns:
+       --------
+       2d arr
+           metrics of shape (nstars, len(_quality_metrics)); nan for stars that weren't found
+    """
+    x_subpix, y_subpix = np.asarray(x_subpix, dtype = float), np.asarray(y_subpix, dtype = float)
+    metrics = np.full((len(x_subpix), len(_quality_metrics)), np.nan)
+    found = np.where(np.isfinite(x_subpix) & np.isfinite(y_subpix))[0]
+    if len(found) == 0:
+        return metrics
+    half = int(np.ceil(2*fwhm))
+    # Pad so stamps of stars near the edge are still full size:
+    padded = np.pad(np.asarray(image, dtype = float), half, mode = 'constant', constant_values = np.nan)
+    xi, yi = np.int_(np.round(x_subpix[found])), np.int_(np.round(y_subpix[found]))
+    stamps = np.array([padded[b:b+2*half+1, a:a+2*half+1] for a, b in zip(xi, yi)])
+    stamps = np.where(np.isnan(stamps), np.nanmedian(stamps), stamps)
+    quality = stamp_quality(stamps, x_subpix[found]-xi+half, y_subpix[found]-yi+half, fwhm = fwhm, 
+                            saturation = saturation)
+    edge = np.min([x_subpix[found], y_subpix[found], image.shape[1]-1-x_subpix[found], 
+                   image.shape[0]-1-y_subpix[found]], axis = 0)
+    metrics[found] = np.insert(quality, 5, edge, axis = 1)
+    return metrics
+
+def make_cleanlist(path, boxsize = 50, min_strehl = 0.7, max_fwhm = 1.25, max_residual = 1.0, 
+                   max_saturated = 0, filename = 'CleanList', verbose = True):
+    """Write CleanList from the star locations and frame quality metrics written by 
+       findstars_in_dataset, keeping frames that pass all thresholds.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy, pandas
+
+       Parameters:
+       -----------
+       path : str
+           dataset directory containing ABLocations.csv and FrameQuality.csv
+       boxsize : int
+           stamp half-width that will be used for stacking (ab_stack_shift); frames with a star 
+           closer than this to the image edge are dropped.  Default = 50
+       min_strehl : flt
+           minimum strehl proxy relative to the dataset median for that star.  Default = 0.7
+       max_fwhm : flt
+           maximum fwhm relative to the dataset median for that star.  Default = 1.25
+       max_residual : flt
+           maximum centroid residual in pixels.  Default = 1
+       max_saturated : int
+           maximum number of saturated pixels per star.  Default = 0
+       filename : str
+           output filename in path.  Default = 'CleanList'
+           
+       Returns:
+       --------
+       pandas DataFrame
+           the clean list, columns filename, xca, yca, xcb, ycb (xc3, yc3... for more stars)
+       pandas DataFrame
+           the quality table with a 'reason' column giving why each rejected frame failed
+    """
+    k = pd.read_csv(path+'ABLocations.csv')
+    q = pd.read_csv(path+'FrameQuality.csv')
+    nstars = len([c for c in k.columns if c.startswith('xc')])
+    reasons = [[status] if status else [] for status in k['status'].fillna('')]
+    for i in range(1, nstars+1):
+        strehl = q['strehl'+str(i)] / np.nanmedian(q['strehl'+str(i)])
+        fwhm = q['fwhm'+str(i)] / np.nanmedian(q['fwhm'+str(i)])
+        checks = [(q['edge_distance'+str(i)] < boxsize, 'edge'), (strehl < min_strehl, 'strehl'),
+                  (fwhm > max_fwhm, 'fwhm'), (q['centroid_residual'+str(i)] > max_residual, 'centroid'),
+                  (q['saturated'+str(i)] > max_saturated, 'saturated')]
+        for fail, name in checks:
+            for j in np.where(fail)[0]:
+                reasons[j].append(name+' '+str(i))
+    q['reason'] = ['; '.join(r) for r in reasons]
+    keep = q['reason'] == ''
+    clean = k.loc[keep, ['filename']+[c for c in k.columns if c[:2] in ['xc','yc']]]
+    clean = clean.rename(columns = {'xc1':'xca', 'yc1':'yca', 'xc2':'xcb', 'yc2':'ycb'}).reset_index(drop = True)
+    clean.to_csv(path+filename, index = False)
+    if verbose:
+        print('make_cleanlist: kept',np.sum(keep),'of',len(k),'frames')
+    return clean, q
+
+def _frame_products(data, x_subpix, y_subpix, fwhm, medfilt, subframes, quality, saturation):
+    ''' Per-subframe positions and quality metrics of a frame whose stars have been found
+    '''
+    sub, qual = None, None
+    if subframes and len(data.shape) == 3:
+        sub = subframe_positions(data, x_subpix, y_subpix, fwhm = fwhm, medfilt = medfilt)
+    if quality:
+        qual = frame_quality(data[0] if len(data.shape) == 3 else data, x_subpix, y_subpix, fwhm = fwhm, 
+                             saturation = saturation)
+    return sub, qual
+
+# Correlator for the reference stamp, built once per worker process:
+_findstars_correlator = None
+
+def _findstars_init(imstamp):
+    ''' Process pool initializer: compute the stamp spectrum once per worker
+    '''
+    global _findstars_correlator
+    _findstars_correlator = FFTCorrelator(imstamp)
+
+def _findstars_one_frame(im, nstars, boxsize, threshold, radius, fwhm, medfilt = 'full', subframes = False,
+                         quality = False, saturation = None):
+    ''' Find stars in one frame (filename or image), returning positions, a failure reason ('' on 
+        success), per-subframe positions for cubes if subframes is True and quality metrics if 
+        quality is True (otherwise None)
+    '''
+    import warnings
+    # Supress warnings when failing to find point sources, for this frame only:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            data = fits.getdata(im) if isinstance(im, str) else np.asarray(im)
+            x_subpix, y_subpix = findstars(_findstars_correlator.imstamp, data[0] if len(data.shape) == 3 else data, 
+                                           nstars, boxsize = boxsize, threshold = threshold, radius = radius, 
+                                           fwhm = fwhm, correlator = _findstars_correlator, medfilt = medfilt)
+        except Exception as e:
+            return np.full(nstars, np.nan), np.full(nstars, np.nan), type(e).__name__+': '+str(e), None, None
+        failed = [str(i+1) for i in range(nstars) if np.isnan(x_subpix[i]) or np.isnan(y_subpix[i])]
+        reason = 'star '+','.join(failed)+' not found' if failed else ''
+        sub, qual = _frame_products(data, x_subpix, y_subpix, fwhm, medfilt, subframes, quality, saturation)
+    return x_subpix, y_subpix, reason, sub, qual
+
+def track_stars(image, x_prev, y_prev, trackbox = 20, threshold = 1e4, fwhm = 10, medfilt = 'window'):
+    """Find the subpixel location of stars from their location in a previous frame, searching only
+       a small window around each.  Only the window is median filtered, so the cost per star is 
+       set by the window size rather than the image size.
+       Written by Logan A. Pearce, 2020
+       Dependencies: numpy, scipy, photutils
+
+       Parameters:
+       -----------
+       image : 2d array
+           science image
+       x_prev, y_prev : arr
+           subpixel locations of the stars in the previous frame
+       trackbox : int
+           half-width of the search window around each previous location
+       threshold : int
+           minimum source peak value (not the DAOStarFinder threshold, see StarDetector)
+       fwhm : int
+           fwhm keyword for DAO StarFinder
+       medfilt : str
+           how to smooth each window, see smooth_image; 'full' and 'window' both median filter the 
+           window.  Default = 'window'
+           
+       Returns:
+       --------
+       x_subpix, y_subpix : arr,flt
+           subpixel x and y locations of stars, nan where a star was not found
+    """
+    x_subpix, y_subpix = np.full(len(x_prev), np.nan), np.full(len(x_prev), np.nan)
+    for i, (x, y) in enumerate(zip(x_prev, y_prev)):
+        # daostarfinder needs integer pixel locations:
+        x, y = np.int_(np.round(x)), np.int_(np.round(y))
+        # Cut out the window with a margin for the median filter edge:
+        stamp, xmin, xmax, ymin, ymax = make_imagestamp(image, x, y, boxsizex = trackbox+2, boxsizey = trackbox+2)
+        stamp = smooth_image(stamp, 'full' if medfilt == 'window' else medfilt)
+        xs, ys = daostarfinder(stamp, x-xmin, y-ymin, boxsize = trackbox, threshold = threshold, 
+                               fwhm = fwhm, verbose = False)
+        x_subpix[i], y_subpix[i] = xmin+xs, ymin+ys
+    return x_subpix, y_subpix
+
+def _findstars_track_frame(im, last, nstars, boxsize, threshold, radius, fwhm, medfilt, subframes, quality, 
+                           saturation, trackbox, maxshift):
+    ''' Star positions in one frame, seeded from last[BEAM] (updated in place) if there is one
+    '''
+    try:
+        data, imhdr = fits.getdata(im, header = True)
+    except Exception as e:
+        return np.full(nstars, np.nan), np.full(nstars, np.nan), type(e).__name__+': '+str(e), None, None
+    image = data[0] if len(data.shape) == 3 else data
+    beam = imhdr.get('BEAM', None)
+    locked = False
+    if beam in last:
+        x_subpix, y_subpix = track_stars(image, last[beam][0], last[beam][1], trackbox = trackbox, 
+                                         threshold = threshold, fwhm = fwhm, medfilt = medfilt)
+        shift = np.hypot(x_subpix - last[beam][0], y_subpix - last[beam][1])
+        # Lock is lost if a star wasn't found or jumped further than a nod jitter:
+        locked = not (np.any(np.isnan(shift)) or np.any(shift > maxshift))
+        reason = ''
+    if not locked:
+        x_subpix, y_subpix, reason, sub, qual = _findstars_one_frame(image, nstars, boxsize, threshold, radius, 
+                                                                     fwhm, medfilt)
+    if not reason:
+        last[beam] = (x_subpix, y_subpix)
+    sub, qual = _frame_products(data, x_subpix, y_subpix, fwhm, medfilt, subframes, quality, saturation)
+    return x_subpix, y_subpix, reason, sub, qual
+
+def _findstars_tracked(ims, nstars, boxsize, threshold, radius, fwhm, medfilt, subframes, quality, saturation, 
+                       trackbox, maxshift):
+    ''' Star positions for each frame in order, seeded from the previous frame with the same BEAM 
+        and falling back to the full-frame search on loss of lock
+    '''
+    import warnings
+    # Last positions found in each nod:
+    last = {}
+    for im in ims:
+        # Supress warnings when failing to find point sources, only while finding (not across the yield):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            result = _findstars_track_frame(im, last, nstars, boxsize, threshold, radius, fwhm, medfilt, subframes, 
+                                            quality, saturation, trackbox, maxshift)
+        yield result
+
 def findstars_in_dataset(dataset_path, nstars, xca, yca, corrboxsizex = 40, corrboxsizey = 40, boxsize = 100, skip_list = False, \
-                         append_file = False, threshold = 1e4, radius = 20, fwhm = 10, filesuffix = '_skysub'):
-    """Find the subpixel location of stars A and B in a clio BDI dataset.
+                         append_file = False, threshold = 1e4, radius = 20, fwhm = 10, filesuffix = '_skysub', 
+                         ncores = 1, verbose = True, track = False, trackbox = 20, maxshift = 10, medfilt = 'full',
+                         subframes = True, quality = True, saturation = None, cleanlist = True, cleanlist_kwargs = {}):
+    """Find the subpixel location of stars A and B in a clio BDI dataset.  Frames are distributed
+       across a process pool and results are streamed, in input order, through a single writer.
        Written by Logan A. Pearce, 2020
        Dependencies: numpy, astropy, scipy, photutils
 
@@ -623,75 +1244,159 @@ def findstars_in_dataset(dataset_path, nstars, xca, yca, corrboxsizex = 40, corr
        boxsize : int
            size of box to draw around star psfs for DAOStarFinder
        skip_list : bool
-           By default script will make a list of all "skysub" images in given directory.
+           By default script will find all "skysub" images in given directory.
            Set to True if a list of paths to science files has already been made.  List
            must be named "list".  
         append_file : bool
             Set to True to append to an existing locations file, False to make a new file or 
             overwrite an old one.  Default = False.
         threshold : flt
-            threshold for finding stars using DAOStarFinder
+            minimum source peak value for finding stars (not the DAOStarFinder threshold, see StarDetector)
+        ncores : int
+            number of processes to distribute frames across.  Default = 1
+        verbose : bool
+            display a progress bar.  Default = True
+        track : bool
+            if True, seed each frame from the star locations in the previous frame with the same 
+            BEAM and search only a trackbox window around them, falling back to the full-frame search
+            for the first frame of each nod and on loss of lock.  Frames are processed in order in 
+            this process.  Default = False
+        trackbox : int
+            half-width of the tracking search window.  Default = 20
+        maxshift : flt
+            a star moving more than this many pixels from the previous frame counts as loss of lock.
+            Default = 10
+        medfilt : str
+            how to smooth each frame, see smooth_image: 'full', 'window', 'separable', 'badpix' or 
+            'none'.  Default = 'full'
+        subframes : bool
+            for cube files, also locate the stars in every subframe (centroid_stack over the stack of
+            stamps around the first-subframe location) and write them to 'ABLocations_subframes.csv',
+            which ab_stack_shift can use instead of its own per-subframe search.  Default = True
+        quality : bool
+            compute frame quality metrics for each star (see frame_quality) and write them to 
+            'FrameQuality.csv'.  Default = True
+        saturation : flt
+            detector saturation level for the quality metrics.  Default = None, don't check
+        cleanlist : bool
+            if quality is True, write 'CleanList' of frames passing the quality thresholds with 
+            make_cleanlist.  Default = True
+        cleanlist_kwargs : dict
+            thresholds to pass to make_cleanlist
 
        Returns:
        --------
-       writes subpixel location of stars to file called 'StarLocations' in order:
-           image_filename   x   y   x   y   ...ect. for all requested stars.
+       pandas DataFrame
+           filename, xc1, yc1, ... for all requested stars, and status: '' for success or the reason 
+           the frame failed.
+       writes subpixel location of stars to file called 'ABLocations' in order:
+           image_filename   x   y   x   y   ...ect. for all requested stars,
+       with failed frames commented out; the same table with failure reasons to 'ABLocations.csv';
+       and the positions as an (nframes, nstars, 2) array to 'ABLocations.npy'.  For cube datasets,
+       per-subframe positions (filename, subframe, xc1, yc1, ...) go to 'ABLocations_subframes.csv'.
+       If quality is True, frame quality metrics (filename, peak1, peak2, ... centroid_residual1, ...)
+       go to 'FrameQuality.csv' and, if cleanlist is True, frames passing make_cleanlist to 'CleanList'.
     """
+    from cliotools.catalog import dataset_files, read_list
     from scipy import ndimage
-    from cliotools.pcaskysub import update_progress
-    # Supress warnings when failing to find point sources
-    import warnings
-    warnings.filterwarnings("ignore")
-    # Make a file to store results:
+    # Files to store results:
     newfile = dataset_path.split('/')[0]+'/ABLocations'
-    
-    if append_file == False:
-        string = '#     '
-        for i in range(nstars):
-            string += 'xc'+str(i+1) + '     ' + 'yc'+str(i+1)  + '     ' 
-        string += "\n"
-        k = open(newfile, 'w')
-        k.write(string)
-        k.close()
+    csvfile, sidecar, subfile = newfile+'.csv', newfile+'.npy', newfile+'_subframes.csv'
+    columns = []
+    for i in range(nstars):
+        columns += ['xc'+str(i+1), 'yc'+str(i+1)]
     
     # Make a list of all images in dataset:
     if skip_list == False:
-        os.system('ls '+dataset_path+'0*'+filesuffix+'.fit > list')
-    with open('list') as f:
-        ims = f.read().splitlines()
+        ims = dataset_files(dataset_path, '0*'+filesuffix+'.fit')
+    else:
+        ims = read_list('list')
     # Open initial image in dataset:
     image = fits.getdata(ims[0])
     if len(image.shape) == 3:
         image = image[0]
-    # Apply median filter to smooth bad pixels:
-    image = ndimage.median_filter(image, 3)
+    # Apply median filter to smooth bad pixels, the same way frames will be smoothed for correlation:
+    image = smooth_image(image, medfilt)
     # Create referance stamp from initial image of A:
     imstamp = np.copy(image[np.int_(yca-corrboxsizey):np.int_(yca+corrboxsizey),np.int_(xca-corrboxsizex):np.int_(xca+corrboxsizex)])
     
-    count = 0
-    for im in ims:
-        # For each image in the dataset, find subpixel location of stars:
-        x_subpix, y_subpix = findstars(imstamp, im, nstars, \
-                                                           boxsize = boxsize, threshold = threshold, \
-                                                           radius = radius, fwhm = fwhm)
-        if any(np.isnan(x_subpix)) or any(np.isnan(y_subpix)):
-            # If any of the stars were failed to find, mark this entry with a comment:
-            string = '# '+ im + ' '
+    args = (nstars, boxsize, threshold, radius, fwhm, medfilt, subframes, quality, saturation)
+    positions = np.full((len(ims), nstars, 2), np.nan)
+    metrics = np.full((len(ims), nstars, len(_quality_metrics)), np.nan)
+    status = []
+    subtables = []
+    # Single buffered writer for the whole run:
+    with open(newfile, 'a' if append_file else 'w') as k:
+        if append_file == False:
+            k.write('#     '+''.join([c+'     ' for c in columns])+"\n")
+        if track:
+            executor = None
+            _findstars_init(imstamp)
+            results = _findstars_tracked(ims, *args, trackbox, maxshift)
+        elif ncores > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers = ncores, initializer = _findstars_init, initargs = (imstamp,))
+            # map yields in input order as frames finish:
+            results = executor.map(_findstars_one_frame, ims, *[[a]*len(ims) for a in args], 
+                                   chunksize = int(np.max([1, len(ims) // (4*ncores)])))
         else:
-            string = im + ' '
-        for i in range(nstars):
-            string += str(x_subpix[i]) + '     ' + str(y_subpix[i])  + '     ' 
-        string += "\n"
-
-        k = open(newfile, 'a')
-        k.write(string)
-        k.close()
-        
-        count+=1
-        update_progress(count,len(ims))
-    print('Done')
-    os.system('rm list')
-    os.system("say 'done'")
+            executor = None
+            _findstars_init(imstamp)
+            results = (_findstars_one_frame(im, *args) for im in ims)
+        try:
+            for count, (im, (x_subpix, y_subpix, reason, sub, qual)) in enumerate(zip(ims, results)):
+                positions[count,:,0], positions[count,:,1] = x_subpix, y_subpix
+                status.append(reason)
+                if qual is not None:
+                    metrics[count] = qual
+                if sub is not None:
+                    subtable = pd.DataFrame(sub.reshape(sub.shape[0], 2*nstars), columns = columns)
+                    subtable.insert(0, 'subframe', np.arange(sub.shape[0]))
+                    subtable.insert(0, 'filename', im)
+                    subtables.append(subtable)
+                # If any of the stars were failed to find, mark this entry with a comment:
+                string = '# '+ im + ' ' if reason else im + ' '
+                for i in range(nstars):
+                    string += str(x_subpix[i]) + '     ' + str(y_subpix[i])  + '     ' 
+                k.write(string + "\n")
+                if verbose:
+                    update_progress(count+1,len(ims))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    
+    table = pd.DataFrame(positions.reshape(len(ims), 2*nstars), columns = columns)
+    table.insert(0, 'filename', ims)
+    table['status'] = status
+    if append_file and os.path.exists(csvfile):
+        table.to_csv(csvfile, mode = 'a', header = False, index = False)
+    else:
+        table.to_csv(csvfile, index = False)
+    if append_file and os.path.exists(sidecar):
+        positions = np.concatenate([np.load(sidecar), positions])
+    np.save(sidecar, positions)
+    if append_file == False and os.path.exists(subfile):
+        os.remove(subfile)
+    if len(subtables) != 0:
+        subtables = pd.concat(subtables, ignore_index = True)
+        if append_file and os.path.exists(subfile):
+            subtables.to_csv(subfile, mode = 'a', header = False, index = False)
+        else:
+            subtables.to_csv(subfile, index = False)
+    if quality:
+        qualityfile = dataset_path.split('/')[0]+'/FrameQuality.csv'
+        qtable = pd.DataFrame(metrics.transpose(0,2,1).reshape(len(ims), -1), 
+                              columns = [m+str(i+1) for m in _quality_metrics for i in range(nstars)])
+        qtable.insert(0, 'filename', ims)
+        if append_file and os.path.exists(qualityfile):
+            qtable.to_csv(qualityfile, mode = 'a', header = False, index = False)
+        else:
+            qtable.to_csv(qualityfile, index = False)
+        if cleanlist:
+            make_cleanlist(dataset_path.split('/')[0]+'/', verbose = verbose, **cleanlist_kwargs)
+    if verbose:
+        print('Done')
+    return table
 
 ################################ prepare images for KLIP ##################################################
 
@@ -763,7 +1468,7 @@ def rotate_clio(image, imhdr, center = None, interp = 'bicubic', bordermode = 'c
     return imrot
     
 
-def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True):
+def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True, subframes = None, ncores = 1):
     """Prepare cubes for BDI by stacking and subpixel aligning image 
        postage stamps of star A and star B.
        Written by Logan A. Pearce, 2020
@@ -780,16 +1485,22 @@ def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True):
        path_prefix : int
            string to put in front of filenames in input file in case the relative
            location of files has changed
+       subframes : Pandas array or str
+           per-subframe star locations for cube datasets, from findstars_in_dataset, or the path to 
+           'ABLocations_subframes.csv'.  If supplied, those positions are used to align each subframe 
+           instead of running DAOStarFinder on it.  Default = None
+       ncores : int
+           number of threads for finding the star in each subframe of a cube.  Default = 1
            
        Returns:
        --------
        astamp, bstamp : 3d arr 
            stack of aligned psf's of star A and B for BDI.
     """
-    from cliotools.bditools import daostarfinder
     from scipy import ndimage
     import warnings
     warnings.filterwarnings('ignore')
+    detector = StarDetector(fwhm = fwhm, ncores = ncores)
     # define center:
     center = (0.5*((2*boxsize)-1),0.5*((2*boxsize)-1))
     # open first image to get some info:
@@ -823,8 +1534,8 @@ def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True):
                 astamp[count,:,:] = a.copy()
                 bstamp[count,:,:] = b.copy()
                 # Use DAOStarFinder to find the subpixel location of each star within the image stamp:
-                xa,ya = daostarfinder(a, boxsize, boxsize, boxsize = boxsize, fwhm = fwhm)
-                xb,yb = daostarfinder(b, boxsize, boxsize, boxsize = boxsize, fwhm = fwhm)
+                xa,ya = detector.Locate(a, boxsize, boxsize, boxsize = boxsize)
+                xb,yb = detector.Locate(b, boxsize, boxsize, boxsize = boxsize)
                 # If StarFinder failed to find a star, just skip it:
                 if np.isnan(xa):
                     print(k['filename'][i],'Failed')
@@ -859,6 +1570,10 @@ def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True):
 
     # For image cubes:         
     if len(image.shape) == 3:
+        if isinstance(subframes, str):
+            subframes = read_subframe_locations(subframes)
+        if subframes is not None:
+            subframes = {f:g.sort_values('subframe') for f, g in subframes.groupby('filename')}
         coadd_count = 0
         count = 0
         for i in range(len(k)):
@@ -870,10 +1585,17 @@ def ab_stack_shift(k, boxsize = 50, fwhm = 7.8, path_prefix='', verbose = True):
                                                                    np.int_(k['xcb'][i]-boxsize):np.int_(k['xcb'][i]+boxsize)]
                 bstamp[coadd_count:coadd_count+b.shape[0],:,:] = b
                    
+                # Subframe positions from star finding, in stamp coordinates:
+                sub = subframes.get(k['filename'][i]) if subframes is not None else None
+                if sub is not None:
+                    xas, yas = sub['xca'].values-np.int_(k['xca'][i]-boxsize), sub['yca'].values-np.int_(k['yca'][i]-boxsize)
+                    xbs, ybs = sub['xcb'].values-np.int_(k['xcb'][i]-boxsize), sub['ycb'].values-np.int_(k['ycb'][i]-boxsize)
+                else:
+                    xas, yas = detector.find_in_cube(a, boxsize, boxsize, boxsize = boxsize)
+                    xbs, ybs = detector.find_in_cube(b, boxsize, boxsize, boxsize = boxsize)
                 for j in range(0,a.shape[0]):
                     count = count+1
-                    xa,ya = daostarfinder(a[j], boxsize, boxsize, boxsize = boxsize, fwhm = fwhm)
-                    xb,yb = daostarfinder(b[j], boxsize, boxsize, boxsize = boxsize, fwhm = fwhm)
+                    xa,ya,xb,yb = xas[j],yas[j],xbs[j],ybs[j]
                     if np.isnan(xa):
                         print(k['filename'][i],'Failed')
                         pass
@@ -913,7 +1635,9 @@ def PrepareCubes(k, boxsize = 20, path_prefix='', verbose = True,\
                    # User supplied cubes:
                    acube = None, bcube = None,
                    # DAOStarfinder parameters:
-                   fwhm = 7.8
+                   fwhm = 7.8,
+                   # Per-subframe star locations for cube datasets:
+                   subframes = None
                 ):
     '''Assemble cubes of images and prepare them for KLIP reduction by: centering/subpixel-aligning images along
     vertical axis, normalizing images by dividing by sum of pixels in image, and masking the core of the central star.
@@ -958,6 +1682,9 @@ def PrepareCubes(k, boxsize = 20, path_prefix='', verbose = True,\
         User can supply already stacked and aligned image cubes and skip the alignment step.
     fwhm : flt
         FWHM for Starfinder centering
+    subframes : Pandas array or str
+        per-subframe star locations for cube datasets, from findstars_in_dataset, or the path to 
+        'ABLocations_subframes.csv'.  Passed to ab_stack_shift to align each subframe.  Default = None
         
     Returns:
     --------
@@ -967,7 +1694,8 @@ def PrepareCubes(k, boxsize = 20, path_prefix='', verbose = True,\
     if np.size(acube) == 1:
         # collect and align postage stamps of each star:
         from cliotools.bditools import ab_stack_shift
-        astack, bstack = ab_stack_shift(k, boxsize = boxsize,  fwhm = fwhm, path_prefix=path_prefix, verbose = verbose)
+        astack, bstack = ab_stack_shift(k, boxsize = boxsize,  fwhm = fwhm, path_prefix=path_prefix, verbose = verbose,
+                                        subframes = subframes)
     else:
         # copy user-supplied cubes:
         astack, bstack = acube.copy(),bcube.copy()
@@ -1519,12 +2247,73 @@ def SubtractCubes(acube, bcube, K_klip, k,\
 #  Functions for injecting synthetic planet signals                      #
 
 
+def resample_snrs(sep, snrs, resep):
+    ''' Linearly interpolate a grid of SNRs (or a stack of grids) from the tested separations
+        onto a new set of separations, for all contrast rows at once.
+
+    Parameters:
+    -----------
+    sep : 1d arr
+        separations tested in the contrast curve calculation, in increasing order
+    snrs : 2d or 3d arr
+        SNRs with contrasts along rows and separations along columns, shape (..., len(C), len(sep))
+    resep : 1d arr
+        new separations within the range of sep
+
+    Returns:
+    --------
+    arr
+        SNRs resampled onto resep, shape (..., len(C), len(resep))
+    '''
+    sep, snrs, resep = np.asarray(sep, dtype = float), np.asarray(snrs, dtype = float), np.asarray(resep, dtype = float)
+    if np.min(resep) < np.min(sep) or np.max(resep) > np.max(sep):
+        raise ValueError('resampled separations must lie within the range of tested separations')
+    # index of the tested separation just below each new separation:
+    ind = np.clip(np.searchsorted(sep, resep, side = 'right') - 1, 0, len(sep)-2)
+    weight = (resep - sep[ind]) / (sep[ind+1] - sep[ind])
+    return snrs[...,ind]*(1-weight) + snrs[...,ind+1]*weight
+
+def sigma_contrast_limit(snrs, C, sigma = 5.0):
+    ''' Find the contrast at which the SNR drops below a threshold for every separation 
+        (and every grid in a stack of grids) at once.  For each column, finds the first 
+        contrast with SNR below sigma and linearly interpolates between it and the contrast 
+        just before it.
+
+    Parameters:
+    -----------
+    snrs : 2d or 3d arr
+        SNRs with contrasts along rows and separations along columns, shape (..., len(C), Nsep)
+    C : 1d arr
+        contrasts corresponding to the rows of snrs, in increasing order
+    sigma : flt
+        SNR threshold.  Default = 5
+
+    Returns:
+    --------
+    arr
+        contrast limit at each separation, shape (..., Nsep).  nan where the SNR never crosses 
+        the threshold within the tested contrasts.
+    '''
+    snrs, C = np.asarray(snrs, dtype = float), np.asarray(C, dtype = float)
+    below = snrs < sigma
+    # index of the first contrast below threshold in each column:
+    first = np.argmax(below, axis = -2)
+    crossed = np.any(below, axis = -2) & (first > 0)
+    first = np.clip(first, 1, None)
+    sigmalower = np.take_along_axis(snrs, first[...,np.newaxis,:], axis = -2)[...,0,:]
+    sigmaupper = np.take_along_axis(snrs, (first-1)[...,np.newaxis,:], axis = -2)[...,0,:]
+    Cbelowlimit, Cabovelimit = C[first], C[first-1]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        limit = Cbelowlimit + (sigma - sigmalower) * (Cabovelimit - Cbelowlimit) / (sigmaupper - sigmalower)
+    limit[~crossed] = np.nan
+    return limit
+
 def contrast_curve(path, Star, sep = np.arange(1,7,1), C = np.arange(3,7,0.2), curves_file = [],
                    cmap = 'viridis', Ncontours_cmap=100, Ncontours_label = 5, 
                    fontsize=15, plotstyle = 'magrathea'):
     
     """After running DoSNR for a range of seps and contrasts, generate a map of SNR
-        with contours at some intervals for contrast curves.  Uses scipy interpolate to
+        with contours at some intervals for contrast curves.  Uses resample_snrs to
         expand sep/C to a square matrix and fill in intervals in what was tested.
 
     Parameters
@@ -1550,18 +2339,12 @@ def contrast_curve(path, Star, sep = np.arange(1,7,1), C = np.arange(3,7,0.2), c
         snr plot
         
     """
-    from scipy import interpolate
     if not len(curves_file):
         snrs = pickle.load( open( path+"snrs"+Star+".pkl", "rb" ) )
     else:
         snrs = pickle.load( open( path+curves_file, "rb" ) )
     resep = np.linspace(np.min(sep),np.max(sep),len(C))
-    m = np.max([len(sep),len(C)])
-    newSNRs = np.zeros((m,m))
-    for i in range(m):
-        f = interpolate.interp1d(sep, snrs[i])
-        newSNR = f(resep)
-        newSNRs[i] = newSNR
+    newSNRs = resample_snrs(sep, snrs, resep)
 
     try:
         plt.style.use(plotstyle)
@@ -1581,21 +2364,12 @@ def contrast_curve(path, Star, sep = np.arange(1,7,1), C = np.arange(3,7,0.2), c
     plt.title(path.split('/')[0]+' '+Star)
     return fig
 
-def deconvolve_app_mag(magT,k):
-    from cliotools.bditools import mag
-    # compute average deltamag in images:
-    deltamagarray = np.array([])
-    for i in range(len(k)):
-        image = fits.getdata(k['filename'][i])
-        if len(image.shape) == 3:
-            image = image[0]
-        else:
-            pass
-        magA, fluxA = mag(image,k['xca'][i],k['yca'][i], returnflux = True)
-        magB, fluxB = mag(image,k['xcb'][i],k['ycb'][i], returnflux = True)
-        deltamag = magA-magB
-        deltamagarray = np.append(deltamagarray,deltamag)
-    deltamag = np.median(deltamagarray)
+def deconvolve_app_mag(magT,k,path = None, phot = None):
+    # compute average deltamag in images, from the dataset photometry table (kept in memory
+    # unless a dataset path is given):
+    if phot is None:
+        phot = PhotometryTable(k, path or None)
+    deltamag = np.median(-phot.ABContrast())
     # Compute magA:
     exp1 = -(deltamag + magT) / 2.5
     num = 10**exp1
@@ -1642,7 +2416,7 @@ def GetSNR(path, Star, K_klip, sep, pa, C, boxsize = 50,
                 returnsnrs = False, writeklip = False, update_prog = False, 
                 sciencecube = [],
                 refcube = [],
-                templatecube = [], 
+                templatecube = [], TC = None,
                 mask_core = True, mask_outer_annulus = True, mask_radius = 5., outer_mask_radius = 50., subtract_radial_profile = True,
                 normalize = True, normalizebymask = False, normalizing_radius = [],
                 wavelength = 3.9):
@@ -1684,6 +2458,9 @@ def GetSNR(path, Star, K_klip, sep, pa, C, boxsize = 50,
         optional user-provided cube of reference psfs.
     templatecube : 3d arr
         optional user-provded cube of images to use as injected signal psf template.
+    TC : flt or arr
+        optional contrast of the template relative to the science star, one value or one per image.  If not \
+        provided it is measured from the cubes with template_contrasts.
     mask_core : bool
         if True, set all pixels within mask_radius to value of 0 in all images.  Default = True
     mask_radius : flt
@@ -1711,7 +2488,8 @@ def GetSNR(path, Star, K_klip, sep, pa, C, boxsize = 50,
     SynthCubeObject2 = SyntheticSignal(k, Star, sep, pa, C, verbose = False, 
                                   sciencecube = sciencecube,
                                   refcube = refcube,
-                                  templatecube = templatecube
+                                  templatecube = templatecube,
+                                  TC = TC
                                  )
 
     if Star == 'A':
@@ -1765,7 +2543,7 @@ def DoSNR(path, Star, K_klip, sep, C,
                 returnsnrs = False, writeklip = False, update_prog = False, 
                 sciencecube = [],
                 refcube = [],
-                templatecube = [], 
+                templatecube = [], TC = None,
                 mask_core = True, mask_outer_annulus = True, mask_radius = 5., outer_mask_radius = 50.,
                 normalize = True, normalizebymask = False, normalizing_radius = [],
                 subtract_radial_profile = True, wavelength = 3.9
@@ -1809,6 +2587,9 @@ def DoSNR(path, Star, K_klip, sep, C,
         optional user-provided cube of reference psfs.
     templatecube : 3d arr
         optional user-provded cube of images to use as injected signal psf template.
+    TC : flt or arr
+        optional contrast of the template relative to the science star, one value or one per image.  If not \
+        provided it is measured from the cubes with template_contrasts.
     mask_core : bool
         if True, set all pixels within mask_radius to value of 0 in all images.  Default = True
     mask_radius : flt
@@ -1848,6 +2629,10 @@ def DoSNR(path, Star, K_klip, sep, C,
     snrs = np.zeros(len(pas))
     # create synth cube with injected signal:
     boxsize = sciencecube.shape[1] * 0.5
+    # The template contrast doesn't depend on pa, so measure it once for every image
+    # rather than once per aperture:
+    if TC is None and np.size(templatecube) > 1:
+        TC = template_contrasts(sciencecube, templatecube)
     for i in range(len(pas)):
         if i == 0 and writeklip:
             do_writeklip = True
@@ -1859,7 +2644,7 @@ def DoSNR(path, Star, K_klip, sep, C,
                 returnsnrs = returnsnrs, writeklip = do_writeklip, update_prog = False, 
                 sciencecube = sciencecube,
                 refcube = refcube,
-                templatecube = templatecube, 
+                templatecube = templatecube, TC = TC,
                 mask_core = mask_core, mask_outer_annulus = mask_outer_annulus, 
                 mask_radius = mask_radius, outer_mask_radius = outer_mask_radius,
                 normalize = normalize, normalizebymask = normalizebymask, normalizing_radius = normalizing_radius,
@@ -1902,7 +2687,6 @@ def getsnr(image, sep, pa, xc, yc, wavelength = 3.9, radius = 0.5, radius_format
             
     '''
     from cliotools.bditools import lod_to_pixels
-    from photutils import CircularAperture, aperture_photometry
     radius = lod_to_pixels(radius, wavelength)
     lod = lod_to_pixels(1., wavelength)
     # convert sep in L/D to pixels:
@@ -1914,31 +2698,14 @@ def getsnr(image, sep, pa, xc, yc, wavelength = 3.9, radius = 0.5, radius_format
     # Create array around circumference, excluding the ones immediately before and after
     # where the planet is:
     pas = np.arange(pa+2*dTheta,pa+360-dTheta,dTheta)%360
-    # create emptry container to store results:
-    noisesums = np.zeros(len(pas))
-    # for each noise aperture:
-    for i in range(len(pas)):
-        # lay down a photometric aperture at that point:
-        xx = seppix*np.sin(np.radians((pas[i])))
-        yy = seppix*np.cos(np.radians((pas[i])))
-        xp,yp = xc-xx,yc+yy
-        aperture = CircularAperture([xp,yp], r=radius)
-        # sum pixels in aperture:
-        phot = aperture_photometry(image, aperture)
-        # add to noise container:
-        noisesums[i] = phot['aperture_sum'][0]
+    # Lay down photometric apertures at each of those points and at the planet location (last),
+    # and sum pixels in all of them at once:
+    angles = np.radians(np.append(pas, pa))
+    sums = aperture_sums(image, xc - seppix*np.sin(angles), yc + seppix*np.cos(angles), radius = radius)
+    noisesums, signal = sums[:-1], sums[-1]
     # the noise value is the std dev of pixel sums in each
     # noise aperture:
     noise = np.std(noisesums)
-    # Compute signal of injected planet in signal aperture:
-    xx = seppix*np.sin(np.radians((pa)))
-    yy = seppix*np.cos(np.radians((pa)))
-    xp,yp = xc-xx,yc+yy
-    # Lay down aperture at planet location:
-    aperture = CircularAperture([xp,yp], r=radius)
-    # compute pixel sum in that location:
-    phot = aperture_photometry(image, aperture)
-    signal = phot['aperture_sum'][0]
     signal_without_bkgd = signal.copy()
     # compute mean background:
     bkgd = np.mean(noisesums)
@@ -1950,7 +2717,130 @@ def getsnr(image, sep, pa, xc, yc, wavelength = 3.9, radius = 0.5, radius_format
     return snr
 
 
-def mag(image, x, y, radius = 3.89245, returnflux = False, returntable = False):
+def snrmap(image, xc = None, yc = None, wavelength = 3.9, radius = 0.5, radius_format = 'lambda/D', 
+           return_signal_noise = False):
+    ''' Compute the SNR at every pixel of a KLIP reduced image (or stack of images) in one pass, 
+        following getsnr.  The aperture sum centered on every pixel is computed at once by FFT 
+        convolution of the image with the aperture kernel, and the noise at each pixel is the std 
+        deviation of the aperture sums centered on every pixel of the ring at the same separation 
+        (excluding the signal aperture and its neighbors), with the Mawet 2014 small sample 
+        correction (Eqn 9) for the number of independent apertures that fit in that ring.  These
+        apertures overlap, so the noise is not the independent-aperture estimate of getsnr and 
+        the two SNRs agree only approximately.  The map is nan within 2 aperture radii of the
+        star, where there are too few apertures in a ring for a noise estimate.
+
+    Parameters:
+    -----------
+    image : 2d or 3d arr
+        KLIP reduced image, or stack of reduced images (ex: BDI.A_Reduced for several K_klip values)
+    xc, yc : flt or int
+        (x,y) pixel location of center of star.  If None, use the center of the image.
+    wavelength : flt
+        central wavelength in microns of image filter. Used for converting 
+        from L/D units to pixels.  Default = 3.9
+    radius : flt
+        radius of the photometric aperture.  Default = 0.5 lambda/D
+    radius_format : str
+        units of radius, either 'lambda/D' or 'pixels'.  Default = 'lambda/D'
+    return_signal_noise : bool
+        if True, return SNR map, aperture sum map, noise map, background map
+    
+    Returns:
+    --------
+    2d or 3d arr
+        SNR at each pixel, same shape as image.  Pixels with no noise estimate (within 2 
+        aperture radii of the star, or masked regions) are nan.
+    '''
+    from scipy.signal import fftconvolve
+    from cliotools.bditools import lod_to_pixels
+    image = np.array(image, dtype = float)
+    single_image = (image.ndim == 2)
+    if single_image:
+        image = image[np.newaxis]
+    Nimages, ny, nx = image.shape
+    if xc is None or yc is None:
+        xc, yc = 0.5*(nx-1), 0.5*(ny-1)
+    if radius_format == 'lambda/D':
+        radius = lod_to_pixels(radius, wavelength)
+    elif radius_format == 'pixels':
+        pass
+    else:
+        raise ValueError('please specify radius_format = lambda/D or pixels')
+    # NaNs would spread through the whole image in the FFT, so zero them and
+    # blank them again at the end:
+    nans = np.isnan(image)
+    image[nans] = 0.
+    # Sum of pixels in an aperture centered on every pixel:
+    r = np.int_(np.ceil(radius))
+    kx, ky = np.meshgrid(np.arange(-r,r+1), np.arange(-r,r+1))
+    kernel = (np.hypot(kx,ky) <= radius).astype(float)
+    apsums = fftconvolve(image, kernel[np.newaxis], mode = 'same', axes = (1,2))
+    # Separation and position angle of each pixel, binned into 1 pixel wide rings:
+    xx,yy = np.meshgrid(np.arange(nx)-xc, np.arange(ny)-yc)
+    sep = np.hypot(xx,yy).ravel()
+    theta = (np.arctan2(yy,xx).ravel()) % (2*np.pi)
+    ring = np.int_(np.round(sep))
+    # Sort pixels by ring, then by angle within each ring.  Ring statistics at each pixel exclude
+    # the pixels within +/- 1.5 aperture diameters along the ring, as getsnr excludes the signal 
+    # aperture and its neighbors.  These are computed for every pixel at once from cumulative
+    # sums along the sorted rings:
+    order = np.lexsort((theta, ring))
+    ring_s, theta_s = ring[order], theta[order]
+    key = ring_s*8. + theta_s
+    ring_start = np.searchsorted(key, ring_s*8., side = 'left')
+    with np.errstate(divide = 'ignore'):
+        halfwidth = np.clip(1.5*2*radius / ring_s, 0, np.pi)
+    def position(a):
+        # index into the sorted ring of angle a, with angles outside [0,2pi) 
+        # wrapping around by one full ring:
+        wrap = np.floor(a / (2*np.pi))
+        return np.searchsorted(key, ring_s*8. + (a - wrap*2*np.pi), side = 'left'), wrap
+    lo, lowrap = position(theta_s - halfwidth)
+    hi, hiwrap = position(theta_s + halfwidth)
+    ring_end = np.searchsorted(key, ring_s*8. + 2*np.pi, side = 'left')
+    valid = (~nans).reshape(Nimages,-1)[:,order].astype(float)
+    values = apsums.reshape(Nimages,-1)[:,order]
+    def ring_sums(v):
+        # sum of v over each pixel's ring, and over the ring outside its excluded window:
+        P = np.concatenate([np.zeros((Nimages,1)), np.cumsum(v, axis = 1)], axis = 1)
+        total = P[:,ring_end] - P[:,ring_start]
+        window = (P[:,hi] + hiwrap*total) - (P[:,lo] + lowrap*total)
+        return total, total - window
+    # Subtract the mean of each ring before summing squares, so the variance isn't the 
+    # difference of two large numbers:
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        ring_counts, counts = ring_sums(valid)
+        ring_mean = ring_sums(valid*values)[0] / ring_counts
+        centered = np.where(valid > 0, values - np.nan_to_num(ring_mean), 0.)
+        sums, sumsq = ring_sums(centered)[1], ring_sums(centered**2)[1]
+        mean = sums / counts
+        bkgd = ring_mean + mean
+        noise = np.sqrt(np.clip(sumsq / counts - mean**2, 0, None))
+        # Number of independent apertures in the ring excluding the signal aperture and 
+        # its neighbors, as in getsnr:
+        Napers = np.floor(ring_s*2*np.pi / (2*radius)) - 2
+        correction = np.sqrt(1 + 1/Napers)
+        # No noise estimate where the excluded window covers the whole ring, there are too few
+        # pixels or independent apertures left, or within 2 aperture radii of the star:
+        bad = (2*halfwidth >= 2*np.pi) | (Napers < 1) | (ring_s < 2*radius)
+        bad = bad | (counts < 2) | ~(noise > 0)
+        noise[bad], bkgd[bad] = np.nan, np.nan
+        # Eqn 9 in Mawet 2014:
+        snr = (values - bkgd) / (noise * correction)
+    # Put back into image order:
+    unsort = np.argsort(order)
+    snr = snr[:,unsort].reshape(image.shape)
+    noise = noise[:,unsort].reshape(image.shape)
+    bkgd = bkgd[:,unsort].reshape(image.shape)
+    snr[nans] = np.nan
+    if single_image:
+        snr, apsums, noise, bkgd = snr[0], apsums[0], noise[0], bkgd[0]
+    if return_signal_noise:
+        return snr, apsums, noise, bkgd
+    return snr
+
+
+def mag(image, x, y, radius = 3.89245, returnflux = False, returntable = False, phases = 20):
     ''' Compute instrument magnitudes of one object.  Defaults are set to CLIO 3.9um optimal.
 
     Parameters:
@@ -1962,12 +2852,12 @@ def mag(image, x, y, radius = 3.89245, returnflux = False, returntable = False):
     radius : flt
         pixel radius for aperture.  Default = 3.89, approx 1/2 L/D for 
         CLIO 3.9um 
-    r_in, r_out : flt
-        inside and outside radius for background annulus.  Default = 10,12
     returnflux : bool
         if true, return the instrument mag and the raw flux value.
     returntable : bool
         if true, return the entire photometry table.
+    phases : int or None
+        subpixel phase bins for aperture weights, see aperture_sums.  Default = 20
     Returns:
     --------
     flt
@@ -1975,17 +2865,13 @@ def mag(image, x, y, radius = 3.89245, returnflux = False, returntable = False):
     flt
         signal to noise ratio
     '''
-    from photutils import CircularAperture, aperture_photometry
-    # Position of star:
-    positions = [(x,y)]
-    # Get sum of all pixel values within radius of center:
-    aperture = CircularAperture(positions, r=radius)
-    # Do photometry on star:
-    phot_table = aperture_photometry(image, aperture)
-    m =(-2.5)*np.log10(phot_table['aperture_sum'][0])
+    flux = aperture_sums(image, x, y, radius = radius, phases = phases)[0]
+    m =(-2.5)*np.log10(flux)
     if returnflux:
-        return m, phot_table['aperture_sum'][0]
+        return m, flux
     if returntable:
+        from astropy.table import Table
+        phot_table = Table({'id':[1], 'xcenter':[x], 'ycenter':[y], 'aperture_sum':[flux]})
         phot_table['Mag'] = m
         return m, phot_table
     return m
@@ -2016,11 +2902,307 @@ def contrast(image1,image2,pos1,pos2,**kwargs):
     mag2 = mag(image2,pos2[0],pos2[1], **kwargs)
     return mag2 - mag1
 
-def makeplanet(template, C, TC):
-    ''' Make a simulated planet psf with desired contrast using template psf
+# Exact-overlap aperture weights, keyed by (radius, phases):
+_aperture_weights = {}
 
-    Parameters:
-    -----------
+def _disk_corner_area(x, y, r):
+    ''' Signed area of the disk of radius r centered on the origin that lies within the 
+        rectangle with corners at the origin and (x,y)
+    '''
+    ax, ay = np.minimum(np.abs(x), r), np.minimum(np.abs(y), r)
+    G = lambda t: 0.5*(t*np.sqrt(r**2 - t**2) + r**2*np.arcsin(t/r))
+    # the disk edge crosses height ay at c; integrate min(ay, disk height) from 0 to ax:
+    c = np.sqrt(r**2 - ay**2)
+    area = np.where(ax <= c, ax*ay, c*ay + G(ax) - G(np.minimum(c, ax)))
+    return np.sign(x)*np.sign(y)*area
+
+def circle_overlap(dx, dy, radius):
+    ''' Exact fraction of the area of a pixel that lies within a circle, as photutils' "exact" 
+        aperture method.
+
+    Parameters:
+    -----------
+    dx, dy : flt or arr
+        pixel center relative to the circle center in pixels
+    radius : flt
+        circle radius in pixels
+
+    Returns:
+    --------
+    flt or arr
+        fraction of each pixel inside the circle
+    '''
+    x0, x1, y0, y1 = dx - 0.5, dx + 0.5, dy - 0.5, dy + 0.5
+    return _disk_corner_area(x1, y1, radius) - _disk_corner_area(x0, y1, radius) \
+        - _disk_corner_area(x1, y0, radius) + _disk_corner_area(x0, y0, radius)
+
+def get_aperture_weights(radius, phases = 20):
+    ''' Exact-overlap pixel weights of a circular aperture on a grid of subpixel aperture center 
+        phases, computed once per (radius, phases) and cached.
+
+    Parameters:
+    -----------
+    radius : flt
+        pixel radius for aperture
+    phases : int
+        number of subpixel phase intervals along each axis
+
+    Returns:
+    --------
+    arr
+        pixel offsets of the stamp from the nearest pixel to the aperture center
+    4d arr
+        weights of shape (phases+1, phases+1, len(offsets), len(offsets)), indexed by 
+        [y phase, x phase, y offset, x offset], for aperture centers from -0.5 to +0.5 pixels
+        from the nearest pixel in steps of 1/phases
+    '''
+    key = (float(radius), int(phases))
+    if key not in _aperture_weights:
+        R = np.int_(np.ceil(radius)) + 1
+        offsets = np.arange(-R, R+1)
+        # the aperture center relative to the nearest pixel:
+        f = np.arange(phases + 1)/phases - 0.5
+        dx = offsets[np.newaxis,np.newaxis,np.newaxis,:] - f[np.newaxis,:,np.newaxis,np.newaxis]
+        dy = offsets[np.newaxis,np.newaxis,:,np.newaxis] - f[:,np.newaxis,np.newaxis,np.newaxis]
+        _aperture_weights[key] = (offsets, circle_overlap(dx, dy, radius))
+    return _aperture_weights[key]
+
+def aperture_sums(images, x, y, radius = 3.89245, phases = 20):
+    ''' Sum of pixels within a circular aperture for many positions and images in one vectorized 
+        call.  Pixel weights are the exact fraction of each pixel inside the aperture, precomputed 
+        for a grid of subpixel aperture center phases (see get_aperture_weights).
+
+    Parameters:
+    -----------
+    images : 2d or 3d array
+        single image, or cube of images with one image per position
+    x, y : flt or arr
+        x and y pixel location of aperture centers
+    radius : flt
+        pixel radius for aperture.  Default = 3.89, approx 1/2 L/D for CLIO 3.9um
+    phases : int or None
+        number of subpixel phase intervals along each axis; weights are interpolated bilinearly 
+        between the precomputed phases.  Default = 20, which agrees with exact photometry to 
+        ~1e-4 mag.  If None, compute exact weights for each position.
+
+    Returns:
+    --------
+    arr
+        aperture sum for each position
+    '''
+    images = np.asarray(images, dtype = float)
+    x, y = np.atleast_1d(np.asarray(x, dtype = float)), np.atleast_1d(np.asarray(y, dtype = float))
+    if images.ndim == 2:
+        images = images[np.newaxis]
+        index = np.zeros(len(x), dtype = int)
+    else:
+        index = np.arange(len(x))
+    ny, nx = images.shape[1:]
+    xi, yi = np.int_(np.round(x)), np.int_(np.round(y))
+    if phases is None:
+        R = np.int_(np.ceil(radius)) + 1
+        offsets = np.arange(-R, R+1)
+        weights = circle_overlap(offsets[np.newaxis,np.newaxis,:] - (x-xi)[:,np.newaxis,np.newaxis],
+                                 offsets[np.newaxis,:,np.newaxis] - (y-yi)[:,np.newaxis,np.newaxis], radius)
+    else:
+        offsets, table = get_aperture_weights(radius, phases)
+        u, v = (x - xi + 0.5)*phases, (y - yi + 0.5)*phases
+        bx, by = np.clip(np.int_(np.floor(u)), 0, phases-1), np.clip(np.int_(np.floor(v)), 0, phases-1)
+        tx, ty = (u - bx)[:,np.newaxis,np.newaxis], (v - by)[:,np.newaxis,np.newaxis]
+        weights = (1-ty)*((1-tx)*table[by, bx] + tx*table[by, bx+1]) \
+            + ty*((1-tx)*table[by+1, bx] + tx*table[by+1, bx+1])
+    # integer pixel grid of a stamp around each position:
+    px = xi[:,np.newaxis] + offsets
+    py = yi[:,np.newaxis] + offsets
+    # zero weight for any part of the aperture off the edge of the image:
+    validy, validx = (py >= 0) & (py < ny), (px >= 0) & (px < nx)
+    weights = weights * (validy[:,:,np.newaxis] & validx[:,np.newaxis,:])
+    stamps = images[index[:,np.newaxis,np.newaxis], np.clip(py,0,ny-1)[:,:,np.newaxis], np.clip(px,0,nx-1)[:,np.newaxis,:]]
+    return np.sum(stamps*weights, axis = (1,2))
+
+def template_contrasts(sciencecube, templatecube, radius = 3.89245):
+    ''' Contrast of each template image relative to the corresponding science image, measured 
+        at the center of each postage stamp.  Vectorized equivalent of calling contrast() on 
+        each pair of images.
+
+    Parameters:
+    -----------
+    sciencecube, templatecube : 3d arr
+        cubes of aligned postage stamps
+    radius : flt
+        pixel radius for aperture.  Default = 3.89, approx 1/2 L/D for CLIO 3.9um
+
+    Returns:
+    --------
+    arr
+        contrast in magnitudes of each template image relative to the science image
+    '''
+    N = np.min([sciencecube.shape[0], templatecube.shape[0]])
+    center = (0.5*((sciencecube.shape[2])-1),0.5*((sciencecube.shape[1])-1))
+    xc, yc = np.full(N, center[0]), np.full(N, center[1])
+    sci = aperture_sums(sciencecube[:N], xc, yc, radius = radius)
+    temp = aperture_sums(templatecube[:N], xc, yc, radius = radius)
+    return (-2.5)*np.log10(temp) - (-2.5)*np.log10(sci)
+
+def _star_photometry_one_file(filename, positions, radius):
+    ''' Aperture sums of each star in every subframe of one file.  Returns an array of 
+        shape (Nsubframes, Nstars)
+    '''
+    with fits.open(filename, memmap = True) as hdulist:
+        image = np.array(hdulist[0].data, dtype = float)
+    if image.ndim == 2:
+        image = image[np.newaxis]
+    Nsub, Nstars = image.shape[0], len(positions)
+    x = np.tile([p[0] for p in positions], Nsub)
+    y = np.tile([p[1] for p in positions], Nsub)
+    cube = np.repeat(image, Nstars, axis = 0)
+    return aperture_sums(cube, x, y, radius = radius).reshape(Nsub, Nstars)
+
+class PhotometryTable(object):
+    def __init__(self, k, path = None, radius = 3.89245, path_prefix = '', filename = 'StarPhotometry.csv', ncores = 1,
+                 write = None):
+        ''' Table of instrument magnitudes of star A and B in every frame of a dataset, computed once 
+        and, if a dataset folder is given, persisted alongside the dataset.  Entries are keyed by (filename, subframe, star, x, y, radius)
+        so that only frames/positions/radii not already in the table are measured.  Template contrasts, 
+        A/B contrast and mass limit inputs can then be read from the table rather than by re-reading 
+        every image.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas, astropy
+
+        Attributes:
+        -----------
+        k : Pandas array
+            Pandas array made from the output of bditools.findstars_in_dataset.  
+            Assumes column names are ['filename', 'xca','yca', 'xcb', 'ycb']
+        path : str
+            dataset folder.  The table is read from and stored as path+filename.  Default = None, keep 
+            the table in memory only
+        radius : flt
+            pixel radius for aperture.  Default = 3.89, approx 1/2 L/D for CLIO 3.9um
+        path_prefix : str
+            string to put in front of filenames in k in case the relative location of files has changed
+        filename : str
+            name of the table file within path.  Default = 'StarPhotometry.csv'
+        ncores : int
+            number of files to measure in parallel.  Default = 1
+        write : bool
+            if True, write the table to path+filename when new frames are measured.  Default = None, 
+            write only if path is given
+        table : Pandas array
+            photometry table with columns ['filename','subframe','star','x','y','radius','flux','mag']
+        '''
+        self.k = k
+        self.path = path
+        self.radius = radius
+        self.path_prefix = path_prefix
+        self.filename = path+filename if path is not None else None
+        self.ncores = ncores
+        self.write = (path is not None) if write is None else write
+        if self.write and path is None:
+            raise ValueError('PhotometryTable: give the dataset path to write the table to')
+        self.columns = ['filename','subframe','star','x','y','radius','flux','mag']
+        self.table = pd.DataFrame(columns = self.columns)
+        if self.filename is not None and os.path.exists(self.filename):
+            self.Load()
+
+    def Load(self):
+        ''' Read the photometry table from disk
+        '''
+        self.table = pd.read_csv(self.filename)
+
+    def Save(self):
+        ''' Write the photometry table to disk
+        '''
+        self.table.to_csv(self.filename, index = False)
+
+    def Compute(self, save = True):
+        ''' Measure star A and B in every frame in k that is not already in the table for this radius.
+        
+        Parameters:
+        -----------
+        save : bool
+            if True, write the updated table to disk if the table is written (see write).  Default = True
+        '''
+        # frames already measured at these positions and radius:
+        done = self.table[np.isclose(self.table['radius'].astype(float), self.radius)]
+        done = set(zip(done['filename'], done['star'], np.round(done['x'].astype(float),3), np.round(done['y'].astype(float),3)))
+        todo = []
+        for i in range(len(self.k)):
+            f = self.k['filename'][i]
+            positions = [(self.k['xca'][i],self.k['yca'][i]), (self.k['xcb'][i],self.k['ycb'][i])]
+            if (f,'A',np.round(positions[0][0],3),np.round(positions[0][1],3)) in done and \
+                    (f,'B',np.round(positions[1][0],3),np.round(positions[1][1],3)) in done:
+                continue
+            todo.append((f, positions))
+        if len(todo) == 0:
+            return
+        measure = lambda t: _star_photometry_one_file(self.path_prefix+t[0], t[1], self.radius)
+        if self.ncores > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers = self.ncores) as executor:
+                fluxes = list(executor.map(measure, todo))
+        else:
+            fluxes = [measure(t) for t in todo]
+        rows = []
+        for (f, positions), flux in zip(todo, fluxes):
+            for j in range(flux.shape[0]):
+                for s, star in enumerate(['A','B']):
+                    rows.append([f, j, star, positions[s][0], positions[s][1], self.radius, flux[j,s], 
+                                 (-2.5)*np.log10(flux[j,s])])
+        new = pd.DataFrame(rows, columns = self.columns)
+        self.table = pd.concat([self.table, new], ignore_index = True) if len(self.table) else new
+        if save and self.write:
+            self.Save()
+
+    def Mags(self, star, subframe = 0):
+        ''' Instrument magnitudes of one star in every frame of k, in the order of k.
+
+        Parameters:
+        -----------
+        star : 'A' or 'B'
+            which star
+        subframe : int
+            for image cubes, which subframe to use.  Default = 0
+
+        Returns:
+        --------
+        arr
+            instrument magnitudes
+        '''
+        self.Compute()
+        t = self.table[(self.table['star'] == star) & (self.table['subframe'].astype(int) == subframe) & \
+                       np.isclose(self.table['radius'].astype(float), self.radius)]
+        t = t.assign(xr = np.round(t['x'].astype(float),3), yr = np.round(t['y'].astype(float),3))
+        t = t.drop_duplicates(subset = ['filename','xr','yr'], keep = 'last')
+        # look up each frame at the star position listed in k:
+        xcol, ycol = {'A':('xca','yca'), 'B':('xcb','ycb')}[star]
+        frames = pd.DataFrame({'filename':self.k['filename'].values, 
+                               'xr':np.round(self.k[xcol].values.astype(float),3),
+                               'yr':np.round(self.k[ycol].values.astype(float),3)})
+        frames = frames.merge(t[['filename','xr','yr','mag']], on = ['filename','xr','yr'], how = 'left')
+        return frames['mag'].values.astype(float)
+
+    def ABContrast(self, subframe = 0):
+        ''' Contrast of B relative to A in magnitudes in every frame of k
+
+        Parameters:
+        -----------
+        subframe : int
+            for image cubes, which subframe to use.  Default = 0
+
+        Returns:
+        --------
+        arr
+            contrast in magnitudes of B component relative to A component
+        '''
+        return self.Mags('B', subframe = subframe) - self.Mags('A', subframe = subframe)
+
+def makeplanet(template, C, TC):
+    ''' Make a simulated planet psf with desired contrast using template psf
+
+    Parameters:
+    -----------
     template : 2d image
         sample PSF for making simulated planet
     C : flt
@@ -2205,8 +3387,9 @@ class SyntheticSignal(object):
             script will generate them from files in CleanList and specified science star.
         template : 2d arr
             optional user input for a psf template not built from the BDI dataset.
-        TC : flt
-            if external template provided, you must specify the contrast of the template relative to the science star
+        TC : flt or arr
+            contrast of the template relative to the science star, either a single value or one per image.  If \
+            not provided it is measured for every image with template_contrasts.
         use_same : bool
             If True, use the same star as a template for a synthetic psf signal around itself.  If false, use the opposite star. \
             Default = True
@@ -2216,7 +3399,6 @@ class SyntheticSignal(object):
             If True, inject a negative planet signal instead of positive.  Default = False.
 
         '''
-        from cliotools.bditools import contrast
         self.k = k
         self.Star = Star
         self.sep = sep
@@ -2266,20 +3448,23 @@ class SyntheticSignal(object):
         # Inject planet signal into science target star:
         from cliotools.bditools import injectplanets
         synthcube = np.zeros(np.shape(self.sciencecube))
+        # Template contrast of templatecube relative to sciencecube for every image, measured
+        # for the whole cube at once unless supplied by the user:
+        if TC is None:
+            TC = template_contrasts(self.sciencecube, self.templatecube)
+        TC = np.broadcast_to(TC, (self.sciencecube.shape[0],))
+        self.TC = TC
         if len(templatecube) == 0:
             #print('not template provided')
             # If template PSF is not provided by user (this is most common):
-            from cliotools.bditools import contrast
+            center = (0.5*((self.sciencecube.shape[2])-1),0.5*((self.sciencecube.shape[1])-1))
             # for each image in science cube:
             for i in range(self.sciencecube.shape[0]):
-                # Get template constrast of refcube to sciencecube
-                center = (0.5*((self.sciencecube.shape[2])-1),0.5*((self.sciencecube.shape[1])-1))
-                TC = contrast(self.sciencecube[i],self.templatecube[i],center,center)
                 # image header must be provided to 
                 # accomodate rotation from north up reference got PA to image reference:
                 imhdr = fits.getheader(self.k['filename'][i]) 
                 # Inject the desired signal into the science cube:
-                synth = injectplanets(self.sciencecube[i], imhdr, self.templatecube[i], sep, pa, C, TC, 
+                synth = injectplanets(self.sciencecube[i], imhdr, self.templatecube[i], sep, pa, C, TC[i], 
                                       center[0], center[1], 
                                       sepformat = self.sepformat, wavelength = wavelength, box = box, 
                                       inject_negative_signal = inject_negative_signal)
@@ -2287,65 +3472,502 @@ class SyntheticSignal(object):
                 synthcube[i,:,:] = synth
                 
         else:
-            center = (0.5*((self.sciencecube.shape[2])-1),0.5*((self.sciencecube.shape[1])-1))
             # If external template is provided: (this might happen if other star is saturated, etc)
-            #if TC == None:
-                # Known contrast of template to science star must be provided
-                #raise ValueError('template contrast needed')
             # inject signal:
             for i in range(self.sciencecube.shape[0]):
-                if TC == None:
-                    from cliotools.bditools import contrast
-                    # Get template constrast of refcube to sciencecube
-                    TC = contrast(self.sciencecube[i],self.templatecube[i],center,center)
                 imhdr = fits.getheader(k['filename'][i])
-                synth = injectplanets(self.sciencecube[i], imhdr, self.templatecube[i], sep, pa, C, TC, box, box, 
+                synth = injectplanets(self.sciencecube[i], imhdr, self.templatecube[i], sep, pa, C, TC[i], box, box, 
                                               sepformat = sepformat, wavelength = wavelength, box = box, 
                                               inject_negative_signal = inject_negative_signal)
                 synthcube[i,:,:] = synth
                 
         self.synthcube = synthcube.copy()
 
+def _negative_signal_grid_chunk(fitter, points, profile):
+    ''' Evaluate a chunk of NegativeSignalFitter grid points.  Module level so that 
+        NegativeSignalFitter.Grid can farm chunks out to worker processes.
+    '''
+    if profile:
+        return np.array([fitter.BestContrast(sep, pa) for sep, pa in points])
+    return np.array([fitter.Chi2(sep, pa, C) for sep, pa, C in points])
+
+def _cubic_bspline_weights(t, derivative = False):
+    ''' Weights of the four cubic B-spline coefficients at offsets -1, 0, 1, 2 from floor(u) for 
+        fractional position t = u - floor(u), or of the spline derivative if derivative is True
+    '''
+    t = t[...,np.newaxis]
+    if derivative:
+        return np.concatenate([-(1-t)**2/2, (3*t**2 - 4*t)/2, (-3*t**2 + 2*t + 1)/2, t**2/2], axis = -1)
+    return np.concatenate([(1-t)**3/6, (3*t**3 - 6*t**2 + 4)/6, (-3*t**3 + 3*t**2 + 3*t + 1)/6, t**3/6], axis = -1)
+
+class NegativeSignalFitter(object):
+    def __init__(self, k, Star, sep, pa, C, K_klip, sepformat = 'lambda/D', boxsize = 50,
+                sciencecube = [], refcube = [], templatecube = [], TC = None, use_same = True,
+                aperture_radius = 1., window = 3., wavelength = 3.9, pixscale = 15.9,
+                ncores = 1, verbose = True
+                ):
+        ''' Fit the separation, position angle, and contrast of a real candidate signal by injecting 
+        a negative template psf and minimizing the residual flux in an aperture at the candidate's location.
+
+        In BDI the KLIP basis is built from the other star, so it does not change when a signal 
+        is injected into the science star, and the KLIP residual is linear in the injected signal:
+            residual(sep,pa,C) = R0 - 10**(-C/2.5) * L(P(sep,pa))
+        where R0 is the residual of the science images with no injection, P is the (unit contrast) 
+        template psf placed at sep,pa, and L(P) = P - Z Z^T P is the projection off the basis Z.  The basis
+        and R0 are computed once, and each trial only places the template in a small window and projects 
+        that window, so a chi^2 evaluation costs milliseconds instead of a full BDI.Reduce.  Chi^2 is 
+        summed over every frame in an aperture fixed at the initial guess location, weighted by the 
+        residual noise at that separation in each frame.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, scipy, pandas, astropy
+
+        Attributes:
+        -----------
+        k : Pandas array
+            pandas datafrom made from importing "CleanList"
+        Star : 'A' or 'B'
+            star the candidate signal is around
+        sep, pa, C : flt
+            initial guess for the candidate's separation (in sepformat units), position angle (deg from North),
+            and contrast with the central star (mags)
+        K_klip : int
+            number of KLIP modes to use
+        sepformat : str
+            format of separations. Either 'arcsec', 'mas', pixels', or 'lambda/D'. Default = 'lambda/D'
+        boxsize : int
+            size of box of size "2box x 2box" for image stamps, if cubes aren't supplied by user
+        sciencecube, refcube, templatecube : 3d arr
+            optional user input unnormalized cubes for the science star, KLIP reference star, and psf template.  
+            If not provided they are generated from files in CleanList as in SyntheticSignal.
+        TC : flt or arr
+            contrast of the template relative to the science star, one value or one per image.  If \
+            not provided it is measured for every image with template_contrasts.
+        use_same : bool
+            If True, use the science star as its own psf template.  Default = True
+        aperture_radius : flt
+            radius of aperture in which chi^2 is computed, in sepformat units.  Default = 1 L/D
+        window : flt
+            half-width of the region around the trial position in which the template psf is placed, in 
+            sepformat units.  Default = 3 L/D
+        wavelength : flt
+            central wavelength of filter in microns.  Default = 3.9
+        pixscale : flt
+            pixelscale in mas/pixel.  Default = 15.9 mas/pix, pixscale for CLIO narrow camera
+        ncores : int
+            number of processes to use when evaluating a grid.  Default = 1
+        verbose : bool
+            If True, print status of things.  Default = True
+        '''
+        from scipy import ndimage
+        from cliotools.bditools import psf_subtract, lod_to_pixels
+        self.k = k
+        self.Star = Star
+        self.sep = sep
+        self.pa = pa
+        self.C = C
+        self.K_klip = K_klip
+        self.sepformat = sepformat
+        self.ncores = ncores
+        self.verbose = verbose
+        # pixels per unit of separation:
+        if sepformat == 'lambda/D':
+            self.pixels_per_unit = lod_to_pixels(1., wavelength, pixscale = pixscale)
+        elif sepformat == 'arcsec':
+            self.pixels_per_unit = 1000. / pixscale
+        elif sepformat == 'mas':
+            self.pixels_per_unit = 1. / pixscale
+        elif sepformat == 'pixels':
+            self.pixels_per_unit = 1.
+        else:
+            raise ValueError("sepformat must be 'arcsec', 'mas', 'pixels', or 'lambda/D'")
+        # If no image cubes provided, make them without normalizing or masking:
+        if len(sciencecube) == 0:
+            astamp, bstamp = PrepareCubes(self.k, boxsize = boxsize, normalize = False,
+                                          inner_mask_core = False, outer_mask_annulus = False,
+                                          verbose = self.verbose)
+            stamps = {'A':astamp, 'B':bstamp}
+            other = {'A':'B', 'B':'A'}[Star]
+            sciencecube = stamps[Star]
+            refcube = stamps[other]
+            templatecube = stamps[Star] if use_same else stamps[other]
+        self.sciencecube = np.array(sciencecube, dtype = float)
+        self.refcube = np.array(refcube, dtype = float)
+        self.templatecube = np.array(templatecube, dtype = float)
+        N, ny, nx = self.sciencecube.shape
+        self.center = (0.5*(nx-1), 0.5*(ny-1))
+        self.template_center = (0.5*(self.templatecube.shape[2]-1), 0.5*(self.templatecube.shape[1]-1))
+        # Image rotation for each frame, as in injectplanet:
+        NORTH_CLIO = -1.80
+        self.derot = np.array([fits.getheader(f)['ROTOFF'] - 180. + NORTH_CLIO for f in self.k['filename'][:N]])
+        # Template contrast and the resulting flux scale of a unit contrast planet in each frame:
+        if TC is None:
+            TC = template_contrasts(self.sciencecube, self.templatecube)
+        self.TC = np.broadcast_to(TC, (N,))
+        self.template_scale = 10**(self.TC/2.5)
+
+        ######## Fixed KLIP basis and residuals with no injected signal: ########
+        F, Z, immean = psf_subtract(self.sciencecube[0], self.refcube, K_klip, return_basis = True, verbose = verbose)
+        self.Z = Z[:,:np.max(K_klip)]
+        T = self.sciencecube.reshape(N, ny*nx) - immean[np.newaxis,:]
+        R0 = T - np.dot(np.dot(T, self.Z), self.Z.T)
+        self.residuals = R0.reshape(N, ny, nx)
+
+        ######## Aperture at the initial guess location in each frame: ########
+        r = aperture_radius * self.pixels_per_unit
+        x0, y0 = self.Positions(sep, pa)
+        a = np.arange(-np.int_(np.ceil(r)), np.int_(np.ceil(r))+1)
+        dy, dx = np.meshgrid(a, a, indexing = 'ij')
+        ay = np.round(y0)[:,np.newaxis] + dy.ravel()
+        ax = np.round(x0)[:,np.newaxis] + dx.ravel()
+        inside = ((ax - x0[:,np.newaxis])**2 + (ay - y0[:,np.newaxis])**2 <= r**2) & \
+                    (ax >= 0) & (ax < nx) & (ay >= 0) & (ay < ny)
+        self.ap_x, self.ap_y = ax, ay
+        self.ap_index = np.int_(np.clip(ay,0,ny-1)*nx + np.clip(ax,0,nx-1))
+        self.ap_Z = self.Z[self.ap_index]
+        self.r0 = np.take_along_axis(R0, self.ap_index, axis = 1) * inside
+        # Noise in each frame from the residuals in a ring at the candidate separation, excluding the candidate:
+        yy, xx = np.indices((ny, nx))
+        xx, yy = xx.ravel(), yy.ravel()
+        ring = np.abs(np.hypot(xx - self.center[0], yy - self.center[1]) - sep * self.pixels_per_unit) <= r
+        ring = ring[np.newaxis,:] & (np.hypot(xx - x0[:,np.newaxis], yy - y0[:,np.newaxis]) > 2*r)
+        empty = ~np.any(ring & np.isfinite(R0), axis = 1)
+        if np.any(empty):
+            raise ValueError('NegativeSignalFitter: no pixels in the noise ring at sep = '+str(sep)+' in frame(s) '
+                             +str(np.where(empty)[0].tolist())+'; the ring falls outside the image stamp')
+        self.noise = np.nanstd(np.where(ring, R0, np.nan), axis = 1)
+        if np.any(~(self.noise > 0)):
+            raise ValueError('NegativeSignalFitter: zero noise in the ring at sep = '+str(sep)+' in frame(s) '
+                             +str(np.where(~(self.noise > 0))[0].tolist()))
+        self.weights = inside / self.noise[:,np.newaxis]**2
+
+        ######## Spline coefficients for placing the template at subpixel positions: ########
+        self.window = np.int_(np.ceil(window * self.pixels_per_unit))
+        self.template_coeffs = ndimage.spline_filter1d(ndimage.spline_filter1d(self.templatecube, order = 3, axis = 1), 
+                                                       order = 3, axis = 2)
+
+    def Positions(self, sep, pa):
+        ''' Pixel location of a signal at sep (in sepformat units), pa (deg from North) in every frame
+
+        Returns:
+        --------
+        arr, arr
+            x and y pixel locations
+        '''
+        phi = np.radians(pa + self.derot)
+        sep = sep * self.pixels_per_unit
+        return self.center[0] - sep*np.sin(phi), self.center[1] + sep*np.cos(phi)
+
+    def _template(self, frames, y, x, derivative = None):
+        ''' Evaluate the cubic spline template of each frame, or its derivative along 'x' or 'y', at pixel 
+            coordinates relative to the template center.  Outside the template is zero.
+        '''
+        nf, ny, nx = self.template_coeffs.shape
+        y, x = y + self.template_center[1], x + self.template_center[0]
+        y0, x0 = np.floor(y), np.floor(x)
+        wy = _cubic_bspline_weights(y - y0, derivative == 'y')
+        wx = _cubic_bspline_weights(x - x0, derivative == 'x')
+        # the 4x4 spline coefficients around each point:
+        iy = np.int_(y0)[...,np.newaxis] + np.arange(-1, 3)
+        ix = np.int_(x0)[...,np.newaxis] + np.arange(-1, 3)
+        inside = ((iy >= 0) & (iy < ny))[...,:,np.newaxis] & ((ix >= 0) & (ix < nx))[...,np.newaxis,:]
+        c = self.template_coeffs[np.broadcast_to(frames, y.shape)[...,np.newaxis,np.newaxis], 
+                                 np.clip(iy, 0, ny-1)[...,:,np.newaxis], np.clip(ix, 0, nx-1)[...,np.newaxis,:]]
+        return np.einsum('...i,...ij,...j->...', wy, c * inside, wx)
+
+    def _model(self, sep, pa, derivatives = False):
+        ''' KLIP residual of a unit contrast planet at sep, pa in the aperture of every frame, L(P).  
+            If derivatives, also return its derivatives with respect to the planet x and y pixel position.
+        '''
+        N, ny, nx = self.sciencecube.shape
+        frames = np.arange(N)[:,np.newaxis]
+        x, y = self.Positions(sep, pa)
+        x, y = x[:,np.newaxis], y[:,np.newaxis]
+        ix, iy = np.round(x), np.round(y)
+        # pixels of the window the template is placed in:
+        w = np.arange(-self.window, self.window+1)
+        dy, dx = np.meshgrid(w, w, indexing = 'ij')
+        wy, wx = iy + dy.ravel(), ix + dx.ravel()
+        valid = (wx >= 0) & (wx < nx) & (wy >= 0) & (wy < ny)
+        Zw = self.Z[np.int_(np.clip(wy,0,ny-1)*nx + np.clip(wx,0,nx-1))]
+        # aperture pixels that fall in the window:
+        apin = (np.abs(self.ap_y - iy) <= self.window) & (np.abs(self.ap_x - ix) <= self.window)
+        def project(derivative = None):
+            # template (or its derivative) placed at the planet position, projected off the basis, in the aperture:
+            U = self._template(frames, wy - y, wx - x, derivative) * valid
+            Uap = self._template(frames, self.ap_y - y, self.ap_x - x, derivative) * apin
+            coef = np.einsum('npk,np->nk', Zw, U)
+            return self.template_scale[:,np.newaxis] * (Uap - np.einsum('nak,nk->na', self.ap_Z, coef))
+        LP = project()
+        if not derivatives:
+            return LP
+        # L is linear, so the derivatives with respect to the planet position are the projected analytic
+        # derivatives of the template spline (with a minus sign, the template is evaluated at pixel - planet):
+        return LP, -project('x'), -project('y')
+
+    def Chi2(self, sep, pa, C):
+        ''' Chi^2 of residual flux in the aperture after injecting a negative signal at sep, pa, C
+
+        Parameters:
+        -----------
+        sep : flt
+            separation in sepformat units
+        pa : flt
+            position angle in deg from North
+        C : flt
+            contrast in magnitudes
+
+        Returns:
+        --------
+        flt
+            chi^2 summed over every frame
+        '''
+        s = 10**(-C/2.5)
+        r = self.r0 - s*self._model(sep, pa)
+        return np.sum(self.weights * r**2)
+
+    def Chi2Gradient(self, sep, pa, C):
+        ''' Chi^2 and its analytic gradient with respect to (sep, pa, C)
+
+        Returns:
+        --------
+        flt
+            chi^2
+        arr
+            [dchi2/dsep, dchi2/dpa, dchi2/dC]
+        '''
+        s = 10**(-C/2.5)
+        q, qx, qy = self._model(sep, pa, derivatives = True)
+        r = self.r0 - s*q
+        wr = self.weights * r
+        chi2 = np.sum(wr * r)
+        # derivative with respect to planet pixel position in each frame:
+        dx = -2*s*np.sum(wr * qx, axis = 1)
+        dy = -2*s*np.sum(wr * qy, axis = 1)
+        # chain rule to sep, pa:
+        phi = np.radians(pa + self.derot)
+        seppix = sep * self.pixels_per_unit
+        dsep = self.pixels_per_unit * np.sum(-dx*np.sin(phi) + dy*np.cos(phi))
+        dpa = np.radians(1.) * seppix * np.sum(-dx*np.cos(phi) - dy*np.sin(phi))
+        dC = -2*np.sum(wr * q) * (-s*np.log(10)/2.5)
+        return chi2, np.array([dsep, dpa, dC])
+
+    def BestContrast(self, sep, pa):
+        ''' Contrast that minimizes chi^2 at sep, pa.  Chi^2 is quadratic in the planet flux so 
+            this is solved analytically.
+
+        Returns:
+        --------
+        flt
+            chi^2 at the best contrast
+        flt
+            best contrast in magnitudes, inf if there is no positive signal at sep, pa
+        '''
+        q = self._model(sep, pa)
+        s = np.sum(self.weights * self.r0 * q) / np.sum(self.weights * q**2)
+        s = np.max([s, 0.])
+        chi2 = np.sum(self.weights * (self.r0 - s*q)**2)
+        if s == 0:
+            return chi2, np.inf
+        return chi2, -2.5*np.log10(s)
+
+    def Grid(self, seps, pas, Cs = None):
+        ''' Evaluate chi^2 on a grid of separations, position angles, and contrasts.  If Cs is not 
+            provided, the best contrast at each (sep, pa) is solved for analytically.
+
+        Parameters:
+        -----------
+        seps, pas : arr
+            separations (sepformat units) and position angles (deg) to test
+        Cs : arr
+            contrasts to test.  Default = None, solve for the best contrast
+
+        Returns:
+        --------
+        arr
+            chi^2 grid of shape (len(seps), len(pas)) or (len(seps), len(pas), len(Cs))
+        arr
+            if Cs is None, best contrast at each (sep, pa)
+        '''
+        profile = Cs is None
+        if profile:
+            points = [(sep, pa) for sep in seps for pa in pas]
+            shape = (len(seps), len(pas))
+        else:
+            points = [(sep, pa, C) for sep in seps for pa in pas for C in Cs]
+            shape = (len(seps), len(pas), len(Cs))
+        if self.ncores > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            chunks = np.array_split(np.arange(len(points)), self.ncores)
+            with ProcessPoolExecutor(max_workers = self.ncores) as executor:
+                futures = [executor.submit(_negative_signal_grid_chunk, self, [points[i] for i in c], profile) 
+                           for c in chunks]
+                results = np.concatenate([f.result() for f in futures])
+        else:
+            results = _negative_signal_grid_chunk(self, points, profile)
+        if profile:
+            self.grid_chi2 = results[:,0].reshape(shape)
+            self.grid_C = results[:,1].reshape(shape)
+            return self.grid_chi2, self.grid_C
+        self.grid_chi2 = results.reshape(shape)
+        return self.grid_chi2
+
+    def Fit(self, p0 = None, use_gradient = True, method = None, bounds = None, **kwargs):
+        ''' Minimize chi^2 over (sep, pa, C) with scipy.optimize.minimize
+
+        Parameters:
+        -----------
+        p0 : arr
+            starting [sep, pa, C].  Default = the initial guess
+        use_gradient : bool
+            if True, use the analytic gradient.  Default = True
+        method : str
+            scipy.optimize.minimize method.  Default = L-BFGS-B with the gradient, Nelder-Mead without
+        bounds : list
+            optional [(min,max)] bounds for each parameter
+        kwargs :
+            passed to scipy.optimize.minimize
+
+        Returns:
+        --------
+        OptimizeResult
+            scipy result; best fit is also stored as sep_fit, pa_fit, C_fit
+        '''
+        from scipy.optimize import minimize
+        if p0 is None:
+            p0 = [self.sep, self.pa, self.C]
+        if use_gradient:
+            if method is None:
+                method = 'L-BFGS-B'
+            result = minimize(lambda p: self.Chi2Gradient(*p), p0, jac = True, method = method, bounds = bounds, **kwargs)
+        else:
+            if method is None:
+                method = 'Nelder-Mead'
+            result = minimize(lambda p: self.Chi2(*p), p0, method = method, bounds = bounds, **kwargs)
+        self.fit_result = result
+        self.sep_fit, self.pa_fit, self.C_fit = result.x
+        return result
+
+    def lnlike(self, theta):
+        ''' Log likelihood of theta = [sep, pa, C] for use with an MCMC sampler such as emcee.
+            Pixels are treated as independent, so the posterior width should be taken as approximate.
+        '''
+        return -0.5 * self.Chi2(*theta)
+
 ################## Tools for estimating noise floor contrast ###################################
 
+def _read_sky_patches(filename, positions, box):
+    ''' Read the (2box x 2box) sky patches at every (x,y) in positions from a single
+        memory-mapped fits file.  Only the requested patches are pulled from disk.
+        Returns an array of shape (len(positions), Nsubframes, 2box, 2box); Nsubframes = 1
+        for 2d images.
+    '''
+    with fits.open(filename, memmap = True) as hdulist:
+        section = hdulist[0].section
+        ndim = len(hdulist[0].shape)
+        patches = []
+        for x,y in positions:
+            if ndim == 2:
+                patch = section[y-box:y+box,x-box:x+box][np.newaxis]
+            else:
+                patch = section[:,y-box:y+box,x-box:x+box]
+            patches.append(np.array(patch, dtype = float))
+    return np.array(patches)
+
+def skycube_filename(path, x, y, box, filenames):
+    ''' Filename of the on-disk cached sky cube for sky patch location (x,y) and boxsize in dataset path,
+        made from the images in filenames (identified by a hash of the list)
+    '''
+    import hashlib
+    files = hashlib.sha1('\n'.join(filenames).encode()).hexdigest()[:10]
+    return path+'skycube_x'+str(int(x))+'_y'+str(int(y))+'_box'+str(int(box))+'_'+files+'.fits'
+
+def makeskycubes(path, positions, k, box, ncores = 1, use_cache = True, write_cache = True, path_prefix = ''):
+    ''' Extract cubes of empty sky patches at several locations in every image of a dataset, for use
+        in estimating the noise floor.  Each image is memory-mapped and every requested patch is sliced out
+        in a single read of that file, rather than reading the full frame once per patch location.
+
+    Parameters:
+    -----------
+    path : str
+        dataset folder.  Cached sky cubes are written here.
+    positions : list of tuples
+        list of (x,y) integer pixel locations of the center of each sky patch
+    k : Pandas array
+        Pandas array made from the output of bditools.findstars_in_dataset.  
+        Assumes column names are ['filename', 'xca','yca', 'xcb', 'ycb']
+    box : int
+        sky patches will be 2box x 2box
+    ncores : int
+        number of files to read in parallel.  Default = 1
+    use_cache : bool
+        if True, load a previously written sky cube for a (path, x, y, box, image list) combination 
+        instead of reading the images again.  Default = True
+    write_cache : bool
+        if True, write each sky cube to disk keyed by (path, x, y, box, image list), see 
+        skycube_filename.  Default = True
+    path_prefix : str
+        string to put in front of filenames in k in case the relative location of files has changed
+
+    Returns:
+    --------
+    list of 3d arr
+        one sky cube per requested position, in the same order as positions
+    '''
+    positions = [(int(x),int(y)) for x,y in positions]
+    box = int(box)
+    filenames = [path_prefix+f for f in k['filename']]
+    skycubes = [None]*len(positions)
+    # Load anything that has already been cached for these images:
+    if use_cache:
+        for n,(x,y) in enumerate(positions):
+            cachefile = skycube_filename(path, x, y, box, filenames)
+            if os.path.exists(cachefile):
+                skycubes[n] = fits.getdata(cachefile)
+    todo = [n for n in range(len(positions)) if skycubes[n] is None]
+    if len(todo) == 0:
+        return skycubes
+    todo_positions = [positions[n] for n in todo]
+    # Read all requested patches from each file, one read per file:
+    if ncores > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = ncores) as executor:
+            patches = list(executor.map(lambda f: _read_sky_patches(f, todo_positions, box), filenames))
+    else:
+        patches = [_read_sky_patches(f, todo_positions, box) for f in filenames]
+    # patches is a list of (Npositions, Nsubframes, 2box, 2box) arrays; stack along the subframe axis:
+    patches = np.concatenate(patches, axis = 1)
+    for n,(x,y),cube in zip(todo, todo_positions, patches):
+        skycubes[n] = cube
+        if write_cache:
+            fits.writeto(skycube_filename(path, x, y, box, filenames), cube, overwrite = True)
+    return skycubes
+
 def makeskycube(path,x,y,k,box,lim_lod = 10, write_skycube = False):
-    from cliotools.bditools import circle_mask
-    from cliotools.bditools import lod_to_pixels
-    xx,yy = np.meshgrid(np.arange(x-box,x+box+1,1),np.arange(y-box,y+box+1,1))
-    lim = lod_to_pixels(lim_lod, 3.9)
-    im = fits.getdata(k['filename'][0])
-    count = 0
-    keep = np.array([])
-    im = fits.getdata(k['filename'][0])
-    ndim = len(im.shape)
-    if ndim == 2:
-        skycube = np.zeros([len(k),box*2,box*2])
-    if ndim == 3:
-        s = im.shape[0]
-        skycube = np.zeros([(len(k)+1)*s,box*2,box*2])
-    for i in range(len(k)):
-        if ndim == 2:
-            tooclose = False
-            im = fits.getdata(k['filename'][i])
-            sky = im[y-box:y+box,x-box:x+box]
-            xca,yca = k['xca'][i],k['yca'][i]
-            xcb,ycb = k['xcb'][i],k['ycb'][i]
-            ra = circle_mask(lim,im.shape[1],im.shape[0], xca, yca)
-            rb = circle_mask(lim,im.shape[1],im.shape[0], xcb, ycb)
-            skycube[count,:,:] = sky
-            count += 1
-        if ndim == 3:
-            im = fits.getdata(k['filename'][i])
-            for j in range(im.shape[0]):
-                sky = im[j,y-box:y+box,x-box:x+box]
-                xca,yca = k['xca'][i],k['yca'][i]
-                xcb,ycb = k['xcb'][i],k['ycb'][i]
-                ra = circle_mask(lim,im.shape[2],im.shape[1], xca, yca)
-                rb = circle_mask(lim,im.shape[2],im.shape[1], xcb, ycb)
-                skycube[count+j,:,:] = sky
-            count += 1   
-    #print(keep)
-    #skycube = skycube[np.int_(keep)]
+    ''' Extract a cube of a single (2box x 2box) sky patch centered on (x,y) from every image in 
+        the dataset.  Wrapper for makeskycubes() for a single location.
+
+    Parameters:
+    -----------
+    path : str
+        dataset folder
+    x, y : int
+        pixel location of center of sky patch
+    k : Pandas array
+        Pandas array made from the output of bditools.findstars_in_dataset.  
+    box : int
+        sky patch will be 2box x 2box
+    lim_lod : flt
+        unused, kept for backwards compatibility
+    write_skycube : bool
+        if True, also write the cube to path/skycube.fits.  Default = False
+
+    Returns:
+    --------
+    3d arr
+        cube of sky patches
+    '''
+    skycube = makeskycubes(path, [(x,y)], k, box, use_cache = False, write_cache = False)[0]
     if write_skycube:
         fits.writeto(path+'skycube.fits',skycube,overwrite = True)
     return skycube
@@ -2354,11 +3976,18 @@ def GetSingleSNRForNoiseFloor(path, k, x1, y1, x2, y2, K_klip, box, templatecube
                                 skycube1 = None, skycube2 = None):
     from cliotools.bdi import BDI
     from cliotools.bditools import getsnr,injectplanets
-    # Make two skycubes:
-    if np.size(skycube1) == 1:
-        skycube1 = makeskycube(path, x1,y1,k,box, write_skycube=write_skycube)
-    if np.size(skycube2) == 1:
-        skycube2 = makeskycube(path, x2,y2,k,box, write_skycube=write_skycube)
+    # Make two skycubes in a single pass through the dataset (or load them from the
+    # on-disk cache if they've already been made):
+    if np.size(skycube1) == 1 or np.size(skycube2) == 1:
+        cubes = makeskycubes(path, [(x1,y1),(x2,y2)], k, box, write_cache = write_skycube)
+        if np.size(skycube1) == 1:
+            skycube1 = cubes[0]
+            if write_skycube:
+                fits.writeto(path+'skycube.fits', skycube1, overwrite = True)
+        if np.size(skycube2) == 1:
+            skycube2 = cubes[1]
+            if write_skycube:
+                fits.writeto(path+'skycube.fits', skycube2, overwrite = True)
     
     smallest = np.min([skycube1.shape[0],templatecube.shape[0]])
     # inject fake signal into skycube1:
@@ -2442,7 +4071,7 @@ def GetNoiseFloors(path, k, x1, y1, x2, y2, K_klip, box, templatecube, C, TC = 0
         n.update({Klip:noise_floor})
         pickle.dump(n,open(path+'NoiseFloors'+filesuffix+'.pkl','wb'))
 
-def get_phoenix_model(model, wavelength_lim = None, DF = -8.0):
+def get_phoenix_model(model, wavelength_lim = None, DF = -8.0, use_cache = True):
     ''' Open *.7 spectral file from https://phoenix.ens-lyon.fr/Grids/.  Explanataion of file
     at https://phoenix.ens-lyon.fr/Grids/FORMAT
     
@@ -2451,18 +4080,17 @@ def get_phoenix_model(model, wavelength_lim = None, DF = -8.0):
         wavelength_lim (flt): cut off wavelength in Ang at red end
         DF (flt): DF value for converting model to Ergs/sec/cm**2/A, from the "format" page.  DF=-8.0 for
             modern models
+        use_cache (bool): if True, use the binary cache of the parsed file made by load_phoenix_spectrum
     Returns:
         pd datafram with columns 'Wavelength','Flux','BBFlux'; flux, BBflux in Ergs/sec/cm**2/A, wavelength in Ang
         
     '''
-    t = pd.read_table(model, delim_whitespace=True, usecols=[0,1,2], skiprows=50000,
-                     names=['Wavelength','Flux','BBFlux'])
-    # convert from IDL double float precision to Python-ese:
-    t['BBFlux'] = t['BBFlux'].str.replace('D','e')
-    t['Flux'] = t['Flux'].str.replace('D','e')
-    # Convert string to float and add DF:
-    t['Flux'] = t['Flux'].astype(float) + DF
-    t['BBFlux'] = t['BBFlux'].astype(float) + DF
+    # parsed columns are cached in binary form alongside the model file:
+    data = load_phoenix_spectrum(model, use_cache = use_cache)
+    t = pd.DataFrame(data, columns = ['Wavelength','Flux','BBFlux'])
+    # add DF:
+    t['Flux'] = t['Flux'] + DF
+    t['BBFlux'] = t['BBFlux'] + DF
     # sort dataframe by wavelength in case it is not sorted:
     t = t.sort_values(by=['Wavelength'])
     # convert wavelength to microns:
@@ -2475,218 +4103,964 @@ def get_phoenix_model(model, wavelength_lim = None, DF = -8.0):
         t = t.loc[0:lim]
     return t
 
-def GetMassLimits(path,reloadA,reloadB,m,models,spt,k,distance,age, interpflux = [], filesuffix = '', constraint = '3.9',\
-                    isochrone_set = 'BTSettl'):
-    d = distance
-    ############# Filter zero point fluxes: ###################
-    # the wavelengths of the filter bands:
-    wavelengths = np.array([1.24,1.65,2.2,3.35,4.6]) #microns
-    # Filter zero points:
-    # 2MASS:
-    f0J = ( 1594*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.235 * u.um)),
-           27.8*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.235 * u.um)) )
-    f0H = ( 1024*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.662 * u.um)),
-           20.0*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.662 * u.um)) )
-    f0K = ( 666.7*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(2.159 * u.um)),
-           12.6*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(2.159 * u.um)) )
-    # WISE:
-    f0335 = 309.540 #Jy
-    f0335 = f0335*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(3.35 * u.um))
-    f046 = 171.787 # Jy
-    f046 = f046*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(4.6 * u.um))
-    #put in array:
-    f0 = np.array([f0J[0],f0H[0],f0K[0],f0335,f046])
-    
-    ############# Convert app mags to fluxes: ###################
-    # convert m to fluxes in those filters:
-    fluxes = f0*10**(-m/2.5)
-    
-    ############# Interpolate to 3.9 microns flux using models: ###################
-    if np.size(interpflux) == 0:
-        interpflux = np.zeros(len(models))
-        for i in range(len(models)):
-            r = fits.open('../model_spectra/'+models[i])
-            data = r[1].data
-            ind = np.where((data['WAVELENGTH'] < 33500.1) & (data['WAVELENGTH'] > 33400) )[0]
-            try:
-                ind = ind[-1]
-            except:
-                pass
-            scale_factor = fluxes[3]/(data['FLUX'][ind])
-            scaledflux = data['FLUX']*scale_factor
-            ind2 = np.where((data['WAVELENGTH'] < 39000.1) & (data['WAVELENGTH'] > 38950) )[0]
-            try:
-                ind2 = ind2[-1]
-            except:
-                pass
-            interpflux[i] = scaledflux[ind2]
-    
-    ############# Compute primary's true flux: ##################
-    primary_true_flux = np.mean(interpflux) # in physical units ergs s^-1 cm^-2 Ang^-1
-    primary_true_flux_err = np.std(interpflux)
-    
-    ############# Convert to apparent magnitude: #############
-    # open Vega's model:
-    model = 'alpha_lyr_mod_004.fits'
-    r = fits.open('../model_spectra/'+model)
-    data = r[1].data
-    ind = np.where((data['WAVELENGTH'] < 39000.1) & (data['WAVELENGTH'] > 38950) )[0]
-    f_vega = data['FLUX'][ind]
-    primary_app_mag = -2.5*np.log10(primary_true_flux/f_vega)[0]
-    
-    ############# Compute contrast of A relative to B in images: ############
-    fivesigmacontrast = reloadA.fivesigmacontrast
-    sep = reloadA.resep_au
-    from cliotools.bditools import contrast
-    cont = np.zeros(len(k))
-    for i in range(len(k)):
-        image = fits.getdata(k['filename'][i])
-        if len(image.shape) == 2:
-            cont[i] = contrast(image,image,[k['xca'][i],k['yca'][i]],[k['xcb'][i],k['ycb'][i]])
-        elif len(image.shape) == 3:
-            cont[i] = contrast(image[0],image[0],[k['xca'][i],k['yca'][i]],[k['xcb'][i],k['ycb'][i]])
+################## Model spectra and filter curves ###################################
+# Packaged CLIO filter curves in cliotools/clio_filters_v3: band name -> file.  Wavelengths are
+# in microns except H_filter.csv, which is in nm.
+_clio_filters = {
+    '3.9':'3.9um_Clio.dat.txt', 'Lprime':'barr_mko_l.filter.txt', 'Ks':'barr_ks.filter.txt', 
+    'M':'barr_m.filter.txt', 'MKO_H':'barr_mko_h.filter.txt', 'H':'H_filter.csv', 
+    '3to5':'janos_3to5.filter.txt', 'ocli_M':'ocli_m.filter.txt', 'x0047':'x0047.filter.txt'
+}
 
-    ABcontrast = np.mean(cont)
-    
-    ############# Apparent mag os object at the 5 sigma contrast limit for star A: ################
-    fivesigmacontrastA = fivesigmacontrast
-    fivesigma_app_mag = primary_app_mag + fivesigmacontrastA
-    
-    ########## Convert to absolute mag: ################
-    fivesigma_abs_Mag = fivesigma_app_mag - 5*np.log10(d[0]) + 5
-    
-    ########## load BT Settl grids #####################
-    # Load BT Settl grids:
-    if isochrone_set == 'BTSettl':
-        file = os.path.join(os.path.dirname(__file__), 'isochrones/bt-settl_cifist2011_2015_mko_isochrones_plus_clio.csv')
-        #file = os.path.join(os.path.dirname(__file__), 'isochrones/model.BT-Settl.MKO.txt')
-        f = pd.read_csv(file)
-        #f = pd.read_table(file,header=3,delim_whitespace=True)
-        BTmass = f['M_Msun'].values
-        BTage = f['age_Gyr'].values
-        if constraint == "Lprime":
-            BTMag = f["Lprime"].values
-        elif constraint == "3.9":
-            BTMag = f["clio_3.9"].values
-    elif isochrone_set == 'bobcat':
-        file = os.path.join(os.path.dirname(__file__), 'isochrones/bobcat_mags.csv')
-        f = pd.read_csv(file)
-        BTmass = f['mass_Msun'].values
-        BTage = (10**f['log_age_yr'].values)*u.yr.to(u.Gyr)
-        if constraint == "Lprime":
-            BTMag = f["mag_Lprime"].values
-        elif constraint == "3.9":
-            BTMag = f["mag_clio3_95"].values
-    
-    ########### Interpolate mass for age and L' mag: ###################
-    from scipy.interpolate import griddata
-    import pickle
+def load_clio_filter(band):
+    ''' Load a packaged CLIO filter transmission curve
 
-    BTagearray = np.random.normal(age[0],age[1],100000)
+    Parameters:
+    -----------
+    band : str
+        filter name, one of the keys of _clio_filters
 
-    # For each abs magnitude value:
-    fivesigma_mass_limit = np.zeros(len(fivesigma_abs_Mag))
-    for i in range(len(fivesigma_abs_Mag)):
-        # Generate an array of L' values around the mag value with error
-        # (a placeholder for now, I haven't computed error accurately)
-        BTMagarray = np.random.normal(fivesigma_abs_Mag[i],0.1,100000)
-        # interpolate masses from a grid of ages and L' mag:
-        BTmassarray = griddata((BTage, BTMag),BTmass, (BTagearray, BTMagarray), method='linear')
-        fivesigma_mass_limit[i] = np.nanmedian(BTmassarray)
+    Returns:
+    --------
+    arr
+        wavelength in Angstroms, increasing
+    arr
+        transmission, from 0 to 1
+    '''
+    if band not in _clio_filters:
+        raise ValueError('band must be one of '+', '.join(_clio_filters.keys()))
+    file = os.path.join(os.path.dirname(__file__), 'clio_filters_v3', _clio_filters[band])
+    if file.endswith('.csv'):
+        f = pd.read_csv(file, encoding = 'utf-8-sig')
+        wavelength, transmission = f.iloc[:,0].values * 10., f.iloc[:,1].values / 100.
+    else:
+        f = np.loadtxt(file, comments = '#')
+        wavelength, transmission = f[:,0] * 1e4, f[:,1]
+        # the Barr and janos curves are in percent:
+        if np.max(transmission) > 1.5:
+            transmission = transmission / 100.
+    order = np.argsort(wavelength)
+    return wavelength[order], np.clip(transmission[order], 0, None)
+
+class SyntheticPhotometry(object):
+    def __init__(self, bands = None):
+        ''' Band-integrated synthetic photometry through the packaged CLIO filter curves.  Filter curves
+        are loaded once; for each model wavelength grid the filters are resampled into a matrix of 
+        integration weights (cached per grid), so that many spectra through many filters are integrated
+        with one matrix product.  Band fluxes are photon-weighted mean flux densities,
+        int(F T lambda dlambda) / int(T lambda dlambda), using the trapezoid rule on the model grid.
 
-    pickle.dump(fivesigma_mass_limit, open(path+'StarA_fivesigma_mass_limit_Kklip'+str(reloadA.K_klip)+filesuffix+'.pkl','wb'))
-    
-    ############## Repeat for B ##########################
-    fivesigmacontrast = reloadB.fivesigmacontrast
-    fivesigmacontrastB = fivesigmacontrast + ABcontrast
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas
+
+        Attributes:
+        -----------
+        bands : list
+            filters to use.  Default = all packaged CLIO filters
+        filters : dict
+            wavelength (Angstroms) and transmission of each filter
+        '''
+        if bands is None:
+            bands = list(_clio_filters.keys())
+        self.bands = list(bands)
+        self.filters = {band:load_clio_filter(band) for band in self.bands}
+        self._weights = {}
+
+    def Weights(self, wavelength):
+        ''' Integration weight matrix of shape (n_bands, n_wavelength) for a wavelength grid in 
+            Angstroms, increasing.  Band fluxes are np.dot(flux, Weights.T).
+        '''
+        wavelength = np.asarray(wavelength, dtype = float)
+        key = (len(wavelength), wavelength[0], wavelength[-1], hash(wavelength.tobytes()))
+        if key not in self._weights:
+            # trapezoid rule weight of each sample:
+            dw = np.zeros(len(wavelength))
+            dw[:-1] += 0.5*np.diff(wavelength)
+            dw[1:] += 0.5*np.diff(wavelength)
+            W = np.zeros((len(self.bands), len(wavelength)))
+            for j, band in enumerate(self.bands):
+                fw, ft = self.filters[band]
+                W[j] = np.interp(wavelength, fw, ft, left = 0, right = 0) * wavelength * dw
+                if np.sum(W[j]) > 0:
+                    W[j] /= np.sum(W[j])
+                else:
+                    # filter doesn't overlap the grid:
+                    W[j] = np.nan
+            self._weights[key] = W
+        return self._weights[key]
+
+    def Integrate(self, wavelength, fluxes):
+        ''' Flux of each spectrum through each filter
+
+        Parameters:
+        -----------
+        wavelength : arr
+            shared wavelength grid of the spectra in Angstroms, increasing
+        fluxes : 1d or 2d arr
+            one spectrum or (n_spectra, n_wavelength) spectra
+
+        Returns:
+        --------
+        arr
+            band fluxes, shape (n_bands,) or (n_spectra, n_bands), in the order of self.bands
+        '''
+        return np.dot(fluxes, self.Weights(wavelength).T)
+
+    def IntegrateMany(self, spectra):
+        ''' Band fluxes for a list of (wavelength, flux) spectra that may be on different grids.  
+            Spectra sharing a grid are integrated together.
+
+        Returns:
+        --------
+        Pandas array
+            band fluxes, one row per spectrum and one column per band
+        '''
+        out = np.zeros((len(spectra), len(self.bands)))
+        groups = {}
+        for i, (wavelength, flux) in enumerate(spectra):
+            wavelength = np.asarray(wavelength, dtype = float)
+            groups.setdefault((len(wavelength), hash(wavelength.tobytes())), []).append(i)
+        for index in groups.values():
+            wavelength = np.asarray(spectra[index[0]][0], dtype = float)
+            out[index] = self.Integrate(wavelength, np.array([spectra[i][1] for i in index]))
+        return pd.DataFrame(out, columns = self.bands)
+
+_synthetic_photometry = {}
+
+def get_synthetic_photometry(bands = None):
+    ''' Return a shared SyntheticPhotometry engine for a set of bands, creating it on first use.
+    '''
+    key = None if bands is None else tuple(bands)
+    if key not in _synthetic_photometry:
+        _synthetic_photometry[key] = SyntheticPhotometry(bands)
+    return _synthetic_photometry[key]
+
+def load_phoenix_spectrum(model, skiprows = 50000, use_cache = True):
+    ''' Read the wavelength, flux, and blackbody flux columns of a PHOENIX *.7 spectral file, in
+        file order and before the DF offset is applied.  The parsed columns are cached in binary form
+        as model+'.npy' and reused while the cache is newer than the model file.
+
+    Parameters:
+    -----------
+    model : str
+        path to model file
+    skiprows : int
+        number of leading rows to skip.  Default = 50000
+    use_cache : bool
+        if True, read and write the binary cache.  Default = True
+
+    Returns:
+    --------
+    arr
+        (n, 3) array of wavelength, flux, and blackbody flux
+    '''
+    import io
+    cachefile = model + '.npy'
+    if use_cache and os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(model):
+        return np.load(cachefile)
+    with open(model) as f:
+        for i in range(skiprows):
+            next(f)
+        # convert from IDL double float precision to Python-ese:
+        text = f.read().replace('D','e')
+    data = pd.read_csv(io.StringIO(text), sep = r'\s+', usecols = [0,1,2], header = None).values.astype(float)
+    if use_cache:
+        try:
+            np.save(cachefile, data)
+        except OSError:
+            pass
+    return data
+
+class SpectralLibrary(object):
+    def __init__(self, directory = '../model_spectra/', bands = ['3.9', 'Lprime'], tablefile = 'spectral_library.csv'):
+        ''' Fluxes of fits model spectra (such as the stellar models used for primary photometry in
+        GetMassLimits) computed once and kept in a table.  Each spectrum is read once and sorted by 
+        wavelength, so single wavelength samples are found with a binary search, and flux through 
+        the packaged CLIO filter curves is integrated once per model.  The table is persisted in the 
+        model directory so later targets and sessions only look values up.  It stores the bands and the
+        modification time of each model file: a saved table with other bands is discarded, and a model
+        whose file has changed since its row was computed is recomputed.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas, astropy
+
+        Attributes:
+        -----------
+        directory : str
+            folder containing the model spectra fits files, with 'WAVELENGTH' (Angstroms) and 'FLUX' columns.
+            A relative path is resolved once, against the working directory when the library is made
+        bands : list
+            CLIO filters to compute band fluxes through
+        tablefile : str
+            name of the flux table within directory.  Default = 'spectral_library.csv'
+        table : Pandas array
+            flux table indexed by model name, with the model file modification time in column 'mtime'
+        '''
+        self.directory = os.path.abspath(directory)
+        self.bands = list(bands)
+        self.tablefile = os.path.join(self.directory, tablefile)
+        self.photometry = get_synthetic_photometry(self.bands)
+        self._spectra = {}
+        columns = ['mtime', 'flux_3.35um', 'flux_3.9um', 'vega_flux_3.9um'] + ['band_'+band for band in self.bands]
+        self.table = pd.DataFrame(columns = columns)
+        if os.path.exists(self.tablefile):
+            table = pd.read_csv(self.tablefile, index_col = 0)
+            # only reuse a table made for the same bands:
+            if list(table.columns) == columns:
+                self.table = table
+
+    def ModelTime(self, model):
+        ''' Modification time of a model file
+        '''
+        return os.path.getmtime(os.path.join(self.directory, model))
+
+    def Spectrum(self, model):
+        ''' Wavelength and flux of a model spectrum, sorted by wavelength.  Read from disk on first use,
+        and again if the file has changed.
+        '''
+        if model not in self._spectra or self._spectra[model][0] != self.ModelTime(model):
+            with fits.open(os.path.join(self.directory, model)) as r:
+                data = r[1].data
+                wavelength = np.array(data['WAVELENGTH'], dtype = float)
+                flux = np.array(data['FLUX'], dtype = float)
+            order = np.argsort(wavelength, kind = 'stable')
+            self._spectra[model] = (self.ModelTime(model), wavelength[order], flux[order])
+        return self._spectra[model][1:]
+
+    def FluxAt(self, model, low, high, which = 'last'):
+        ''' Flux of the first or last model sample with low < wavelength < high
+
+        Parameters:
+        -----------
+        model : str
+            model spectrum file name
+        low, high : flt
+            wavelength window in Angstroms
+        which : str
+            'first' or 'last' sample in the window.  Default = 'last'
+
+        Returns:
+        --------
+        flt
+            flux, nan if there is no sample in the window
+        '''
+        wavelength, flux = self.Spectrum(model)
+        if which == 'last':
+            i = np.searchsorted(wavelength, high, side = 'left') - 1
+        else:
+            i = np.searchsorted(wavelength, low, side = 'right')
+        if i < 0 or i >= len(wavelength) or not (low < wavelength[i] < high):
+            return np.nan
+        return flux[i]
+
+    def BandFluxes(self, model):
+        ''' Photon-weighted mean flux density of a model through each CLIO filter in bands, 
+            int(F T lambda dlambda) / int(T lambda dlambda)
+        '''
+        wavelength, flux = self.Spectrum(model)
+        return self.photometry.Integrate(wavelength, flux)
+
+    def Fluxes(self, model, save = True):
+        ''' Row of the flux table for one model, computing it if the model isn't in the table yet or 
+        its file has changed since.
+
+        Returns:
+        --------
+        Pandas series
+            flux at 3.35um, 3.9um (same samples as used in GetMassLimits), the first 3.9um sample 
+            (as used for Vega in GetMassLimits), and flux through each band
+        '''
+        mtime = self.ModelTime(model)
+        # (to the ms, as the time is saved in text)
+        if model not in self.table.index or not np.isclose(self.table.loc[model, 'mtime'], mtime, rtol = 0, atol = 1e-3):
+            row = [mtime, self.FluxAt(model, 33400, 33500.1), self.FluxAt(model, 38950, 39000.1), 
+                   self.FluxAt(model, 38950, 39000.1, which = 'first')]
+            row += list(self.BandFluxes(model))
+            self.table.loc[model] = row
+            if save:
+                from cliotools.catalog import _write_atomic
+                try:
+                    _write_atomic(self.table, self.tablefile)
+                except OSError:
+                    pass
+        return self.table.loc[model].drop('mtime').astype(float)
+
+_spectral_libraries = {}
+
+def get_spectral_library(directory = '../model_spectra/'):
+    ''' Return the shared SpectralLibrary for a model spectra folder, creating it on first use.
+    '''
+    directory = os.path.abspath(directory)
+    if directory not in _spectral_libraries:
+        _spectral_libraries[directory] = SpectralLibrary(directory)
+    return _spectral_libraries[directory]
+
+################## Isochrone registry ###################################
+def cache_directory(subdirectory = ''):
+    ''' Per-user cache folder for cliotools: $CLIOTOOLS_CACHE if set, else $XDG_CACHE_HOME/cliotools
+        or ~/.cache/cliotools, created if needed.
+    '''
+    base = os.environ.get('CLIOTOOLS_CACHE') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'cliotools')
+    directory = os.path.join(base, subdirectory)
+    os.makedirs(directory, exist_ok = True)
+    return directory
+
+def _savez_atomic(filename, data):
+    ''' np.savez to a temporary file in the same folder, then os.replace it into place, so other 
+        processes never load a partly written cache
+    '''
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(filename) or '.', prefix = '.tmp_', suffix = '.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# Packaged isochrone tables: file in cliotools/isochrones, age and mass columns, and the 
+# magnitude column for each band.
+_isochrone_sources = {
+    'BTSettl': {'file':'bt-settl_cifist2011_2015_mko_isochrones_plus_clio.csv', 'age':'age_Gyr', 'mass':'M_Msun',
+                'bands':{'J':'J', 'H':'H', 'Ks':'Ks', 'Lprime':'Lprime', 'Mprime':'Mprime', '3.9':'clio_3.9',
+                         'new_Lprime':'new_Lprime'}},
+    'bobcat': {'file':'bobcat_mags.csv', 'age':'log_age_yr', 'mass':'mass_Msun',
+               'bands':{'Lprime':'mag_Lprime', '3.9':'mag_clio3_95'}},
+    'BTSettl_MKO': {'file':'model.BT-Settl.MKO.txt', 'age':'age_Gyr', 'mass':'M_Msun',
+                    'bands':{'J':'J', 'H':'H', 'Ks':'Ks', 'Lprime':'Lprime', 'Mprime':"M'"}}
+}
+
+def _read_isochrone_source(isochrone_set):
+    ''' Parse a packaged isochrone table into a pandas dataframe
+    '''
+    file = os.path.join(os.path.dirname(__file__), 'isochrones', _isochrone_sources[isochrone_set]['file'])
+    if file.endswith('.csv'):
+        return pd.read_csv(file)
+    # Allard model.* files: '#' comment block, a header line, then whitespace delimited rows:
+    with open(file) as f:
+        lines = [line.split() for line in f if line.strip() and not line.startswith('#')]
+    return pd.DataFrame(np.array(lines[1:], dtype = float), columns = lines[0])
+
+class Isochrones(object):
+    def __init__(self, isochrone_set = 'BTSettl', cachefile = None):
+        ''' One packaged isochrone table.  The table is converted once to a numpy .npz cache in the 
+        user cache folder (see cache_directory), holding the age, mass, and magnitude columns for every band plus, for tables 
+        on a grid of ages, per-age mass and magnitude columns sorted by mass with magnitude forced to be
+        monotonic.  Nothing is read until the table is first used, and the cache is rebuilt if the 
+        source file is newer.  Use get_isochrones() to share one instance per set.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas
+
+        Attributes:
+        -----------
+        isochrone_set : str
+            'BTSettl', 'bobcat', or 'BTSettl_MKO'
+        cachefile : str
+            optional location of the .npz cache.  Default = cache_directory('isochrones')
+        bands : list
+            bands available in the table
+        '''
+        if isochrone_set not in _isochrone_sources:
+            raise ValueError('isochrone_set must be one of '+', '.join(_isochrone_sources.keys()))
+        self.isochrone_set = isochrone_set
+        self.source = _isochrone_sources[isochrone_set]
+        self.sourcefile = os.path.join(os.path.dirname(__file__), 'isochrones', self.source['file'])
+        if cachefile is None:
+            cachefile = os.path.splitext(self.source['file'])[0] + '.npz'
+            try:
+                cachefile = os.path.join(cache_directory('isochrones'), cachefile)
+            except OSError:
+                # no writable cache folder, Build will keep the arrays in memory:
+                pass
+        self.cachefile = cachefile
+        self.bands = list(self.source['bands'].keys())
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.Load()
+        return self._data
+
+    def Load(self):
+        ''' Load the .npz cache, building it first if it is missing or older than the source table
+        '''
+        if not os.path.exists(self.cachefile) or os.path.getmtime(self.cachefile) < os.path.getmtime(self.sourcefile):
+            self.Build()
+        else:
+            with np.load(self.cachefile) as f:
+                self._data = dict(f)
+
+    def Build(self):
+        ''' Convert the source table to arrays and write the .npz cache atomically.  If the cache 
+        can't be written the arrays are kept in memory only, with a warning.
+        '''
+        f = _read_isochrone_source(self.isochrone_set)
+        age = f[self.source['age']].values.astype(float)
+        if self.source['age'] == 'log_age_yr':
+            age = 10**age / 1e9
+        data = {'age':age, 'mass':f[self.source['mass']].values.astype(float)}
+        for band, column in self.source['bands'].items():
+            data['mag_'+band] = f[column].values.astype(float)
+        # Per-age columns for tables computed on a grid of ages:
+        ages = np.unique(age)
+        if len(ages) < len(age) / 3:
+            rows = [np.where(age == a)[0] for a in ages]
+            rows = [r[np.argsort(data['mass'][r])] for r in rows]
+            n = np.max([len(r) for r in rows])
+            data['grid_ages'] = ages
+            data['grid_mass'] = np.full((len(ages), n), np.nan)
+            for band in self.bands:
+                data['grid_mag_'+band] = np.full((len(ages), n), np.nan)
+            for i, r in enumerate(rows):
+                data['grid_mass'][i,:len(r)] = data['mass'][r]
+                for band in self.bands:
+                    # brighter with increasing mass:
+                    data['grid_mag_'+band][i,:len(r)] = np.minimum.accumulate(data['mag_'+band][r])
+        try:
+            _savez_atomic(self.cachefile, data)
+        except OSError as e:
+            import warnings
+            warnings.warn('Isochrones: could not write cache '+self.cachefile+' ('+str(e)+'), keeping '
+                          +self.isochrone_set+' in memory only')
+        self._data = data
+
+    def Table(self, band):
+        ''' Age (Gyr), absolute magnitude, and mass columns for one band
+        '''
+        if band not in self.bands:
+            raise ValueError('band must be one of '+', '.join(self.bands))
+        return self.data['age'], self.data['mag_'+band], self.data['mass']
+
+    def MassAtAge(self, age, mag, band):
+        ''' Mass at each (age, mag) by interpolating in magnitude along the two bracketing isochrones 
+        and linearly in log age between them.  Only for tables on a grid of ages.  Points outside the 
+        table are nan.
+
+        Parameters:
+        -----------
+        age : arr
+            age in Gyr
+        mag : arr
+            absolute magnitude
+        band : str
+            band of mag
+
+        Returns:
+        --------
+        arr
+            mass in solar masses
+        '''
+        if 'grid_ages' not in self.data:
+            raise ValueError(self.isochrone_set+' is not computed on a grid of ages')
+        if band not in self.bands:
+            raise ValueError('band must be one of '+', '.join(self.bands))
+        age, mag = np.broadcast_arrays(np.asarray(age, dtype = float), np.asarray(mag, dtype = float))
+        logages = np.log10(self.data['grid_ages'])
+        grid_mass, grid_mag = self.data['grid_mass'], self.data['grid_mag_'+band]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            logage = np.log10(age)
+        j = np.clip(np.searchsorted(logages, logage) - 1, 0, len(logages)-2)
+        t = (logage - logages[j]) / (logages[j+1] - logages[j])
+        mass = np.full(age.shape, np.nan)
+        for jj in np.unique(j[(t >= 0) & (t <= 1)]):
+            here = (j == jj) & (t >= 0) & (t <= 1)
+            m = []
+            for row in [jj, jj+1]:
+                good = np.isfinite(grid_mag[row])
+                # magnitude decreases with mass, so reverse for np.interp:
+                m.append(np.interp(mag[here], grid_mag[row][good][::-1], grid_mass[row][good][::-1], 
+                                   left = np.nan, right = np.nan))
+            mass[here] = (1-t[here])*m[0] + t[here]*m[1]
+        return mass
+
+_isochrone_registry = {}
+
+def get_isochrones(isochrone_set = 'BTSettl'):
+    ''' Return the shared Isochrones table for an isochrone set, creating it on first use.
+    '''
+    if isochrone_set not in _isochrone_registry:
+        _isochrone_registry[isochrone_set] = Isochrones(isochrone_set)
+    return _isochrone_registry[isochrone_set]
+
+def load_isochrone_table(isochrone_set = 'BTSettl', constraint = '3.9'):
+    ''' Age, absolute magnitude, and mass columns of a packaged isochrone table, read from 
+        the isochrone registry
+
+    Parameters:
+    -----------
+    isochrone_set : str
+        'BTSettl', 'bobcat', or 'BTSettl_MKO'.  Default = 'BTSettl'
+    constraint : str
+        band, for example "Lprime" or "3.9".  Default = "3.9"
+
+    Returns:
+    --------
+    arr
+        age in Gyr
+    arr
+        absolute magnitude in the band
+    arr
+        mass in solar masses
+    '''
+    return get_isochrones(isochrone_set).Table(constraint)
+
+class IsochroneInterpolator(object):
+    def __init__(self, age, mag, mass, nage = 400, nmag = 1000):
+        ''' Interpolate mass from age and absolute magnitude on an isochrone table.  The table is 
+        triangulated once (the same linear interpolation as scipy.interpolate.griddata) and resampled 
+        onto a regular grid in (log age, mag) so that large Monte Carlo draws can be evaluated with a 
+        fast bilinear lookup.  The bilinear lookup approximates the triangulated interpolation inside 
+        the table; points in grid cells that cross the edge of the table (where a cell corner is nan) 
+        are evaluated with the triangulated interpolation, so no valid area near the edge is lost.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, scipy
+
+        Attributes:
+        -----------
+        age, mag, mass : arr
+            isochrone table columns; age in Gyr, absolute magnitude, mass
+        nage, nmag : int
+            number of points in the regular grid along log age and magnitude.  Defaults = 400, 1000
+        '''
+        from scipy.interpolate import LinearNDInterpolator
+        self.linear = LinearNDInterpolator((age, mag), mass)
+        self.logage_grid = np.linspace(np.log10(np.min(age)), np.log10(np.max(age)), nage)
+        self.mag_grid = np.linspace(np.min(mag), np.max(mag), nmag)
+        A, M = np.meshgrid(10**self.logage_grid, self.mag_grid, indexing = 'ij')
+        self.mass_grid = self.linear(A, M)
+
+    def __call__(self, age, mag, method = 'grid'):
+        ''' Mass at each (age, mag).  Points outside the table are nan.
+
+        Parameters:
+        -----------
+        age : arr
+            age in Gyr
+        mag : arr
+            absolute magnitude
+        method : str
+            'grid' for bilinear lookup on the regular grid (triangulated interpolation in cells at 
+            the edge of the table), or 'linear' for the triangulated interpolation everywhere.  
+            Default = 'grid'
+
+        Returns:
+        --------
+        arr
+            mass in solar masses
+        '''
+        if method == 'linear':
+            return self.linear(age, mag)
+        # fractional grid index; kept in the input shapes so a shared age draw is only transformed once:
+        nage, nmag = self.mass_grid.shape
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            fa = (np.log10(np.asarray(age, dtype = float)) - self.logage_grid[0]) / (self.logage_grid[1] - self.logage_grid[0])
+        fm = (np.asarray(mag, dtype = float) - self.mag_grid[0]) / (self.mag_grid[1] - self.mag_grid[0])
+        # points outside the grid get nan age weights, which carry through to the mass:
+        fa = np.where((fa >= 0) & (fa <= nage-1), fa, np.nan)
+        outside_mag = (fm < 0) | (fm > nmag-1)
+        ia = np.clip(np.nan_to_num(fa), 0, nage-2).astype(int)
+        im = np.clip(fm, 0, nmag-2).astype(int)
+        ta, tm = fa - ia, fm - im
+        index = ia*nmag + im
+        g = self.mass_grid.ravel()
+        g00, g10, g01, g11 = g[index], g[index+nmag], g[index+1], g[index+nmag+1]
+        mass = g00 + ta*(g10 - g00) + tm*(g01 - g00) + ta*tm*(g11 - g10 - g01 + g00)
+        mass = np.where(outside_mag, np.nan, mass)
+        # cells crossing the edge of the table have a nan corner; evaluate those points exactly:
+        edge = np.isnan(mass) & ~outside_mag & np.isfinite(fa)
+        if np.any(edge):
+            age, mag = np.broadcast_arrays(age, mag)
+            mass[edge] = self.linear(age[edge], mag[edge])
+        return mass
+
+_isochrone_interpolators = {}
+
+def get_isochrone_interpolator(isochrone_set = 'BTSettl', constraint = '3.9'):
+    ''' Return the IsochroneInterpolator for an isochrone set and band, building it on first 
+        use and reusing it afterwards.
+
+    Parameters:
+    -----------
+    isochrone_set : str
+        'BTSettl' or 'bobcat'.  Default = 'BTSettl'
+    constraint : str
+        band, either "Lprime" or "3.9".  Default = "3.9"
+
+    Returns:
+    --------
+    IsochroneInterpolator
+    '''
+    key = (isochrone_set, constraint)
+    if key not in _isochrone_interpolators:
+        _isochrone_interpolators[key] = IsochroneInterpolator(*load_isochrone_table(isochrone_set, constraint))
+    return _isochrone_interpolators[key]
+
+def mass_limits_mc(abs_mags, age, interp = None, mag_err = 0.1, nsamples = 100000, percentiles = [16, 84],
+                   rng = None, adaptive = False, batch = 10000, rtol = 1e-3, chunksize = 50):
+    ''' Monte Carlo propagation of absolute magnitude limits at every separation to mass limits in one call.
+        One age draw is shared by all separations and the interpolator is evaluated on (n_sep x n_samples) 
+        blocks, chunksize separations at a time to bound memory.
+
+    Parameters:
+    -----------
+    abs_mags : arr
+        absolute magnitude limit at each separation
+    age : arr
+        [age, age uncertainty] in Gyr
+    interp : callable
+        interp(age, mag) returning mass, such as an IsochroneInterpolator.  Default = BT-Settl 3.9um
+    mag_err : flt
+        uncertainty on the magnitude limits.  Default = 0.1
+    nsamples : int
+        number of samples, or the maximum number if adaptive.  Default = 100000
+    percentiles : list
+        percentiles to return as uncertainty bands.  Default = [16, 84]
+    rng : None, int, or numpy Generator
+        random generator or seed for reproducible draws.  Default = None
+    adaptive : bool
+        if True, draw batch samples at a time and stop when the median mass at every separation
+        changes by less than rtol.  Default = False
+    batch : int
+        samples per batch if adaptive.  Default = 10000
+    rtol : flt
+        relative tolerance on the median for convergence if adaptive.  Default = 1e-3
+    chunksize : int
+        number of separations evaluated at once.  Default = 50
+
+    Returns:
+    --------
+    arr
+        median mass at each separation
+    arr
+        mass at each percentile, shape (len(percentiles), n_sep)
+    arr
+        number of samples used at each separation
+    '''
+    import warnings
+    if interp is None:
+        interp = get_isochrone_interpolator()
+    rng = np.random.default_rng(rng)
+    abs_mags = np.atleast_1d(abs_mags)
+    ages = rng.normal(age[0], age[1], nsamples)
+    step = batch if adaptive else nsamples
+    median = np.full(len(abs_mags), np.nan)
+    bands = np.full((len(percentiles), len(abs_mags)), np.nan)
+    nused = np.zeros(len(abs_mags), dtype = int)
+    with warnings.catch_warnings():
+        # separations beyond the isochrone grid are all nan:
+        warnings.simplefilter('ignore', category = RuntimeWarning)
+        for start in range(0, len(abs_mags), chunksize):
+            mags = abs_mags[start:start+chunksize]
+            masses, last = [], None
+            for b in range(0, nsamples, step):
+                a = ages[b:b+step]
+                magarray = mags[:,np.newaxis] + mag_err*rng.standard_normal((len(mags), len(a)))
+                masses.append(interp(a[np.newaxis,:], magarray))
+                if adaptive:
+                    current = np.nanmedian(np.concatenate(masses, axis = 1), axis = 1)
+                    if last is not None and np.all(np.isclose(current, last, rtol = rtol, atol = 0, equal_nan = True)):
+                        break
+                    last = current
+            masses = np.concatenate(masses, axis = 1)
+            median[start:start+chunksize] = np.nanmedian(masses, axis = 1)
+            bands[:,start:start+chunksize] = np.nanpercentile(masses, percentiles, axis = 1)
+            nused[start:start+chunksize] = masses.shape[1]
+    return median, bands, nused
+
+def GetMassLimits(path,reloadA,reloadB,m,models,spt,k,distance,age, interpflux = [], filesuffix = '', constraint = '3.9',\
+                    isochrone_set = 'BTSettl', phot = None, nsamples = 100000, percentiles = [16, 84], rng = None,
+                    adaptive = False, model_dir = '../model_spectra/', band_integrated = False):
+    d = distance
+    ############# Filter zero point fluxes: ###################
+    # the wavelengths of the filter bands:
+    wavelengths = np.array([1.24,1.65,2.2,3.35,4.6]) #microns
+    # Filter zero points:
+    # 2MASS:
+    f0J = ( 1594*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.235 * u.um)),
+           27.8*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.235 * u.um)) )
+    f0H = ( 1024*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.662 * u.um)),
+           20.0*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(1.662 * u.um)) )
+    f0K = ( 666.7*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(2.159 * u.um)),
+           12.6*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(2.159 * u.um)) )
+    # WISE:
+    f0335 = 309.540 #Jy
+    f0335 = f0335*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(3.35 * u.um))
+    f046 = 171.787 # Jy
+    f046 = f046*u.Jy.to(u.erg / u.s / u.cm**2 / u.AA, equivalencies=u.spectral_density(4.6 * u.um))
+    #put in array:
+    f0 = np.array([f0J[0],f0H[0],f0K[0],f0335,f046])
+    
+    ############# Convert app mags to fluxes: ###################
+    # convert m to fluxes in those filters:
+    fluxes = f0*10**(-m/2.5)
+    
+    ############# Interpolate to 3.9 microns flux using models: ###################
+    # model fluxes are read once per model and kept in the spectral library table:
+    library = get_spectral_library(model_dir)
+    column_39 = 'band_3.9' if band_integrated else 'flux_3.9um'
+    if np.size(interpflux) == 0:
+        interpflux = np.zeros(len(models))
+        for i in range(len(models)):
+            f = library.Fluxes(models[i])
+            # scale the model to the measured 3.35um flux and take the 3.9um flux, either the single
+            # model sample or integrated through the CLIO 3.9um filter:
+            scale_factor = fluxes[3]/f['flux_3.35um']
+            interpflux[i] = f[column_39]*scale_factor
+    
+    ############# Compute primary's true flux: ##################
+    primary_true_flux = np.mean(interpflux) # in physical units ergs s^-1 cm^-2 Ang^-1
+    primary_true_flux_err = np.std(interpflux)
+    
+    ############# Convert to apparent magnitude: #############
+    # Vega's model:
+    f_vega = library.Fluxes('alpha_lyr_mod_004.fits')['band_3.9' if band_integrated else 'vega_flux_3.9um']
+    primary_app_mag = -2.5*np.log10(primary_true_flux/f_vega)
+    
+    ############# Compute contrast of A relative to B in images: ############
+    fivesigmacontrast = reloadA.fivesigmacontrast
+    sep = reloadA.resep_au
+    # read from the dataset photometry table, measuring only frames not already in it:
+    if phot is None:
+        phot = PhotometryTable(k, path or None)
+    cont = phot.ABContrast()
+
+    ABcontrast = np.mean(cont)
+    
+    ############# Apparent mag os object at the 5 sigma contrast limit for star A: ################
+    fivesigmacontrastA = fivesigmacontrast
+    fivesigma_app_mag = primary_app_mag + fivesigmacontrastA
+    
+    ########## Convert to absolute mag: ################
+    fivesigma_abs_Mag = fivesigma_app_mag - 5*np.log10(d[0]) + 5
+    
+    ########## Isochrone interpolator for this set and band, built once and reused: ##########
+    interp = get_isochrone_interpolator(isochrone_set, constraint)
+    
+    ########### Interpolate mass for age and L' mag: ###################
+    import pickle
+
+    # Propagate to mass at every separation at once, sharing one age draw:
+    rng = np.random.default_rng(rng)
+    fivesigma_mass_limit, bands, nused = mass_limits_mc(fivesigma_abs_Mag, age, interp = interp, nsamples = nsamples,
+                                                        percentiles = percentiles, rng = rng, adaptive = adaptive)
+
+    pickle.dump(fivesigma_mass_limit, open(path+'StarA_fivesigma_mass_limit_Kklip'+str(reloadA.K_klip)+filesuffix+'.pkl','wb'))
+    pickle.dump(bands, open(path+'StarA_fivesigma_mass_limit_bands_Kklip'+str(reloadA.K_klip)+filesuffix+'.pkl','wb'))
+    
+    ############## Repeat for B ##########################
+    fivesigmacontrast = reloadB.fivesigmacontrast
+    fivesigmacontrastB = fivesigmacontrast + ABcontrast
     # The apparent magnitude of an object at the 5 sigma constrast limit around B:
     fivesigma_app_mag = primary_app_mag + fivesigmacontrastB
     # distance modulus:
     fivesigma_abs_Mag = fivesigma_app_mag - 5*np.log10(d[0]) + 5
     
     # Interpolate masses:
-    BTagearray = np.random.normal(age[0],age[1],100000)
-    # For each abs magnitude value:
-    fivesigma_mass_limit = np.zeros(len(fivesigma_abs_Mag))
-    for i in range(len(fivesigma_abs_Mag)):
-        # Generate an array of L' values around the mag value with error
-        # (a placeholder for now, I haven't computed error accurately)
-        BTMagarray = np.random.normal(fivesigma_abs_Mag[i],0.1,100000)
-        # interpolate masses from a grid of ages and L' mag:
-        BTmassarray = griddata((BTage, BTMag),BTmass, (BTagearray, BTMagarray), method='linear')
-        fivesigma_mass_limit[i] = np.nanmedian(BTmassarray)
+    fivesigma_mass_limit, bands, nused = mass_limits_mc(fivesigma_abs_Mag, age, interp = interp, nsamples = nsamples,
+                                                        percentiles = percentiles, rng = rng, adaptive = adaptive)
     pickle.dump(fivesigma_mass_limit, open(path+'StarB_fivesigma_mass_limit_Kklip'+str(reloadB.K_klip)+filesuffix+'.pkl','wb'))
+    pickle.dump(bands, open(path+'StarB_fivesigma_mass_limit_bands_Kklip'+str(reloadB.K_klip)+filesuffix+'.pkl','wb'))
+
+
+###################### System parameters ###################################
+# Column types of the per-target system parameters table.  'pair' columns are (value, error) tuples, 
+# 'array' columns are numpy arrays.
+_system_parameters_schema = {
+    'box':int, 'StarName':str, 'distance':'pair', 'sep':'array', 'C':'array', 'K_klipA':int, 'K_klipB':int,
+    'today':str, 'filesuffix':str, 'mass_limit_filesuffix':str, 'binary_sep':float, 'obs_dm':float,
+    'Nimages':int, 'contA':float, 'contB':float, 'ao_modes':float, 'humidity':float, 'seeing':float,
+    'obs_date':float, 'massA':'pair', 'massB':'pair', 'age':float, 'sourceidA':int, 'sourceidB':int,
+    'Gmag':float, 'J':float, 'H':float, 'K':float, 'WISE1':float, 'WISE2':float,
+    'MGmag':float, 'MJ':float, 'MH':float, 'MK':float, 'MWISE1':float, 'MWISE2':float,
+    'GaiaBP_A':float, 'GaiaRP_A':float, 'GaiaBP-RP_A':float, 'MGaiaBP_A':float, 'MGaiaRP_A':float,
+    'GaiaBP_B':float, 'GaiaRP_B':float, 'GaiaBP-RP_B':float, 'MGaiaBP_B':float, 'MGaiaRP_B':float,
+    'Zs':'array', 'Rs':'array'
+}
+# Parameters every target needs to reload its contrast curves and mass limits:
+_system_parameters_required = ['box', 'StarName', 'distance', 'sep', 'C', 'K_klipA', 'K_klipB', 
+                               'today', 'filesuffix', 'mass_limit_filesuffix']
+_system_parameters = {}
+
+class SystemParameters(object):
+    def __init__(self, file = None, table = None):
+        ''' Per-target system parameters table indexed by dataset path, validated against
+        _system_parameters_schema.  Replaces looking up string-concatenated keys 
+        (sp[path+'box']) in the pickled system-parameters dictionary.
 
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas
 
-def load_masslimits(path):
-    sp = pickle.load(open('/Users/loganpearce/Dropbox/Uarizona/research/bdi/system-parameters.pkl','rb'))
-    box = sp[path+'box']
-    distance = sp[path+'distance']
-    d = distance
-    sep = sp[path+'sep']
-    C = sp[path+'C']
-    K_klipA = sp[path+'K_klipA']
-    K_klipB = sp[path+'K_klipB']
-    filesuffix = sp[path+'filesuffix'] 
-    mass_limit_filesuffix = sp[path+'mass_limit_filesuffix']
-    today = sp[path+'today']
-    inner_mask = 1.0
-    Stars = ['A','B']
-    
-    from cliotools.bdi import ContrastCurve
-    from cliotools.bditools import lod_to_pixels
-    inner_mask = lod_to_pixels(inner_mask, 3.9)
-    astamp = fits.getdata(path+'acube_box'+str(box)+'_bpf'+filesuffix+'.fits')
-    bstamp = fits.getdata(path+'bcube_box'+str(box)+'_bpf'+filesuffix+'.fits')
-    outer_mask = box
-    Star = Stars[0]
-    K_klip = K_klipA
-    reloadA = ContrastCurve(path, Star, K_klip, sep, C, 
-                        sciencecube = astamp,
-                        refcube = bstamp,
-                        templatecube = astamp)
+        Attributes:
+        -----------
+        file : str
+            pickle of either the legacy {path+key:value} dictionary or a saved table.  Default = 
+            the system-parameters.pkl shipped with cliotools
+        table : pandas DataFrame
+            one row per target, indexed by path (with trailing '/'), one column per parameter.  If 
+            supplied, file is not read.
+
+        Examples:
+        ---------
+        sp = get_system_parameters()
+        sp['HD36705/']['box']
+        sp.Get('HD36705', 'distance')
+        '''
+        if file is None:
+            file = os.path.join(os.path.dirname(__file__),'system-parameters.pkl')
+        self.file = file
+        if table is None:
+            table = self.Load(file)
+        self.table = self.Validate(table)
+
+    @staticmethod
+    def FromDict(sp):
+        ''' Convert the legacy {path+key:value} dictionary into a table
+        '''
+        if 'paths' in sp:
+            paths = list(sp['paths'])
+        else:
+            paths = list(dict.fromkeys(key.rsplit('/',1)[0]+'/' for key in sp))
+        rows = {path:{} for path in paths}
+        for key, value in sp.items():
+            if key == 'paths':
+                continue
+            path, name = key.rsplit('/',1)
+            rows.setdefault(path+'/', {})[name] = value
+        table = pd.DataFrame.from_dict(rows, orient = 'index')
+        table.index.name = 'path'
+        return table
+
+    def Load(self, file):
+        ''' Read a pickled legacy dictionary or table
+        '''
+        sp = pickle.load(open(file,'rb'))
+        if isinstance(sp, pd.DataFrame):
+            return sp
+        return self.FromDict(sp)
+
+    @staticmethod
+    def Validate(table):
+        ''' Check required parameters are present and coerce every column to its schema type
+        '''
+        missing = [name for name in _system_parameters_required if name not in table.columns]
+        if missing:
+            raise ValueError('System parameters missing required columns: '+', '.join(missing))
+        table = table.copy()
+        table.index = [path if path.endswith('/') else path+'/' for path in table.index]
+        table.index.name = 'path'
+        for name, kind in _system_parameters_schema.items():
+            if name not in table.columns:
+                continue
+            values = table[name]
+            null = values.isna() if kind not in ['pair','array'] else values.apply(lambda v: v is None)
+            if name in _system_parameters_required and np.any(null):
+                raise ValueError('System parameter '+name+' missing for '+', '.join(table.index[null]))
+            try:
+                if kind == 'pair':
+                    table[name] = [None if v is None else (float(v[0]), float(v[1])) for v in values]
+                elif kind == 'array':
+                    table[name] = [None if v is None else np.asarray(v) for v in values]
+                elif kind == str:
+                    table[name] = values.astype(object).where(null, values.astype(str))
+                elif kind == int and not np.any(null):
+                    table[name] = values.astype(np.int64)
+                else:
+                    table[name] = values.astype(float)
+            except (TypeError, ValueError, IndexError):
+                raise ValueError('System parameter '+name+' does not match schema type '+str(kind))
+        return table
 
-    reloadA.LoadResults(path+'Star'+Star+'_ContrastCurvesSNRs'+\
-                                today+'Kklip'+str(int(K_klip))+'.innermask'+str(int(inner_mask))+\
-                                '.outermask'+str(int(outer_mask))+filesuffix+'.pkl')
+    def Save(self, file):
+        ''' Pickle the validated table
+        '''
+        pickle.dump(self.table, open(file,'wb'))
 
-    reloadA.Compute5SigmaContrast(sep_in_au = True, distance = d)
-    reloadA.fivesigma_mass_limit = pickle.load(open(path+'Star'+Star+\
-                                                           '_fivesigma_mass_limit_Kklip'+str(reloadA.K_klip)+\
-                                mass_limit_filesuffix+'.pkl','rb'))
+    @property
+    def paths(self):
+        return list(self.table.index)
 
-    Star = Stars[1]
-    K_klip = K_klipB
-    reloadB = ContrastCurve(path, Star, K_klip, sep, C, 
-                        sciencecube = astamp,
-                        refcube = bstamp,
-                        templatecube = astamp)
+    def __len__(self):
+        return len(self.table)
 
-    reloadB.LoadResults(path+'Star'+Star+'_ContrastCurvesSNRs'+\
-                                today+'Kklip'+str(int(K_klip))+'.innermask'+str(int(inner_mask))+\
-                                '.outermask'+str(int(outer_mask))+filesuffix+'.pkl')
+    def __contains__(self, path):
+        return (path if path.endswith('/') else path+'/') in self.table.index
 
-    reloadB.Compute5SigmaContrast(sep_in_au = True, distance = d)
-    reloadB.fivesigma_mass_limit = pickle.load(open(path+'Star'+Star+\
-                                                           '_fivesigma_mass_limit_Kklip'+str(reloadB.K_klip)+\
-                                mass_limit_filesuffix+'.pkl','rb'))
-    return reloadA,reloadB
+    def __getitem__(self, path):
+        ''' All parameters of one target as a pandas Series
+        '''
+        path = path if path.endswith('/') else path+'/'
+        if path not in self.table.index:
+            raise ValueError('No system parameters for '+path)
+        return self.table.loc[path]
+
+    def Get(self, path, name):
+        ''' A single parameter of one target
+        '''
+        return self[path][name]
+
+    def Mass(self, path, Star):
+        ''' Host star mass in Msun
+        '''
+        return self.Get(path, 'mass'+Star)[0]
+
+def get_system_parameters(sp = None):
+    ''' Return a SystemParameters store, loading each file once per process and reloading only if 
+        it changes on disk.
 
+    Parameters:
+    -----------
+    sp : None, str, dict, or SystemParameters
+        None for the store shipped with cliotools; a filename; a legacy {path+key:value} 
+        dictionary; or an existing store, which is returned as is.
 
-def load_masslimits(path):
-    import os
-    file = os.path.join(os.path.dirname(__file__),'system-parameters.pkl')
-    sp = pickle.load(open(file,'rb'))
-    box = sp[path+'box']
-    distance = sp[path+'distance']
+    Returns:
+    --------
+    SystemParameters object
+    '''
+    if isinstance(sp, SystemParameters):
+        return sp
+    if isinstance(sp, dict):
+        return SystemParameters(table = SystemParameters.FromDict(sp))
+    if sp is None:
+        sp = os.path.join(os.path.dirname(__file__),'system-parameters.pkl')
+    key = os.path.abspath(sp)
+    mtime = os.path.getmtime(key)
+    if key not in _system_parameters or _system_parameters[key][0] != mtime:
+        _system_parameters[key] = (mtime, SystemParameters(file = key))
+    return _system_parameters[key][1]
+
+def load_masslimits(path, sp = None):
+    ''' Reload both stars' contrast curves and five-sigma mass limits
+
+    Parameters:
+    -----------
+    path : str
+        dataset path, as indexed in the system parameters
+    sp : None, str, dict, or SystemParameters
+        system parameters store, see get_system_parameters.  Default = None, the store shipped 
+        with cliotools
+
+    Returns:
+    --------
+    ContrastCurve objects for star A and star B
+    '''
+    params = get_system_parameters(sp)[path]
+    box = params['box']
+    distance = params['distance']
     d = distance
-    sep = sp[path+'sep']
-    C = sp[path+'C']
-    K_klipA = sp[path+'K_klipA']
-    K_klipB = sp[path+'K_klipB']
-    filesuffix = sp[path+'filesuffix'] 
-    mass_limit_filesuffix = sp[path+'mass_limit_filesuffix']
-    today = sp[path+'today']
+    sep = params['sep']
+    C = params['C']
+    K_klipA = params['K_klipA']
+    K_klipB = params['K_klipB']
+    filesuffix = params['filesuffix']
+    mass_limit_filesuffix = params['mass_limit_filesuffix']
+    today = params['today']
     inner_mask = 1.0
     Stars = ['A','B']
     
@@ -2773,23 +5147,184 @@ def d2Ndmda_smooth(m,a, Mstar,
     
     return f * C1 * (m**alpha) * (a**beta) * ((Mstar/1.75)**gamma)
 
-def prob_of_detecting_substellar_companion_deprecated(path, Nsamples = 500000, dm = 0.1, savemaps = True):
+###################### Occurrence rates ###################################
+# Nielsen+2019 Eqn 7 hyperparameters, (mean, std), for giant planets (m <= 13 Mjup) and brown dwarfs.
+# f is in percent.
+_nielsen2019_hyperparameters = {
+    'planet': {'alpha':(-2.277,0.75), 'beta':(-1.68,0.55), 'gamma':(2.03,1.0), 'f':(3.5,1.6)},
+    'bd': {'alpha':(-0.47,1.25), 'beta':(-0.65,1.25), 'gamma':(-0.85,1.5), 'f':(0.8,0.5)}
+}
+
+def draw_nielsen2019_hyperparameters(nsamples, rng = None):
+    ''' Draw all Nielsen+2019 occurrence rate hyperparameter samples at once
+
+    Parameters:
+    -----------
+    nsamples : int
+        number of samples
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+
+    Returns:
+    --------
+    dict
+        {'planet':{'alpha','beta','gamma','f'}, 'bd':{...}} arrays of length nsamples, f as a fraction
+    '''
+    rng = np.random.default_rng(rng)
+    hp = {}
+    for regime, params in _nielsen2019_hyperparameters.items():
+        hp[regime] = {name:rng.normal(mean, std, nsamples) for name, (mean, std) in params.items()}
+        hp[regime]['f'] = hp[regime]['f'] / 100
+    return hp
+
+def d2Ndmda_samples(mass, sma, Mstar, nsamples = 100, m1 = 5, m2 = 81, a1 = 1, a2 = 100, 
+                    hyperparameters = None, rng = None):
+    ''' Nielsen+2019 Eqn 7 occurrence rate density for every hyperparameter sample over a full
+        mass x sma grid, evaluated with broadcasting.  Vectorized equivalent of calling d2Ndmda 
+        nsamples times per grid cell.
+
+    Parameters:
+    -----------
+    mass : 1d arr
+        companion masses in Mjup
+    sma : 1d arr
+        semi-major axes in AU
+    Mstar : flt
+        host star mass in Msun
+    nsamples : int
+        number of hyperparameter samples, if hyperparameters not supplied.  Default = 100
+    m1, m2, a1, a2 : flt
+        mass and sma range of the power law normalization
+    hyperparameters : dict
+        optional output of draw_nielsen2019_hyperparameters to reuse
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+
+    Returns:
+    --------
+    3d arr
+        occurrence rate density of shape (nsamples, len(sma), len(mass))
+    '''
+    if hyperparameters is None:
+        hyperparameters = draw_nielsen2019_hyperparameters(nsamples, rng = rng)
+    m = np.asarray(mass, dtype = float)[np.newaxis,np.newaxis,:]
+    a = np.asarray(sma, dtype = float)[np.newaxis,:,np.newaxis]
+    planet = m <= 13
+    pick = lambda name: np.where(planet, hyperparameters['planet'][name][:,np.newaxis,np.newaxis],
+                                 hyperparameters['bd'][name][:,np.newaxis,np.newaxis])
+    alpha, beta, gamma, f = pick('alpha'), pick('beta'), pick('gamma'), pick('f')
+    C1 = ( (alpha + 1) / (m1**(alpha+1) - m2**(alpha+1)) )
+    C1 = C1 * ( (beta + 1) / (a1**(beta+1) - a2**(beta+1)) )
+    return f * C1 * (m**alpha) * (a**beta) * ((Mstar/1.75)**gamma)
+
+def occurrence_rate_maps(mass, sma, Mstar, nsamples = 100, rng = None, chunksize = 100):
+    ''' Median and standard deviation of the Nielsen+2019 occurrence rate density over a 
+        mass x sma grid.  Hyperparameters are drawn once and shared by every cell; the grid is 
+        evaluated chunksize sma rows at a time to bound memory on dense grids.
+
+    Parameters:
+    -----------
+    mass : 1d arr
+        companion masses in Mjup
+    sma : 1d arr
+        semi-major axes in AU
+    Mstar : flt
+        host star mass in Msun
+    nsamples : int
+        number of hyperparameter samples.  Default = 100
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+    chunksize : int
+        number of sma rows evaluated at once.  Default = 100
+
+    Returns:
+    --------
+    2d arr
+        median occurrence rate density, shape (len(sma), len(mass))
+    2d arr
+        standard deviation
+    '''
+    hp = draw_nielsen2019_hyperparameters(nsamples, rng = rng)
+    sma = np.asarray(sma, dtype = float)
+    median = np.zeros((len(sma), len(mass)))
+    std = np.zeros((len(sma), len(mass)))
+    for start in range(0, len(sma), chunksize):
+        samples = d2Ndmda_samples(mass, sma[start:start+chunksize], Mstar, hyperparameters = hp)
+        median[start:start+chunksize] = np.median(samples, axis = 0)
+        std[start:start+chunksize] = np.std(samples, axis = 0)
+    return median, std
+
+def occurrence_pdf(distrib, mass, sma):
+    ''' Integrate an occurrence rate density map over its grid cells and normalize it to a PDF
+
+    Parameters:
+    -----------
+    distrib : 2d arr
+        occurrence rate density, shape (len(sma), len(mass)), e.g. from occurrence_rate_maps
+    mass, sma : 1d arr
+        evenly spaced grid of masses and semi-major axes
+
+    Returns:
+    --------
+    2d arr
+        PDF over grid cells
+    flt
+        total occurrence rate over the grid
+    '''
+    dm = (np.max(mass) - np.min(mass)) / len(mass)
+    da = (np.max(sma) - np.min(sma)) / len(sma)
+    cells = distrib * dm * da
+    return cells / np.sum(cells), np.sum(cells)
+
+def sample_occurrence(pdf, mass, sma, N, joint = False, rng = None):
+    ''' Draw companion masses and semi-major axes from an occurrence PDF
+
+    Parameters:
+    -----------
+    pdf : 2d arr
+        PDF of shape (len(sma), len(mass)) from occurrence_pdf
+    mass, sma : 1d arr
+        grid of masses and semi-major axes
+    N : int
+        number of samples
+    joint : bool
+        if True, draw (mass, sma) pairs from the joint PDF; otherwise draw independently from the
+        1D marginals.  Default = False
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+
+    Returns:
+    --------
+    arr
+        masses
+    arr
+        semi-major axes
+    '''
+    rng = np.random.default_rng(rng)
+    mass, sma = np.asarray(mass), np.asarray(sma)
+    if joint:
+        index = rng.choice(pdf.size, size = N, p = pdf.ravel())
+        return mass[index % len(mass)], sma[index // len(mass)]
+    mass_marginal = np.sum(pdf, axis = 0)
+    sma_marginal = np.sum(pdf, axis = 1)
+    return rng.choice(mass, size = N, p = mass_marginal), rng.choice(sma, size = N, p = sma_marginal)
+
+def prob_of_detecting_substellar_companion_deprecated(path, Nsamples = 500000, dm = 0.1, savemaps = True, sp = None):
     ''' Using the occurence rates of Nielsen+2019, compute the percentage of
     substellar companions we would have detected around our star in our survey.
     '''
-    sp = pickle.load(open('/Users/loganpearce/Dropbox/Uarizona/research/bdi/system-parameters.pkl','rb'))
+    params = get_system_parameters(sp)[path]
     colors = np.array(['#8531E6','#E66550', '#F5B92B','#8531E6','#E66550', 
                        '#F5B92B','#8531E6','#E66550', '#F5B92B'])
     linestyles = np.array(['-','-','-','-.','-.','-.',':',':',':'])
     import matplotlib.colors as colorz
     from scipy import interpolate
-    from myastrotools.orbittools import draw_orbits, keplersconstant, keplerian_to_cartesian
     
     # Load survey mass limits:
-    MstarA = sp[path+'massA']
-    MstarB = sp[path+'massB']
-    StarName = sp[path+'StarName']
-    reloadA,reloadB = load_masslimits(path)
+    MstarA = params['massA']
+    MstarB = params['massB']
+    StarName = params['StarName']
+    reloadA,reloadB = load_masslimits(path, sp = sp)
     Stars = ['A','B']
     file = 'paper/detection_probability_maps/substellar-detection-results.txt'
     
@@ -2810,64 +5345,27 @@ def prob_of_detecting_substellar_companion_deprecated(path, Nsamples = 500000, d
             reload = reloadB
         
         ########## 1. Generate probability distribution function:
-        # Create array of companion masses in Nielsen+2019 regime
-        companion_mass_array = np.arange(5,81,1)
-        # Create array of semimajor axis:
-        sma_array = np.linspace(1, 100,len(companion_mass_array))
-        # create empty array:
-        distribution = np.zeros((sma_array.shape[0],companion_mass_array.shape[0], 100))
-        # for each mass bin:
-        for i,x in enumerate(companion_mass_array):
-            # for each sma bin:
-            for j,y in enumerate(sma_array):
-                # randomly draw from the power law parameters and Eqn 7 equation 100 times:
-                for k in range(100):
-                    distribution[j,i,k] = d2Ndmda(x,y,MstarA[0])
-        # Compute mean and std deviation:
-        distrib = np.median(distribution, axis = 2)
-        distrib_std = np.std(distribution, axis = 2)
-        # Integrate the distribution to get the total occurrence rate in the
-        # # 1-100AU, 5-80Mjup range:
-        dm = (80-5)/len(companion_mass_array)
-        da = (100-1)/len(sep_array)
-        distrib_final = distrib.T * dm * da
-        occurrence_rate = np.sum(distrib_final)
-        ##### Turn into a PDF:
-        # Resample onto more dense grid:
-        f = interpolate.interp2d(sep_array,companion_mass_array, distrib, kind='cubic')
-        dm = 0.1
+        # Evaluate the Nielsen+2019 occurrence rates for all hyperparameter samples directly on a
+        # dense grid of companion masses and semi-major axes:
         companion_mass_array_new = np.arange(5,81,dm)
         sma_array_new = np.linspace(1,100,len(companion_mass_array_new))
-        da = (100-1)/len(companion_mass_array_new)
-        distrib_new = f(sma_array_new,companion_mass_array_new)
-        distrib_final_new = distrib_new.T * dm * da
-        # Normalize to turn into a PDF:
-        pdf = distrib_final_new / (np.sum(distrib_final_new))
+        distrib_new, distrib_std = occurrence_rate_maps(companion_mass_array_new, sma_array_new, MstarA[0])
+        # Integrate the distribution to get the total occurrence rate in the
+        # 1-100AU, 5-80Mjup range, and normalize to turn into a PDF:
+        pdf, occurrence_rate = occurrence_pdf(distrib_new, companion_mass_array_new, sma_array_new)
 
         ########## 2. Monte Carlo a set of simulated observations and convert sma to project separation:
-        # Get 1D marginal probability distributions:
-        mass_marginal = np.array([np.sum(pdf[:,i]) for i in range(pdf.shape[0])])
-        sma_marginal = np.array([np.sum(pdf[i,:]) for i in range(pdf.shape[1])])
-        # Draw a set of random masses and smas weighted by PDF:
-        random_masses = np.random.choice(companion_mass_array_new,size = Nsamples, p = mass_marginal)
-        random_smas = np.random.choice(sma_array_new,size = Nsamples, p = sma_marginal)
-        # For each random sma, draw a random set of orbital elements:
-        sma, ecc, inc, argp, lon, orbit_fraction = draw_orbits(Nsamples)
-        lon = np.random.uniform(0.0,360.0,Nsamples)
-        kep = keplersconstant(MstarA[0]*u.Msun,1e-3*u.Msun)
-        meananom = 2*np.pi*orbit_fraction
-        pos, vel, acc = keplerian_to_cartesian(random_smas*u.AU,ecc,inc,argp,lon,meananom,kep)
-        # Project onto sky plane:
-        proj_sep = np.sqrt(pos[:,0]**2 + pos[:,1]**2).value
+        # Draw a set of random masses and smas from the 1D marginal probability distributions:
+        random_masses, random_smas = sample_occurrence(pdf, companion_mass_array_new, sma_array_new, Nsamples)
+        # For each random sma, draw a random set of orbital elements and project onto sky plane:
+        proj_sep = draw_projected_separations(random_smas)
         # Restrict to only companions within the survey separation range:
         ind = np.where(proj_sep <= np.max(reload.resep_au.value))
         proj_sep = proj_sep[ind]
         random_masses = random_masses[ind]
-        random_masses_smooth = random_masses_smooth[ind]
         ind = np.where(proj_sep > np.min(reload.resep_au.value))
         proj_sep = proj_sep[ind]
         random_masses = random_masses[ind]
-        random_masses_smooth = random_masses_smooth[ind]
         # Create a histogram:
         h, xedges, yedges = np.histogram2d(proj_sep,random_masses,bins=100)
         # Resample contrast limits onto same grid as histogram:
@@ -2892,70 +5390,376 @@ def prob_of_detecting_substellar_companion_deprecated(path, Nsamples = 500000, d
         # Multiply by occurrence rate to get total probability:
         detection_probability = Detection_percent * occurrence_rate
 
+###################### Orbit sampling ###################################
+def solve_kepler(M, e, niter = 6):
+    ''' Solve Kepler's equation M = E - e sin(E) for the eccentric anomaly E with a fixed number
+        of Newton iterations over arrays.
+
+    Parameters:
+    -----------
+    M : arr
+        mean anomaly in radians
+    e : arr
+        eccentricity
+    niter : int
+        number of Newton iterations.  Default = 6, which reaches machine precision for e <= 0.95
+
+    Returns:
+    --------
+    arr
+        eccentric anomaly in radians
+    '''
+    M = np.mod(M, 2*np.pi)
+    # Danby starting guess:
+    E = M + 0.85*e*np.sign(np.sin(M))
+    for i in range(niter):
+        E = E - (E - e*np.sin(E) - M) / (1 - e*np.cos(E))
+    return E
+
+def draw_orbits(N, EccNielsenPrior = True, rng = None):
+    ''' Draw random orbital elements: eccentricity, isotropic inclination, argument of periastron, 
+        longitude of node, and mean anomaly.
+
+    Parameters:
+    -----------
+    N : int
+        number of orbits
+    EccNielsenPrior : bool
+        if True, draw eccentricity from the Nielsen+2008 prior p(e) = 2.1 - 2.2e on [0,0.95], otherwise 
+        uniform on [0,0.95].  Default = True
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+
+    Returns:
+    --------
+    arr
+        eccentricity
+    arr
+        inclination in radians
+    arr
+        argument of periastron in radians
+    arr
+        longitude of node in radians
+    arr
+        mean anomaly in radians
+    '''
+    rng = np.random.default_rng(rng)
+    u = rng.uniform(0, 1, N)
+    if EccNielsenPrior:
+        # invert the CDF, (2.1e - 1.1e^2)/norm:
+        norm = 2.1*0.95 - 1.1*0.95**2
+        ecc = (2.1 - np.sqrt(2.1**2 - 4*1.1*u*norm)) / 2.2
+    else:
+        ecc = 0.95*u
+    inc = np.arccos(rng.uniform(-1, 1, N))
+    argp = rng.uniform(0, 2*np.pi, N)
+    lon = rng.uniform(0, 2*np.pi, N)
+    meananom = rng.uniform(0, 2*np.pi, N)
+    return ecc, inc, argp, lon, meananom
+
+def projected_separation(sma, ecc, inc, argp, meananom, niter = 6):
+    ''' Projected separation of a companion on the sky, in the units of sma.  The separation does 
+        not depend on the longitude of node or the masses.
+
+    Parameters:
+    -----------
+    sma : arr
+        semi-major axis
+    ecc, inc, argp, meananom : arr
+        eccentricity and inclination, argument of periastron, mean anomaly in radians
+    niter : int
+        number of Newton iterations for Kepler's equation.  Default = 6
+
+    Returns:
+    --------
+    arr
+        projected separation
+    '''
+    E = solve_kepler(meananom, ecc, niter = niter)
+    # position in the orbital plane, periastron along x:
+    x = sma*(np.cos(E) - ecc)
+    y = sma*np.sqrt(1 - ecc**2)*np.sin(E)
+    # rotate by argument of periastron and incline:
+    X = np.cos(argp)*x - np.sin(argp)*y
+    Y = (np.sin(argp)*x + np.cos(argp)*y)*np.cos(inc)
+    return np.sqrt(X**2 + Y**2)
+
+def draw_projected_separations(sma, EccNielsenPrior = True, rng = None):
+    ''' Projected separation for one random orbit at each semi-major axis, as a float array in the
+        units of sma.
+    '''
+    sma = np.asarray(sma, dtype = float)
+    ecc, inc, argp, lon, meananom = draw_orbits(sma.shape[0], EccNielsenPrior = EccNielsenPrior, rng = rng)
+    return projected_separation(sma, ecc, inc, argp, meananom)
+
 ###################### Completeness Maps ###################################
-def MakeMap(path, Star, Npoints = 100):
-    sp = pickle.load(open('system-parameters.pkl','rb'))
-    MstarA = sp[path+'massA']
-    MstarB = sp[path+'massB']
-    Stars = [MstarA,MstarB]
-    if Star == 'A':
-        j = 0
-    if Star == 'B':
-        j = 1
-    Star = Stars[j]
-    from cliotools.bditools import load_masslimits
-    MassLimits = load_masslimits(path)
-    MassLimit = MassLimits[j]
-    
+def _mass_limit_spline(resep_au, fivesigma_mass_limit):
+    ''' Lookup spline of mass limit vs separation, filling nan limits from the next separation out
+    '''
+    from scipy.interpolate import UnivariateSpline
+    limit = np.array(fivesigma_mass_limit, dtype = float)
+    if np.any(np.isnan(limit)):
+        ind = np.where(np.isnan(limit))[0]
+        limit[ind] = limit[ind+1]
+    return UnivariateSpline(np.array(getattr(resep_au, 'value', resep_au)), limit)
+
+def completeness_map(resep_au, fivesigma_mass_limit, Ntimes = 1000, Npoints = 100, 
+                     chunksize = 2000000, rng = None, verbose = False):
+    ''' Fraction of companions detected on a grid of companion mass and semi-major axis.  For every 
+        grid point Ntimes random orbits are drawn; a companion is detected if its projected separation
+        falls in the contrast curve separation range and its mass is above the mass limit there.
+        All orbits are drawn and compared as arrays, chunksize orbits at a time to bound memory.
+
+    Parameters:
+    -----------
+    resep_au : arr
+        separations of the mass limits in AU
+    fivesigma_mass_limit : arr
+        mass limit in Msun at each separation
+    Ntimes : int
+        number of orbits drawn per grid point.  Default = 1000
+    Npoints : int
+        number of grid points along mass and sma.  Default = 100
+    chunksize : int
+        approximate maximum number of orbits evaluated at once.  Default = 2e6
+    rng : None, int, or numpy Generator
+        random generator or seed for the orbit draws.  Default = None
+    verbose : bool
+        if True, display a progress bar.  Default = False
+
+    Returns:
+    --------
+    2d arr
+        fraction of companions detected at each grid point
+    2d arr
+        semi-major axis (AU) grid
+    2d arr
+        mass (Msun) grid
+    '''
+    Ntimes = int(Ntimes)
+    rng = np.random.default_rng(rng)
     # Generate mass and sma arrays:
     massArray = np.logspace(-3,0.01,Npoints)
     smaArray = np.logspace(0,3,Npoints)
     # Make a grid:
     sma,mass = np.meshgrid(smaArray, massArray)
-    
-    # for each grid point, generate a random set of orbital elements:
-    from myastrotools.tools import draw_orbits, keplersconstant, keplerian_to_cartesian
-    N = sma.flatten().shape[0]
-    sma_throwaway, ecc, inc, argp, lon, orbit_fraction = draw_orbits(N, EccNielsenPrior = True, draw_lon = False)
-    # compute projected separation:
-    kep = keplersconstant(Star[0]*u.Msun,mass.flatten()*u.Msun)
-    meananom = 2*np.pi*orbit_fraction
-    pos, vel, acc = keplerian_to_cartesian(sma.flatten()*u.AU,ecc,inc,argp,lon,meananom,kep)
-    r = np.sqrt(pos[:,0]**2 + pos[:,1]**2).value
-    # reshape onto grid:
-    projSep = np.reshape(r,sma.shape)
-    
+    sma_flat, mass_flat = sma.flatten(), mass.flatten()
     # Make mass limits into lookup spline:
-    from scipy.interpolate import UnivariateSpline
-    if np.any(np.isnan(MassLimit.fivesigma_mass_limit)):
-        ind = np.where(np.isnan(MassLimit.fivesigma_mass_limit))[0]
-        MassLimit.fivesigma_mass_limit[ind] = MassLimit.fivesigma_mass_limit[ind+1]
-        
-    MassLimitsSpline = UnivariateSpline(MassLimit.resep_au,MassLimit.fivesigma_mass_limit)
-    # Make a mask:
-    mask = np.zeros(sma.shape)
-    # Set the mask to 1 for all grid points within detection separation region:
-    ind = np.where((projSep <= np.max(MassLimit.resep_au.value)) & 
-                (projSep >= np.min(MassLimit.resep_au.value)))
-    mask[ind] = 1
-    # for each point in the detection region, look up the corresponding mass limit.
-    # If the mass is below the limit, set the mask value to zero (undetected):""
-    for p,m in zip(ind[0],ind[1]):
-        if mass[p,m] < MassLimitsSpline(projSep[p,m]):
-            mask[p,m] = 0
+    MassLimitsSpline = _mass_limit_spline(resep_au, fivesigma_mass_limit)
+    resep = np.array(getattr(resep_au, 'value', resep_au))
+    sepmin, sepmax = np.min(resep), np.max(resep)
+    # number of draws of the whole grid per chunk:
+    ntrials = np.max([1, chunksize // sma_flat.shape[0]])
+    detected = np.zeros(sma_flat.shape[0])
+    for start in range(0, Ntimes, ntrials):
+        n = np.min([ntrials, Ntimes - start])
+        chunk_sma, chunk_mass = np.tile(sma_flat, n), np.tile(mass_flat, n)
+        projSep = draw_projected_separations(chunk_sma, rng = rng)
+        # detectable if within the detection separation region and above the mass limit there:
+        inrange = np.where((projSep <= sepmax) & (projSep >= sepmin))[0]
+        mask = np.zeros(projSep.shape[0])
+        mask[inrange] = chunk_mass[inrange] >= MassLimitsSpline(projSep[inrange])
+        detected += mask.reshape(n, sma_flat.shape[0]).sum(axis = 0)
+        if verbose:
+            update_progress(start+n, Ntimes)
+    finalMap = np.reshape(detected, sma.shape) / Ntimes
+    return finalMap, sma, mass
+
+def _completeness_inputs(path, Star, sp = None):
+    ''' Mass limits for completeness maps, loaded once
+    '''
+    from cliotools.bditools import load_masslimits
+    j = {'A':0, 'B':1}[Star]
+    return load_masslimits(path, sp = sp)[j]
+
+def MakeMap(path, Star, Npoints = 100, sp = None):
+    ''' Single realization of the completeness map: 1 where a companion with a random orbit at 
+        that mass and sma would be detected, 0 otherwise.
+    '''
+    MassLimit = _completeness_inputs(path, Star, sp = sp)
+    mask, sma, mass = completeness_map(MassLimit.resep_au, MassLimit.fivesigma_mass_limit, 
+                                       Ntimes = 1, Npoints = Npoints)
     return mask, sma, mass
 
-def MakeCompletenessMap(path, Star, Ntimes = 1e3, Npoints = 100):
-    from myastrotools.tools import update_progress
-    Ntimes = int(Ntimes)
-    mapCube = np.zeros((Npoints,Npoints,Ntimes))
-    for i in range(Ntimes):
-        mask, sma, mass = MakeMap(path, Star, Npoints = Npoints)
-        mapCube[:,:,i] = mask
-        update_progress(i+1,Ntimes)
-        
-    finalMap = np.sum(mapCube,axis=2) / Ntimes
-    return finalMap, sma, mass
+def MakeCompletenessMap(path, Star, Ntimes = 1e3, Npoints = 100, chunksize = 2000000, rng = None, verbose = True,
+                        sp = None):
+    ''' Completeness map averaged over Ntimes random orbits per grid point.  System parameters 
+        and mass limits are loaded once, then all orbits are drawn with completeness_map.
+    '''
+    MassLimit = _completeness_inputs(path, Star, sp = sp)
+    return completeness_map(MassLimit.resep_au, MassLimit.fivesigma_mass_limit, 
+                            Ntimes = Ntimes, Npoints = Npoints, chunksize = chunksize, rng = rng, verbose = verbose)
+
+def _survey_target_completeness(path, Star, Ntimes, Npoints, chunksize, seed, sp = None):
+    ''' Completeness map of one survey target, run in a worker process
+    '''
+    MassLimit = _completeness_inputs(path, Star, sp = sp)
+    finalMap, sma, mass = completeness_map(MassLimit.resep_au, MassLimit.fivesigma_mass_limit, Ntimes = Ntimes, 
+                                           Npoints = Npoints, chunksize = chunksize, rng = seed)
+    return finalMap
+
+def completeness_yield(finalMap, sma, mass, Mstar, nsamples = 100, rng = None):
+    ''' Occurrence-weighted detection probability of a completeness map.  The Nielsen+2019 
+        occurrence rate density is evaluated on the map grid (restricted to its 5-80 Mjup, 
+        1-100 AU range) and integrated against the completeness.
+
+    Parameters:
+    -----------
+    finalMap : 2d arr
+        completeness map from completeness_map
+    sma, mass : 2d arr
+        semi-major axis (AU) and mass (Msun) grids from completeness_map
+    Mstar : flt
+        host star mass in Msun
+    nsamples : int
+        number of occurrence rate hyperparameter samples.  Default = 100
+    rng : None, int, or numpy Generator
+        random generator or seed.  Default = None
+
+    Returns:
+    --------
+    flt
+        expected number of detected companions
+    flt
+        occurrence-weighted completeness, i.e. probability of detecting a companion that exists
+    '''
+    smaArray, massArray = sma[0,:], mass[:,0]
+    massArray_mjup = (massArray*u.Msun).to(u.Mjup).value
+    median, std = occurrence_rate_maps(massArray_mjup, smaArray, Mstar, nsamples = nsamples, rng = rng)
+    # completeness maps are (mass, sma):
+    rate = median.T
+    inrange = (massArray_mjup >= 5)[:,np.newaxis] & (massArray_mjup <= 81)[:,np.newaxis] & \
+              (smaArray >= 1)[np.newaxis,:] & (smaArray <= 100)[np.newaxis,:]
+    cells = np.where(inrange, rate, 0) * np.gradient(massArray_mjup)[:,np.newaxis] * np.gradient(smaArray)[np.newaxis,:]
+    expected = np.sum(finalMap * cells)
+    return expected, expected / np.sum(cells)
+
+class SurveyCompleteness(object):
+    def __init__(self, targets, outdir = '', Ntimes = 1000, Npoints = 100, chunksize = 2000000, 
+                 ncores = 1, rng = None, nsamples = 100, prefix = 'survey_completeness', verbose = True, sp = None):
+        ''' Completeness maps for a table of survey targets.  Each target's map is computed in a 
+        process pool and streamed as it finishes into an on-disk stack, while the summed survey 
+        sensitivity map and a per-target detection-probability table are updated incrementally.
+
+        Written by Logan A. Pearce, 2020
+        Dependencies: numpy, pandas, astropy
+
+        Attributes:
+        -----------
+        targets : pandas DataFrame or list
+            table of targets with a 'path' column and optionally 'Star' (A or B; both stars are used 
+            if missing) and 'Mstar' (host mass in Msun, for expected yields).  A list of paths is 
+            also accepted.  Missing host masses are filled from the system parameters.
+        outdir : str
+            directory for the stack, summed map, and detection-probability table
+        Ntimes, Npoints, chunksize : int
+            completeness_map parameters
+        ncores : int
+            number of worker processes.  Default = 1
+        rng : None or int
+            seed; each target gets independent streams spawned from it for its completeness map 
+            and its occurrence-rate draws.  Default = None
+        nsamples : int
+            number of occurrence rate samples for the yields.  Default = 100
+        prefix : str
+            output filename prefix.  Default = 'survey_completeness'
+        sp : None, str, dict, or SystemParameters
+            system parameters store, see get_system_parameters.  Default = None
+        stack : numpy memmap
+            (ntargets, Npoints, Npoints) stack of completeness maps, written to outdir+prefix+'_stack.npy'
+        summed_map : 2d arr
+            sum of all finished target maps
+        table : pandas DataFrame
+            detection-probability table, appended to outdir+prefix+'_table.csv' as targets finish
+        sma, mass : 2d arr
+            semi-major axis (AU) and mass (Msun) grids
+        '''
+        if not isinstance(targets, pd.DataFrame):
+            targets = pd.DataFrame({'path':list(targets)})
+        if 'Star' not in targets.columns:
+            targets = pd.concat([targets.assign(Star = 'A'), targets.assign(Star = 'B')]).sort_index(kind = 'stable')
+        self.sp = get_system_parameters(sp)
+        # host masses from the system parameters where not given:
+        Mstar = [self.sp.Mass(t['path'], t['Star']) if t['path'] in self.sp else np.nan 
+                 for i, t in targets.iterrows()]
+        if 'Mstar' in targets.columns:
+            Mstar = np.where(np.isfinite(targets['Mstar'].astype(float)), targets['Mstar'], Mstar)
+        targets = targets.assign(Mstar = np.array(Mstar, dtype = float))
+        self.targets = targets.reset_index(drop = True)
+        self.outdir = outdir
+        self.Ntimes = int(Ntimes)
+        self.Npoints = Npoints
+        self.chunksize = chunksize
+        self.ncores = ncores
+        self.rng = rng
+        self.nsamples = nsamples
+        self.prefix = prefix
+        self.verbose = verbose
+        self.stackfile = os.path.join(outdir, prefix+'_stack.npy')
+        self.summedfile = os.path.join(outdir, prefix+'_summed.npy')
+        self.tablefile = os.path.join(outdir, prefix+'_table.csv')
+        # grids are shared by every target:
+        massArray = np.logspace(-3,0.01,Npoints)
+        smaArray = np.logspace(0,3,Npoints)
+        self.sma, self.mass = np.meshgrid(smaArray, massArray)
+
+    def _Add(self, i, finalMap):
+        ''' Stream one finished target into the stack, summed map and table
+        '''
+        target = self.targets.iloc[i]
+        self.stack[i] = finalMap
+        self.stack.flush()
+        self.summed_map += finalMap
+        self.done[i] = True
+        row = {'path':target['path'], 'Star':target['Star'], 'index':i, 
+               'mean_completeness':np.mean(finalMap), 'expected_detections':np.nan, 
+               'detection_probability':np.nan}
+        if np.isfinite(target['Mstar']):
+            row['expected_detections'], row['detection_probability'] = completeness_yield(finalMap, self.sma, 
+                                                                        self.mass, target['Mstar'], 
+                                                                        nsamples = self.nsamples, rng = self.seeds[i][1])
+        row = pd.DataFrame([row])
+        row.to_csv(self.tablefile, mode = 'a', header = not os.path.exists(self.tablefile), index = False)
+        self.table = pd.concat([self.table, row], ignore_index = True)
+
+    def Compute(self):
+        ''' Compute every target's completeness map and write the stack, summed map and table
+
+        Returns:
+        --------
+        2d arr
+            summed survey sensitivity map
+        pandas DataFrame
+            detection-probability table
+        '''
+        N = len(self.targets)
+        # one seed per target for the completeness map draws and one for the yield draws:
+        self.seeds = [seed.spawn(2) for seed in np.random.SeedSequence(self.rng).spawn(N)]
+        self.stack = np.lib.format.open_memmap(self.stackfile, mode = 'w+', dtype = float, 
+                                               shape = (N, self.Npoints, self.Npoints))
+        self.summed_map = np.zeros((self.Npoints, self.Npoints))
+        self.done = np.zeros(N, dtype = bool)
+        self.table = pd.DataFrame()
+        if os.path.exists(self.tablefile):
+            os.remove(self.tablefile)
+        args = [(t['path'], t['Star'], self.Ntimes, self.Npoints, self.chunksize, self.seeds[i][0], self.sp) 
+                for i, t in self.targets.iterrows()]
+        if self.ncores > 1:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers = self.ncores) as executor:
+                futures = {executor.submit(_survey_target_completeness, *a):i for i, a in enumerate(args)}
+                for f in as_completed(futures):
+                    self._Add(futures[f], f.result())
+                    if self.verbose:
+                        update_progress(np.sum(self.done), N)
+        else:
+            for i, a in enumerate(args):
+                self._Add(i, _survey_target_completeness(*a))
+                if self.verbose:
+                    update_progress(i+1, N)
+        np.save(self.summedfile, self.summed_map)
+        self.table = self.table.sort_values('index').reset_index(drop = True)
+        return self.summed_map, self.table
 
 def MakeCompletenessPlot(finalMap, sma, mass, StarName, Star, PlotDir = 'paper/completeness_maps/'):
     from scipy.ndimage.filters import gaussian_filter
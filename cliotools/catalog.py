@@ -0,0 +1,189 @@
+import numpy as np
+from astropy.io import fits
+import os
+import fnmatch
+import pandas as pd
+
+################################ Dataset file catalog ##################################################
+# Finding the images of a dataset used to be done by writing the output of 'ls' to a file called 'list' #
+# in the working directory, which was slow and clobbered by concurrent runs in the same directory.      #
+# Directory listings are now scanned once with os.scandir and kept for as long as the directory is     #
+# unchanged, and header info (beam, coadds, cube depth) for each file is kept in a catalog file in the  #
+# dataset directory so headers are only read when a file is new or has changed.  The catalog file is    #
+# replaced atomically so many processes can share it.                                                 #
+
+# Directory listings keyed by absolute path: (directory mtime, {name: (size, mtime)})
+_listings = {}
+# Catalogs keyed by absolute path of the catalog file: (catalog file mtime, DataFrame)
+_catalogs = {}
+# Header keywords kept in the catalog:
+_catalog_keys = ['BEAM', 'COADDS', 'NAXIS3']
+_catalog_file = '.cliotools_catalog.csv'
+
+def scan_directory(directory):
+    ''' Files in a directory with their size and modification time, scanned with os.scandir
+        and cached until the directory changes.
+
+    Parameters:
+    -----------
+    directory : str
+        path to directory
+
+    Returns:
+    --------
+    dict
+        {name: (size in bytes, modification time in ns)} for every file in the directory
+    '''
+    directory = directory or '.'
+    key = os.path.abspath(directory)
+    mtime = os.stat(directory).st_mtime_ns
+    if key not in _listings or _listings[key][0] != mtime:
+        entries = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        _listings[key] = (mtime, entries)
+    return _listings[key][1]
+
+def dataset_files(path, pattern = '*.fit'):
+    ''' Sorted list of files matching path+pattern, the equivalent of 'ls path+pattern'.  The
+        wildcards may only be in the filename part.
+
+    Parameters:
+    -----------
+    path : str
+        path to the dataset directory, optionally followed by the start of the filenames,
+        ex: 'BDI0933/' or 'BDI0933/BDI0933sky_'
+    pattern : str
+        shell-style wildcard pattern for the rest of the filename.  Default = '*.fit'
+
+    Returns:
+    --------
+    list
+        paths to matching files, in the same form as ls would print them
+    '''
+    directory, name_pattern = os.path.split(path + pattern)
+    names = scan_directory(directory)
+    # As ls, wildcards don't match hidden files (such as the catalog file):
+    hidden = name_pattern.startswith('.')
+    return [os.path.join(directory, name) for name in sorted(names) 
+            if fnmatch.fnmatchcase(name, name_pattern) and (hidden or not name.startswith('.'))]
+
+def _load_catalog(catfile):
+    ''' The catalog stored in catfile, cached until the file changes; empty if it doesn't exist
+        or can't be read
+    '''
+    key = os.path.abspath(catfile)
+    try:
+        mtime = os.stat(catfile).st_mtime_ns
+    except OSError:
+        return pd.DataFrame(columns = ['size', 'mtime'] + _catalog_keys)
+    if key not in _catalogs or _catalogs[key][0] != mtime:
+        try:
+            table = pd.read_csv(catfile, index_col = 'name')
+        except Exception:
+            table = pd.DataFrame(columns = ['size', 'mtime'] + _catalog_keys)
+        _catalogs[key] = (mtime, table)
+    return _catalogs[key][1]
+
+def _write_atomic(table, filename):
+    ''' Write table to filename through a temporary file in the same directory and os.replace, so
+        readers never see a partly written file
+    '''
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(filename) or '.', prefix = '.tmp_', suffix = '.csv')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            table.to_csv(f, index_label = 'name')
+        os.replace(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _header_values(filename):
+    ''' Catalog header keywords of one file, nan where missing
+    '''
+    try:
+        hdr = fits.getheader(filename)
+    except Exception:
+        return [np.nan]*len(_catalog_keys)
+    return [hdr.get(key, np.nan) for key in _catalog_keys]
+
+def _directory_catalog(directory, names):
+    ''' Catalog entries for names in directory, reading headers only of files not already in
+        the catalog file or changed since
+    '''
+    directory = directory or '.'
+    catfile = os.path.join(directory, _catalog_file)
+    table = _load_catalog(catfile)
+    stale = []
+    for name in set(names):
+        stat = os.stat(os.path.join(directory, name))
+        if name not in table.index or table.loc[name, 'size'] != stat.st_size \
+                or table.loc[name, 'mtime'] != stat.st_mtime_ns:
+            stale.append((name, stat.st_size, stat.st_mtime_ns))
+    if len(stale) != 0:
+        new = pd.DataFrame([[size, mtime] + _header_values(os.path.join(directory, name)) for name, size, mtime in stale],
+                           index = [name for name, size, mtime in stale], columns = ['size', 'mtime'] + _catalog_keys)
+        # Merge with whatever is on disk now, in case another process has added to it:
+        current = _load_catalog(catfile)
+        table = pd.concat([current.drop(new.index, errors = 'ignore'), new])
+        try:
+            _write_atomic(table, catfile)
+            _catalogs[os.path.abspath(catfile)] = (os.stat(catfile).st_mtime_ns, table)
+        except OSError:
+            # read-only dataset, keep the catalog in memory only:
+            pass
+    return table.loc[list(names)]
+
+def file_headers(files):
+    ''' Beam, number of coadds and cube depth of each file from the dataset catalog, reading
+        headers only for files not seen before.
+
+    Parameters:
+    -----------
+    files : list
+        paths to image files
+
+    Returns:
+    --------
+    pandas DataFrame
+        filename, size, mtime, BEAM, COADDS, NAXIS3 for each file in order; nan for keywords
+        a header doesn't have
+    '''
+    files = list(files)
+    table = pd.DataFrame(index = range(len(files)), columns = ['size', 'mtime'] + _catalog_keys, dtype = float)
+    directories = [os.path.dirname(f) for f in files]
+    for directory in set(directories):
+        rows = [i for i in range(len(files)) if directories[i] == directory]
+        entries = _directory_catalog(directory, [os.path.basename(files[i]) for i in rows])
+        table.loc[rows] = entries.values.astype(float)
+    table.insert(0, 'filename', files)
+    return table
+
+def dataset_catalog(path, pattern = '*.fit'):
+    ''' Catalog of the files matching path+pattern with their header info, see dataset_files
+        and file_headers.
+
+    Parameters:
+    -----------
+    path : str
+        path to the dataset directory, optionally followed by the start of the filenames
+    pattern : str
+        shell-style wildcard pattern for the rest of the filename.  Default = '*.fit'
+
+    Returns:
+    --------
+    pandas DataFrame
+        filename, size, mtime, BEAM, COADDS, NAXIS3 for each file
+    '''
+    return file_headers(dataset_files(path, pattern))
+
+def read_list(filename = 'list'):
+    ''' Read a list of files made by the user, one path per line
+    '''
+    with open(filename) as f:
+        return f.read().splitlines()
@@ -2,6 +2,7 @@ import numpy as np
 from astropy.io import fits
 import os
 from cliotools.global_badpixfix import *
+from cliotools.catalog import dataset_files
 
 
 ##################### Bad pixel find and fix functions ###################
@@ -153,11 +154,8 @@ def build_raw_stack(k):
     return sky0_stack, sky1_stack, xca0, yca0, xcb0, ycb0, xca1, yca1, xcb1, ycb1
 
 def build_skyframe_stack(path, skip_list=False, K_klip = 10):
-    import os
-    os.system('ls '+path+'*sky_0* > list')
     print('Collecting sky images for',path.split('/')[0],'...')
-    with open('list') as f:
-        z = f.read().splitlines()
+    z = dataset_files(path, '*sky_0*')
     image = fits.getdata(z[0])
     shape = image.shape
     sky_stack = np.zeros((len(z),*shape))
@@ -173,7 +171,6 @@ def build_skyframe_stack(path, skip_list=False, K_klip = 10):
         sky_stack[count0,:,:] = image
         count0 += 1
     print('I found ',sky_stack.shape[0],' sky frames')
-    os.system('rm list')
     return sky_stack 
 
 def skysubbed_beam_count(k):
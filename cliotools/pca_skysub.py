@@ -2,6 +2,7 @@ import numpy as np
 from astropy.io import fits
 import os
 import pandas as pd
+from cliotools.catalog import dataset_files, file_headers, read_list
 
 def update_progress(n,max_value):
     import sys
@@ -103,10 +104,7 @@ def make_global_masks(path, shape, radius = 10, diffraction_spike_rotation_angle
     radius = lod_to_pixels(radius, 3.9)
     if len(imlist) == 0:
         # Make list of all fits images in folder:
-        os.system('ls '+path+'*0*.fit > list')
-        # Open the list:
-        with open('list') as f:
-            ims = f.read().splitlines()
+        ims = dataset_files(path, '*0*.fit')
     else:
         ims = imlist
 
@@ -167,15 +165,8 @@ def make_global_masks(path, shape, radius = 10, diffraction_spike_rotation_angle
 
 def beam_count(ims):
     '''Count the number of images in a dataset in each dither'''
-    from astropy.io import fits
-    count0, count1 = 0,0
-    for i in ims:
-        imhdr = fits.getheader(i)
-        if imhdr['BEAM'] == 0:
-            count0 += 1
-        if imhdr['BEAM'] == 1:
-            count1 += 1
-    return count0,count1
+    beams = file_headers(ims)['BEAM']
+    return int(np.sum(beams == 0)), int(np.sum(beams == 1))
 
 def build_reference_stack(path, mask0, mask1, skip_list=False, K_klip = 5, imlist=[]):
     '''Stack reference images into Nx512x1024 array for Nod 0 and Nod 1.
@@ -203,16 +194,9 @@ def build_reference_stack(path, mask0, mask1, skip_list=False, K_klip = 5, imlis
             K_klip = min(sky0_stack.shape[0],sky1_stack.shape[0])
             otherwise returns requested number of modes.
     '''
-    # Make a list of all images in the dataset:
-    if skip_list == False:
-        os.system('ls '+path+'*.fit > list')
-
     if len(imlist) == 0:
         # Make list of all fits images in folder:
-        os.system('ls '+path+'*0*.fit > list')
-        # Open the list:
-        with open('list') as f:
-            ims = f.read().splitlines()
+        ims = dataset_files(path, '*0*.fit')
     else:
         ims = imlist
 
@@ -328,13 +312,10 @@ def build_reference_skyframe_stack(path, skip_list=False, K_klip = 5):
     '''
     # Make a list of all images in the dataset:
     if skip_list == False:
-        os.system('ls '+path+'*.fit > list')
-        os.system('ls '+path+'skyframes/*.fit > skylist')
-    # Open the list:
-    with open('list') as f:
-        ims = f.read().splitlines()
-    with open('skylist') as f:
-        skyims = f.read().splitlines()
+        ims = dataset_files(path, '*.fit')
+        skyims = dataset_files(path+'skyframes/', '*.fit')
+    else:
+        ims, skyims = read_list('list'), read_list('skylist')
     count0,count1 = beam_count(ims)
     skycount0,skycount1 = beam_count(skyims)
     
@@ -742,11 +723,8 @@ def build_raw_stack(k):
     return sky0_stack, sky1_stack, xca0, yca0, xcb0, ycb0, xca1, yca1, xcb1, ycb1
 
 def build_skyframe_stack(path, skip_list=False, K_klip = 10):
-    import os
-    os.system('ls '+path+'*sky_0* > list')
     print('Collecting sky images for',path.split('/')[0],'...')
-    with open('list') as f:
-        z = f.read().splitlines()
+    z = dataset_files(path, '*sky_0*')
     image = fits.getdata(z[0])
     shape = image.shape
     sky_stack = np.zeros((len(z),*shape))
@@ -762,7 +740,6 @@ def build_skyframe_stack(path, skip_list=False, K_klip = 10):
         sky_stack[count0,:,:] = image
         count0 += 1
     print('I found ',sky_stack.shape[0],' sky frames')
-    os.system('rm list')
     return sky_stack 
 
 def build_skysubbed_stack(k):
@@ -969,16 +946,9 @@ def stack_em_up(path, skip_list = False, imlist=[]):
     h = open(path+'skysubbed1.txt','w')
     g.close()
     h.close()
-    # Make a list of all images in the dataset:
-    if skip_list == False:
-        os.system('ls '+path+'*skysub.fit > list')
-
     if len(imlist) == 0:
         # Make list of all fits images in folder:
-        os.system('ls '+path+'*0*skysub.fit > list')
-        # Open the list:
-        with open('list') as f:
-            ims = f.read().splitlines()
+        ims = dataset_files(path, '*0*skysub.fit')
     else:
         ims = imlist
 
@@ -1103,16 +1073,9 @@ def stack_em_all_up(path, skip_list = False, imlist=[], filesuffix='ssbp'):
     '''
     g = open(path+'skysubbed.txt','w')
     g.close()
-    # Make a list of all images in the dataset:
-    if skip_list == False:
-        os.system('ls '+path+'*'+filesuffix+'.fit > list')
-
     if len(imlist) == 0:
         # Make list of all fits images in folder:
-        os.system('ls '+path+'*'+filesuffix+'.fit > list')
-        # Open the list:
-        with open('list') as f:
-            ims = f.read().splitlines()
+        ims = dataset_files(path, '*'+filesuffix+'.fit')
     else:
         ims = imlist
     count = len(ims)
@@ -2,18 +2,12 @@ import numpy as np
 from astropy.io import fits
 import os
 import pandas as pd
+from cliotools.catalog import dataset_files, file_headers, read_list
 
 def beam_count(ims):
     '''Count the number of images in a dataset in each dither'''
-    from astropy.io import fits
-    count0, count1 = 0,0
-    for i in ims:
-        imhdr = fits.getheader(i)
-        if imhdr['BEAM'] == 0:
-            count0 += 1
-        if imhdr['BEAM'] == 1:
-            count1 += 1
-    return count0,count1
+    beams = file_headers(ims)['BEAM']
+    return int(np.sum(beams == 0)), int(np.sum(beams == 1))
 
 def build_reference_stack(path, skip_list=False, K_klip = 10):
 
@@ -41,10 +35,9 @@ def build_reference_stack(path, skip_list=False, K_klip = 10):
     '''
     # Make a list of all images in the dataset:
     if skip_list == False:
-        os.system('ls '+path+'*.fit > list')
-    # Open the list:
-    with open('list') as f:
-        ims = f.read().splitlines()
+        ims = dataset_files(path, '*.fit')
+    else:
+        ims = read_list('list')
     count0,count1 = beam_count(ims)
     
     # Distinguish between fits files that are single images vs data cubes:
@@ -131,10 +124,9 @@ def build_skyframe_stack(path, skip_list=False, K_klip = 10):
     '''
     # Make a list of all images in the dataset:
     if skip_list == False:
-        os.system('ls '+path+'*.fit > list')
-    # Open the list:
-    with open('list') as f:
-        ims = f.read().splitlines()
+        ims = dataset_files(path, '*.fit')
+    else:
+        ims = read_list('list')
     count0 = len(ims)
     
     # Distinguish between fits files that are single images vs data cubes:
@@ -616,10 +608,9 @@ def clio_skysubtract_wskyframes(path, skyframepath, K_klip=5, skip_list = False,
     #    find_eigenimages, build_reference_stack
     # Make a list of all images in the dataset, excluding any "cal" images:
     if skip_list == False:
-        os.system('ls '+path+'0*.fit > list')
-    # Open the list:
-    with open('list') as f:
-        ims = f.read().splitlines()
+        ims = dataset_files(path, '0*.fit')
+    else:
+        ims = read_list('list')
     # Build reference stack for each dither position:
     # Skyframes have "Beam" = 0
     sky0_stack = build_skyframe_stack(skyframepath)
@@ -652,4 +643,3 @@ def clio_skysubtract_wskyframes(path, skyframepath, K_klip=5, skip_list = False,
         count+=1
         update_progress(count,len(ims))
     print('Done.')
-    os.system('rm list')
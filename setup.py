@@ -13,6 +13,6 @@ setup(name='cliotools',
       license='MIT',
       packages=['cliotools'],
       install_requires=['numpy','scipy','astropy','matplotlib','opencv-python','photutils'],
-      package_data={'cliotools': ['system-parameters.pkl','isochrones/*']},
+      package_data={'cliotools': ['system-parameters.pkl','isochrones/*','clio_filters_v3/*']},
       include_package_data=True,
       zip_safe=False)